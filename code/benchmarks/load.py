@@ -0,0 +1,339 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load test the whole Chain Server against stub models, reproducibly and without GPUs.
+
+The benchmark starts the stub NIM from `benchmarks.stubs` in its own process, seeds a local vector index with synthetic
+documents, and launches the Chain Server in a subprocess with every model URL pointed at the stub. It then drives the
+server's `/stream` endpoint at each concurrency level and reports the percentiles of the time to first token and the
+request latency, the throughput, and the server's event loop lag, which is read from its `/metrics` endpoint.
+
+The Chain Server still keeps its chat history in Redis, so a Redis server must be reachable at `--redis-dsn`. Any other
+`APP_*` configuration in the environment is passed on to the server, so optimizations can be compared by toggling
+them between runs.
+
+```bash
+cd code
+python -m benchmarks.load --clients 1 8 32 --requests 4 --use-kb --ttft 0.2 --tokens-per-second 50
+```
+"""
+
+# pylint: disable=bad-builtin
+
+import argparse
+import asyncio
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Iterator
+
+import redis
+from langchain_core.documents import Document
+from langchain_nvidia_ai_endpoints import NVIDIAEmbeddings
+from langserve import RemoteRunnable
+from prometheus_client.parser import text_string_to_metric_families
+
+from benchmarks.stream import LevelResult, format_report, run_level
+from benchmarks.stubs import StubSettings
+from chain_server.configuration import config as app_config
+from chain_server.hybrid import SparseIndex
+from chain_server.vector_stores import LocalVectorStore
+
+_CODE_DIR = Path(__file__).resolve().parent.parent
+_LAG_METRIC = "nim_anywhere_event_loop_lag_seconds"
+_TOPICS = ["inference", "embeddings", "retrieval", "reranking", "containers", "GPUs", "latency", "throughput"]
+
+
+@dataclass
+class LoadResult:
+    """The client side results of a concurrency level and the server's event loop lag while it ran."""
+
+    level: LevelResult
+    lag_buckets: dict[float, float]
+
+    def lag(self, pct: float) -> float:
+        """A percentile of the event loop lag, interpolated within the histogram's buckets."""
+        return bucket_percentile(self.lag_buckets, pct)
+
+
+def bucket_percentile(buckets: dict[float, float], pct: float) -> float:
+    """Estimate a percentile from cumulative histogram bucket counts, keyed by their upper bounds."""
+    bounds = sorted(buckets)
+    if not bounds or not buckets[bounds[-1]]:
+        return math.nan
+    target = pct / 100 * buckets[bounds[-1]]
+    lower, below = 0.0, 0.0
+    for bound in bounds:
+        if buckets[bound] >= target:
+            if math.isinf(bound):
+                return lower
+            share = (target - below) / (buckets[bound] - below) if buckets[bound] > below else 1.0
+            return lower + (bound - lower) * share
+        lower, below = bound, buckets[bound]
+    return lower
+
+
+def free_port() -> int:
+    """Find a free local TCP port."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return int(sock.getsockname()[1])
+
+
+@contextmanager
+def stub_server(settings: StubSettings) -> Iterator[str]:
+    """Serve the stub models from their own process, yielding their base URL."""
+    port = free_port()
+    command = [
+        sys.executable,
+        "-m",
+        "benchmarks.stubs",
+        "--port",
+        str(port),
+        "--ttft",
+        str(settings.ttft),
+        "--tokens-per-second",
+        str(settings.tokens_per_second),
+        "--answer-tokens",
+        str(settings.answer_tokens),
+        "--embedding-dim",
+        str(settings.embedding_dim),
+        "--embedding-latency",
+        str(settings.embedding_latency),
+        "--rerank-latency",
+        str(settings.rerank_latency),
+        "--prefill-tokens-per-second",
+        str(settings.prefill_tokens_per_second),
+        "--prefix-cache-tokens",
+        str(settings.prefix_cache_tokens),
+    ]
+    for model in settings.models:
+        command += ["--model", model]
+    # pylint: disable-next=consider-using-with # the stub is stopped when the benchmark is done with it
+    process = subprocess.Popen(command, cwd=_CODE_DIR)
+    url = f"http://127.0.0.1:{port}/v1"
+    try:
+        _wait_until_ready(f"{url}/models", process, timeout=30)
+        yield url
+    finally:
+        _stop(process)
+
+
+def synthetic_documents(count: int) -> list[str]:
+    """Write deterministic documents that share enough vocabulary for retrieval to find several matches."""
+    return [
+        f"Document {idx} explains how NVIDIA NIM handles {_TOPICS[idx % len(_TOPICS)]} "
+        f"and {_TOPICS[(idx * 3 + 1) % len(_TOPICS)]}. "
+        + " ".join(
+            f"Paragraph {line} of document {idx} covers {_TOPICS[(idx + line) % len(_TOPICS)]}." for line in range(8)
+        )
+        for idx in range(count)
+    ]
+
+
+def seed_index(path: Path, stub_url: str, count: int, redis_dsn: str) -> None:
+    """Embed the synthetic documents with the stub and store them in a local vector index and the keyword index."""
+    embeddings = NVIDIAEmbeddings(model=app_config.embedding_model.name, base_url=stub_url, truncate="END")
+    store = LocalVectorStore(embeddings, path, app_config.milvus.collection_name)
+    texts = synthetic_documents(count)
+    metadatas = [{"source": f"synthetic/{idx}.txt", "simple_file_name": f"{idx}.txt"} for idx in range(count)]
+    ids = store.add_texts(texts, metadatas=metadatas)
+    # the keyword index outlives the temporary vector index, drop the documents of earlier runs
+    sparse_index = SparseIndex(app_config.milvus.collection_name, redis.Redis.from_url(redis_dsn))
+    sparse_index.clear()
+    sparse_index.add_documents(
+        [Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas)], ids
+    )
+
+
+def _wait_until_ready(url: str, process: subprocess.Popen[bytes], timeout: float, successes: int = 1) -> None:
+    """Poll a readiness URL until it answers successfully the given number of times in a row."""
+    deadline = time.monotonic() + timeout
+    answered = 0
+    while answered < successes:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"{url} was not ready after {timeout} seconds.")
+        if process.poll() is not None:
+            raise RuntimeError(f"The process serving {url} exited with code {process.returncode}.")
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                answered += 1
+        except (urllib.error.URLError, OSError):
+            answered = 0
+            time.sleep(0.25)
+
+
+def _stop(process: subprocess.Popen[bytes]) -> None:
+    """Stop a server process, killing it if it does not exit in time."""
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+@contextmanager
+def chain_server(
+    stub_url: str,
+    index_path: Path,
+    redis_dsn: str,
+    timeout: float,
+    workers: int | None = None,
+    *,
+    config: dict[str, str] | None = None,
+) -> Iterator[str]:
+    """Run the Chain Server in a subprocess with every model served by the stub, yielding its URL once it is ready.
+
+    When a number of workers is given, the server is run by the pre-forking `chain_server.workers` supervisor. Any
+    further configuration is passed to the server as `APP_*` environment variables.
+    """
+    port = free_port()
+    env = {
+        **os.environ,
+        "APP_LLM_MODEL__URL": stub_url,
+        "APP_EMBEDDING_MODEL__URL": stub_url,
+        "APP_RERANKING_MODEL__URL": stub_url,
+        "APP_VECTOR_STORE__BACKEND": "local",
+        "APP_VECTOR_STORE__PATH": str(index_path),
+        "APP_REDIS_DSN": redis_dsn,
+        **(config or {}),
+    }
+    if workers is None:
+        command = [sys.executable, "-m", "uvicorn", "chain_server.server:app", "--port", str(port)]
+    else:
+        env["APP_WORKERS"] = str(workers)
+        command = [sys.executable, "-m", "chain_server.workers", "--port", str(port)]
+    # pylint: disable-next=consider-using-with # the server is stopped when the benchmark is done with it
+    process = subprocess.Popen([*command, "--log-level", "warning"], cwd=_CODE_DIR, env=env)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        # with several workers, keep polling until the readiness probes are likely to have reached all of them
+        _wait_until_ready(f"{url}/readyz", process, timeout, successes=4 * (workers or 1))
+        yield url
+    finally:
+        _stop(process)
+
+
+def scrape_lag(url: str) -> dict[float, float]:
+    """Read the cumulative bucket counts of the server's event loop lag histogram."""
+    with urllib.request.urlopen(f"{url}/metrics", timeout=5) as response:
+        text = response.read().decode("UTF-8")
+    buckets: dict[float, float] = {}
+    for family in text_string_to_metric_families(text):
+        if family.name == _LAG_METRIC:
+            for sample in family.samples:
+                if sample.name.endswith("_bucket"):
+                    buckets[float(sample.labels["le"])] = sample.value
+    return buckets
+
+
+def format_lag_report(results: list[LoadResult]) -> str:
+    """Render the event loop lag of every level as a table."""
+    lines = [f"{'clients':>8} {'lag p50':>9} {'lag p95':>9} {'lag p99':>9}"]
+    for res in results:
+        lines.append(
+            f"{res.level.clients:>8} {res.lag(50) * 1000:>7.2f}ms {res.lag(95) * 1000:>7.2f}ms "
+            f"{res.lag(99) * 1000:>7.2f}ms"
+        )
+    return "\n".join(lines)
+
+
+async def run_levels(url: str, args: argparse.Namespace) -> list[LoadResult]:
+    """Measure every requested concurrency level, asking every request a different question."""
+    chain: RemoteRunnable[dict[str, Any], str] = RemoteRunnable(url + "/", timeout=args.timeout)
+    results = []
+    for clients in args.clients:
+        inputs = [
+            {
+                "question": f"How does NIM handle {_TOPICS[idx % len(_TOPICS)]} in case {idx}?",
+                "use_kb": args.use_kb,
+                "use_reranker": args.use_reranker,
+                "coalesce": args.coalesce,
+            }
+            for idx in range(clients * args.requests)
+        ]
+        print(f"Running {clients} concurrent clients...")
+        before = scrape_lag(url)
+        level = await run_level(chain, clients, args.requests, inputs)
+        after = scrape_lag(url)
+        results.append(LoadResult(level, {bound: count - before.get(bound, 0.0) for bound, count in after.items()}))
+    return results
+
+
+def _parse_arguments() -> argparse.Namespace:
+    """Parse the CLI arguments."""
+    defaults = StubSettings()
+    parser = argparse.ArgumentParser("Chain Server end to end load test")
+    parser.add_argument(
+        "--clients", type=int, nargs="+", default=[1, 4, 16, 64], help="The concurrency levels to measure."
+    )
+    parser.add_argument("--requests", type=int, default=4, help="The number of requests sent by each client.")
+    parser.add_argument(
+        "--use-kb", action="store_true", default=False, help="Retrieve context from the knowledge base."
+    )
+    parser.add_argument("--use-reranker", action="store_true", default=False, help="Rerank the retrieved context.")
+    parser.add_argument(
+        "--hybrid-search", action="store_true", default=False, help="Fuse the vector search with the keyword search."
+    )
+    parser.add_argument(
+        "--coalesce", action=argparse.BooleanOptionalAction, help="Ask the server to coalesce the streamed tokens."
+    )
+    parser.add_argument("--documents", type=int, default=500, help="The number of synthetic documents to index.")
+    parser.add_argument("--ttft", type=float, default=defaults.ttft, help="The stub LLM's time to first token.")
+    parser.add_argument(
+        "--tokens-per-second", type=float, default=defaults.tokens_per_second, help="The stub LLM's token rate."
+    )
+    parser.add_argument(
+        "--answer-tokens", type=int, default=defaults.answer_tokens, help="The number of tokens in every answer."
+    )
+    parser.add_argument(
+        "--redis-dsn", default="redis://localhost:6379/0", help="The Redis server used by the Chain Server."
+    )
+    parser.add_argument("--startup-timeout", type=float, default=120.0, help="The seconds to wait for the server.")
+    parser.add_argument("--timeout", type=float, default=120.0, help="The per request timeout in seconds.")
+    return parser.parse_args()
+
+
+def main() -> None:
+    """Execute main routine."""
+    args = _parse_arguments()
+    settings = StubSettings(
+        ttft=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        answer_tokens=args.answer_tokens,
+        models=[app_config.llm_model.name, app_config.embedding_model.name, app_config.reranking_model.name],
+    )
+    with tempfile.TemporaryDirectory(prefix="nim-anywhere-load-") as index_path, stub_server(settings) as stub_url:
+        print(f"Indexing {args.documents} synthetic documents...")
+        seed_index(Path(index_path), stub_url, args.documents, args.redis_dsn)
+        config = {"APP_MILVUS__HYBRID_SEARCH": str(args.hybrid_search).lower()}
+        with chain_server(stub_url, Path(index_path), args.redis_dsn, args.startup_timeout, config=config) as url:
+            results = asyncio.run(run_levels(url, args))
+    print(format_report([res.level for res in results]))
+    print()
+    print(format_lag_report(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure how much prompt prefill the LLM's prefix cache saves with each layout of the chat prompt.
+
+The benchmark starts the stub NIM from `benchmarks.stubs`, which simulates a prefix cache, and runs the Chain Server
+once for each context layout. Every simulated session asks a series of questions with retrieval enabled, one turn
+after another, while the sessions run concurrently. By default, a session runs three times as many turns as the
+history keeps verbatim, so its prompts include the history summary, which is rewritten as turns are folded into it.
+The stub's totals then show how many of the prompt tokens it was sent hit its prefix cache, and so skipped the
+prefill. The prefill rate of the stub turns the saved tokens into a shorter time to first token.
+
+A Redis server must be reachable at `--redis-dsn`, as for `benchmarks.load`.
+
+```bash
+cd code
+python -m benchmarks.prefix_cache --sessions 8 --max-turns 2 --prefill-tokens-per-second 2000
+```
+"""
+
+# pylint: disable=bad-builtin
+
+import argparse
+import asyncio
+import json
+import tempfile
+import urllib.request
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from langserve import RemoteRunnable
+
+from benchmarks.load import chain_server, seed_index, stub_server
+from benchmarks.stream import RequestTiming, percentile
+from benchmarks.stubs import StubSettings
+from chain_server.configuration import config as app_config
+
+_LAYOUTS = ("system", "question")
+_TOPICS = ["inference", "embeddings", "retrieval", "reranking", "containers", "GPUs", "latency", "throughput"]
+_QUESTION = "What does document {document} of the knowledge base explain about {topic}?"
+
+
+@dataclass
+class LayoutResult:
+    """The prompt tokens the stub LLM received with a layout, and the client side timings."""
+
+    layout: str
+    stats: dict[str, int]
+    timings: list[RequestTiming]
+
+    @property
+    def saved(self) -> float:
+        """The share of the prompt tokens that hit the prefix cache."""
+        return self.stats["cached_tokens"] / self.stats["prompt_tokens"] if self.stats["prompt_tokens"] else 0.0
+
+    def ttft(self, pct: float) -> float:
+        """A percentile of the time to first token."""
+        return percentile([timing.ttft for timing in self.timings], pct)
+
+
+def _stub_stats(stub_url: str, method: str = "GET") -> dict[str, int]:
+    """Read, or reset, the stub's prompt token totals."""
+    request = urllib.request.Request(f"{stub_url}/stats", method=method)
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return dict(json.load(response))
+
+
+async def run_session(chain: RemoteRunnable, turns: int, first: int, use_reranker: bool) -> list[RequestTiming]:
+    """Ask a series of questions about different documents in one chat session, one turn after another.
+
+    Every question asks about its own document, so no two requests retrieve the same context.
+    """
+    session = chain.with_config(configurable={"session_id": str(uuid.uuid4())})
+    timings = []
+    for turn in range(turns):
+        inputs = {
+            "question": _QUESTION.format(document=first + turn, topic=_TOPICS[(first + turn) % len(_TOPICS)]),
+            "use_kb": True,
+            "use_reranker": use_reranker,
+        }
+        start = asyncio.get_running_loop().time()
+        ttft = None
+        chunks = 0
+        async for _ in session.astream(inputs):
+            if ttft is None:
+                ttft = asyncio.get_running_loop().time() - start
+            chunks += 1
+        latency = asyncio.get_running_loop().time() - start
+        timings.append(RequestTiming(ttft=latency if ttft is None else ttft, latency=latency, chunks=chunks))
+    return timings
+
+
+async def run_layout(url: str, args: argparse.Namespace) -> list[RequestTiming]:
+    """Run every session concurrently against a server."""
+    chain: RemoteRunnable[dict[str, Any], str] = RemoteRunnable(url.rstrip("/") + "/", timeout=args.timeout)
+    sessions = await asyncio.gather(
+        *(run_session(chain, args.turns, idx * args.turns, args.use_reranker) for idx in range(args.sessions))
+    )
+    return [timing for session in sessions for timing in session]
+
+
+def format_report(results: list[LayoutResult]) -> str:
+    """Render the prompt tokens and the time to first token of every layout as a table."""
+    lines = [
+        f"{'layout':>9} {'requests':>9} {'prompt tok':>11} {'cached tok':>11} {'saved':>7} "
+        f"{'ttft p50':>9} {'ttft p95':>9}"
+    ]
+    for res in results:
+        lines.append(
+            f"{res.layout:>9} {res.stats['requests']:>9} {res.stats['prompt_tokens']:>11} "
+            f"{res.stats['cached_tokens']:>11} {res.saved:>6.1%} {res.ttft(50):>8.3f}s {res.ttft(95):>8.3f}s"
+        )
+    return "\n".join(lines)
+
+
+def _parse_arguments() -> argparse.Namespace:
+    """Parse the CLI arguments."""
+    defaults = StubSettings()
+    parser = argparse.ArgumentParser("Chain Server prefix cache benchmark")
+    parser.add_argument("--sessions", type=int, default=8, help="The number of concurrent chat sessions.")
+    parser.add_argument(
+        "--max-turns",
+        type=int,
+        default=app_config.history.max_turns,
+        help="The number of turns the Chain Server's history keeps verbatim.",
+    )
+    parser.add_argument(
+        "--turns",
+        type=int,
+        default=None,
+        help="The number of questions asked in every session, three times the verbatim turns by default.",
+    )
+    parser.add_argument(
+        "--layout", choices=_LAYOUTS, nargs="+", default=list(_LAYOUTS), help="The context layouts to compare."
+    )
+    parser.add_argument("--use-reranker", action="store_true", default=False, help="Rerank the retrieved context.")
+    parser.add_argument("--documents", type=int, default=500, help="The number of synthetic documents to index.")
+    parser.add_argument("--ttft", type=float, default=defaults.ttft, help="The stub's time to first token.")
+    parser.add_argument(
+        "--tokens-per-second", type=float, default=defaults.tokens_per_second, help="The stub's token rate."
+    )
+    parser.add_argument(
+        "--prefill-tokens-per-second",
+        type=float,
+        default=2000.0,
+        help="The rate the stub processes uncached prompt tokens at before the first token.",
+    )
+    parser.add_argument(
+        "--redis-dsn", default="redis://localhost:6379/0", help="The Redis server used by the Chain Server."
+    )
+    parser.add_argument("--timeout", type=float, default=120.0, help="The per request timeout in seconds.")
+    parser.add_argument("--startup-timeout", type=float, default=120.0, help="The seconds to wait for the server.")
+    args = parser.parse_args()
+    if args.turns is None:
+        args.turns = 3 * max(args.max_turns, 1)
+    return args
+
+
+def main() -> None:
+    """Execute main routine."""
+    args = _parse_arguments()
+    settings = StubSettings(
+        ttft=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        prefill_tokens_per_second=args.prefill_tokens_per_second,
+        models=[app_config.llm_model.name, app_config.embedding_model.name, app_config.reranking_model.name],
+    )
+    results = []
+    with tempfile.TemporaryDirectory(prefix="nim-anywhere-prefix-") as index_path, stub_server(settings) as stub_url:
+        seed_index(Path(index_path), stub_url, args.documents, args.redis_dsn)
+        for layout in args.layout:
+            print(f"Running {args.sessions} sessions of {args.turns} turns with the {layout} layout...")
+            config = {"APP_CONTEXT__LAYOUT": layout, "APP_HISTORY__MAX_TURNS": str(args.max_turns)}
+            with chain_server(stub_url, Path(index_path), args.redis_dsn, args.startup_timeout, config=config) as url:
+                _stub_stats(stub_url, "DELETE")
+                timings = asyncio.run(run_layout(url, args))
+                results.append(LayoutResult(layout=layout, stats=_stub_stats(stub_url), timings=timings))
+    print(format_report(results))
+
+
+if __name__ == "__main__":
+    main()
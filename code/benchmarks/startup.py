@@ -0,0 +1,97 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the Chain Server's cold start, from launching the process until it reports ready.
+
+Every run launches a new Chain Server against the stub models and a local vector index, then polls its `/readyz`
+endpoint. The wall time seen by the benchmark is reported next to the phases the server measured itself: booting the
+interpreter and importing the code, connecting the clients, and warming them up.
+
+A Redis server must be reachable at `--redis-dsn`, as for `benchmarks.load`.
+
+```bash
+cd code
+python -m benchmarks.startup --runs 5
+```
+"""
+
+# pylint: disable=bad-builtin
+
+import argparse
+import json
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+from benchmarks.load import chain_server, seed_index, stub_server
+from benchmarks.stream import percentile
+from benchmarks.stubs import StubSettings
+from chain_server.configuration import config as app_config
+
+_PHASES = ("boot", "connect", "warm_up", "total")
+
+
+def measure_start(stub_url: str, index_path: Path, redis_dsn: str, timeout: float) -> dict[str, float]:
+    """Launch a server and time how long it takes to become ready."""
+    start = time.perf_counter()
+    with chain_server(stub_url, index_path, redis_dsn, timeout) as url:
+        ready = time.perf_counter() - start
+        with urllib.request.urlopen(f"{url}/readyz", timeout=5) as response:
+            report = json.load(response)
+    return {"ready": ready, **report["startup_seconds"]}
+
+
+def format_report(runs: list[dict[str, float]]) -> str:
+    """Render the percentiles of every phase as a table."""
+    lines = [f"{'phase':>8} {'p50':>9} {'p95':>9} {'max':>9}"]
+    for phase in ("ready", *_PHASES):
+        values = [run[phase] for run in runs if phase in run]
+        lines.append(
+            f"{phase:>8} {percentile(values, 50):>8.3f}s {percentile(values, 95):>8.3f}s "
+            f"{max(values, default=float('nan')):>8.3f}s"
+        )
+    return "\n".join(lines)
+
+
+def _parse_arguments() -> argparse.Namespace:
+    """Parse the CLI arguments."""
+    parser = argparse.ArgumentParser("Chain Server cold start benchmark")
+    parser.add_argument("--runs", type=int, default=5, help="The number of times to start the server.")
+    parser.add_argument("--documents", type=int, default=500, help="The number of synthetic documents to index.")
+    parser.add_argument(
+        "--redis-dsn", default="redis://localhost:6379/0", help="The Redis server used by the Chain Server."
+    )
+    parser.add_argument("--startup-timeout", type=float, default=120.0, help="The seconds to wait for the server.")
+    return parser.parse_args()
+
+
+def main() -> None:
+    """Execute main routine."""
+    args = _parse_arguments()
+    settings = StubSettings(
+        models=[app_config.llm_model.name, app_config.embedding_model.name, app_config.reranking_model.name]
+    )
+    runs = []
+    with tempfile.TemporaryDirectory(prefix="nim-anywhere-startup-") as index_path, stub_server(settings) as stub_url:
+        seed_index(Path(index_path), stub_url, args.documents, args.redis_dsn)
+        for run in range(args.runs):
+            print(f"Starting the server, run {run + 1} of {args.runs}...")
+            runs.append(measure_start(stub_url, Path(index_path), args.redis_dsn, args.startup_timeout))
+    print(format_report(runs))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure how the Chain Server's streaming throughput scales with concurrent clients.
+
+Every concurrency level starts the requested number of simulated clients. Each client streams its questions from the
+`/stream` endpoint one after another. A server that keeps its event loop free will finish a level in roughly the same
+wall time regardless of the client count, so the throughput should grow with the number of clients instead of
+flattening out.
+
+Start the Chain Server and run:
+
+```bash
+cd code
+python -m benchmarks.stream --url http://localhost:3030 --clients 1 2 4 8 16
+```
+"""
+
+# pylint: disable=bad-builtin
+
+import argparse
+import asyncio
+import math
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any
+
+from langserve import RemoteRunnable
+
+_DEFAULT_QUESTIONS = [
+    "What is NVIDIA NIM?",
+    "How do I run a NIM locally?",
+    "Which models are available as NIMs?",
+    "What is retrieval augmented generation?",
+]
+
+
+@dataclass
+class RequestTiming:
+    """The client side timings of a single streamed request."""
+
+    ttft: float
+    latency: float
+    chunks: int
+
+
+@dataclass
+class LevelResult:
+    """The results of running one concurrency level."""
+
+    clients: int
+    wall_time: float
+    timings: list[RequestTiming] = field(default_factory=list)
+    errors: int = 0
+
+    @property
+    def throughput(self) -> float:
+        """Completed requests per second."""
+        return len(self.timings) / self.wall_time if self.wall_time else 0.0
+
+    def ttft(self, pct: float) -> float:
+        """A percentile of the time to first token."""
+        return percentile([timing.ttft for timing in self.timings], pct)
+
+    def latency(self, pct: float) -> float:
+        """A percentile of the total request latency."""
+        return percentile([timing.latency for timing in self.timings], pct)
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """Calculate a percentile using the nearest-rank method."""
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+async def time_request(chain: RemoteRunnable, inputs: dict[str, Any]) -> RequestTiming:
+    """Stream a single request and record the client side timings."""
+    session = chain.with_config(configurable={"session_id": str(uuid.uuid4())})
+    start = time.perf_counter()
+    ttft = math.nan
+    chunks = 0
+    async for _ in session.astream(inputs):
+        if not chunks:
+            ttft = time.perf_counter() - start
+        chunks += 1
+    return RequestTiming(ttft=ttft, latency=time.perf_counter() - start, chunks=chunks)
+
+
+async def run_level(
+    chain: RemoteRunnable, clients: int, requests_per_client: int, inputs: list[dict[str, Any]]
+) -> LevelResult:
+    """Run a fixed number of concurrent clients against the server."""
+    result = LevelResult(clients=clients, wall_time=0.0)
+
+    async def _client(client_idx: int) -> None:
+        for request_idx in range(requests_per_client):
+            request = inputs[(client_idx + request_idx) % len(inputs)]
+            try:
+                result.timings.append(await time_request(chain, request))
+            except Exception:  # pylint: disable=broad-exception-caught # report failures instead of aborting the run
+                result.errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(_client(idx) for idx in range(clients)))
+    result.wall_time = time.perf_counter() - start
+    return result
+
+
+def format_report(results: list[LevelResult]) -> str:
+    """Render the benchmark results as a table."""
+    base = results[0].throughput if results else 0.0
+    lines = [
+        f"{'clients':>8} {'ok':>6} {'errors':>6} {'req/s':>8} {'speedup':>8} "
+        f"{'ttft p50':>9} {'ttft p95':>9} {'lat p50':>9} {'lat p95':>9} {'lat p99':>9}"
+    ]
+    for res in results:
+        speedup = res.throughput / base if base else math.nan
+        lines.append(
+            f"{res.clients:>8} {len(res.timings):>6} {res.errors:>6} {res.throughput:>8.2f} {speedup:>7.2f}x "
+            f"{res.ttft(50):>8.3f}s {res.ttft(95):>8.3f}s "
+            f"{res.latency(50):>8.3f}s {res.latency(95):>8.3f}s {res.latency(99):>8.3f}s"
+        )
+    return "\n".join(lines)
+
+
+def _parse_arguments() -> argparse.Namespace:
+    """Parse the CLI arguments."""
+    parser = argparse.ArgumentParser("Chain Server streaming benchmark")
+    parser.add_argument("--url", default="http://localhost:3030", help="The base URL of the Chain Server.")
+    parser.add_argument(
+        "--clients", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="The concurrency levels to measure."
+    )
+    parser.add_argument("--requests", type=int, default=4, help="The number of requests sent by each client.")
+    parser.add_argument("--question", action="append", help="A question to ask. May be repeated.")
+    parser.add_argument(
+        "--use-kb", action="store_true", default=False, help="Retrieve context from the knowledge base."
+    )
+    parser.add_argument("--use-reranker", action="store_true", default=False, help="Rerank the retrieved context.")
+    parser.add_argument(
+        "--coalesce", action=argparse.BooleanOptionalAction, help="Ask the server to coalesce the streamed tokens."
+    )
+    parser.add_argument("--timeout", type=float, default=120.0, help="The per request timeout in seconds.")
+    return parser.parse_args()
+
+
+async def _run(args: argparse.Namespace) -> list[LevelResult]:
+    """Measure every requested concurrency level."""
+    chain: RemoteRunnable[dict[str, Any], str] = RemoteRunnable(args.url.rstrip("/") + "/", timeout=args.timeout)
+    inputs = [
+        {"question": question, "use_kb": args.use_kb, "use_reranker": args.use_reranker, "coalesce": args.coalesce}
+        for question in (args.question or _DEFAULT_QUESTIONS)
+    ]
+    results = []
+    for clients in args.clients:
+        print(f"Running {clients} concurrent clients...")
+        results.append(await run_level(chain, clients, args.requests, inputs))
+    return results
+
+
+def main() -> None:
+    """Execute main routine."""
+    args = _parse_arguments()
+    results = asyncio.run(_run(args))
+    print(format_report(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local stand-ins for the NIM model APIs, used to benchmark the Chain Server without GPUs or network access.
+
+The stub serves an OpenAI compatible chat completions endpoint that streams a fixed answer with a configurable time to
+first token and token rate, an embeddings endpoint that hashes words into deterministic vectors, and a ranking endpoint
+that scores passages by their word overlap with the query. All three are served under `/v1`, so one stub can stand in
+for the LLM, embedding and reranking NIMs.
+
+The chat endpoint simulates a prefix cache: prompts are split into blocks of tokens, and the leading blocks a previous
+prompt already sent are reported as cached tokens and skip the simulated prefill time. The totals are served from
+`/v1/stats` and reset by deleting it.
+
+```bash
+cd code
+python -m benchmarks.stubs --port 9000 --ttft 0.2 --tokens-per-second 50 --model meta/llama3-8b-instruct
+```
+"""
+
+import argparse
+import asyncio
+import json
+import re
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+_WORD_RE = re.compile(r"\w+")
+_ANSWER_WORDS = (
+    "NVIDIA NIM microservices package optimized inference engines for foundation models behind industry standard APIs "
+    "so they can be deployed anywhere from a workstation to the data center"
+).split()
+# the stub counts four characters as a token, and caches prompts in blocks of sixteen tokens
+_CHARS_PER_TOKEN = 4
+_BLOCK_TOKENS = 16
+
+
+@dataclass
+class StubSettings:  # pylint: disable=too-many-instance-attributes # one attribute per simulated setting
+    """The simulated performance of the stub models."""
+
+    ttft: float = 0.2
+    tokens_per_second: float = 50.0
+    answer_tokens: int = 64
+    embedding_dim: int = 256
+    embedding_latency: float = 0.01
+    rerank_latency: float = 0.02
+    prefill_tokens_per_second: float = 0.0
+    prefix_cache_tokens: int = 1 << 20
+    models: list[str] = field(default_factory=list)
+
+
+class PrefixCache:
+    """A simulated prefix cache holding the blocks of recent prompts, evicting the least recently used block.
+
+    A block is identified by its tokens and every token before it, so only the blocks of a shared prompt prefix hit.
+    """
+
+    def __init__(self, capacity_tokens: int) -> None:
+        """Initialize an empty cache."""
+        self._capacity = capacity_tokens // _BLOCK_TOKENS
+        self._blocks: OrderedDict[int, None] = OrderedDict()
+
+    def cached_tokens(self, prompt: str) -> int:
+        """Count the tokens of the prompt's cached prefix, then cache all of its full blocks."""
+        block_chars = _BLOCK_TOKENS * _CHARS_PER_TOKEN
+        prefix = 0
+        hits = 0
+        for index, start in enumerate(range(0, len(prompt) - block_chars + 1, block_chars)):
+            prefix = hash((prefix, prompt[start : start + block_chars]))
+            if hits == index and prefix in self._blocks:
+                hits += 1
+            self._blocks[prefix] = None
+            self._blocks.move_to_end(prefix)
+        while len(self._blocks) > self._capacity:
+            self._blocks.popitem(last=False)
+        return hits * _BLOCK_TOKENS
+
+    def clear(self) -> None:
+        """Forget every cached block."""
+        self._blocks.clear()
+
+
+def embed(text: str, dim: int) -> list[float]:
+    """Hash the words of a text into a unit length vector, so texts that share words are similar."""
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in _WORD_RE.findall(text.lower()):
+        vector[zlib.crc32(word.encode("UTF-8")) % dim] += 1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+def _overlap(query: str, passage: str) -> float:
+    """Score a passage by the share of the query's words it contains."""
+    query_words = set(_WORD_RE.findall(query.lower()))
+    passage_words = set(_WORD_RE.findall(passage.lower()))
+    return len(query_words & passage_words) / max(len(query_words), 1)
+
+
+def _chat_chunk(model: str, delta: dict[str, Any], finish_reason: str | None = None, **extra: Any) -> str:
+    """Format a streamed chat completion chunk as a server sent event."""
+    chunk = {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        **extra,
+    }
+    return f"data: {json.dumps(chunk)}\n\n"
+
+
+def create_app(settings: StubSettings) -> FastAPI:
+    """Create the stub NIM API."""
+    app = FastAPI(title="Stub NIM")
+    answer = [f" {_ANSWER_WORDS[idx % len(_ANSWER_WORDS)]}" for idx in range(settings.answer_tokens)]
+    prefix_cache = PrefixCache(settings.prefix_cache_tokens)
+    totals = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0}
+
+    @app.get("/v1/models")
+    async def models() -> dict[str, Any]:
+        """List the model names the clients validate, the stub answers as any model."""
+        return {
+            "object": "list",
+            "data": [{"id": model, "object": "model", "created": 0, "owned_by": "stub"} for model in settings.models],
+        }
+
+    @app.post("/v1/chat/completions", response_model=None)
+    async def chat_completions(request: Request) -> JSONResponse | StreamingResponse:
+        """Answer with a fixed text at the configured speed."""
+        body = await request.json()
+        model = body.get("model", "stub")
+        messages = body.get("messages", [])
+        prompt_tokens = sum(len(str(message.get("content", ""))) for message in messages) // _CHARS_PER_TOKEN
+        prompt = "".join(f"<|{message.get('role')}|>{message.get('content', '')}" for message in messages)
+        cached_tokens = min(prefix_cache.cached_tokens(prompt), prompt_tokens)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(answer),
+            "total_tokens": prompt_tokens + len(answer),
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+        totals["requests"] += 1
+        totals["prompt_tokens"] += prompt_tokens
+        totals["cached_tokens"] += cached_tokens
+        ttft = settings.ttft
+        if settings.prefill_tokens_per_second:
+            ttft += (prompt_tokens - cached_tokens) / settings.prefill_tokens_per_second
+
+        if not body.get("stream"):
+            await asyncio.sleep(ttft + len(answer) / settings.tokens_per_second)
+            return JSONResponse(
+                {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": "".join(answer)},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": usage,
+                }
+            )
+
+        async def _stream() -> AsyncIterator[str]:
+            await asyncio.sleep(ttft)
+            yield _chat_chunk(model, {"role": "assistant", "content": answer[0]})
+            for token in answer[1:]:
+                await asyncio.sleep(1 / settings.tokens_per_second)
+                yield _chat_chunk(model, {"content": token})
+            yield _chat_chunk(model, {}, finish_reason="stop", usage=usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(_stream(), media_type="text/event-stream")
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request) -> dict[str, Any]:
+        """Embed the inputs with word hashing."""
+        body = await request.json()
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        await asyncio.sleep(settings.embedding_latency)
+        return {
+            "object": "list",
+            "model": body.get("model", "stub"),
+            "data": [
+                {"object": "embedding", "index": idx, "embedding": embed(text, settings.embedding_dim)}
+                for idx, text in enumerate(texts)
+            ],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }
+
+    @app.post("/v1/ranking")
+    async def ranking(request: Request) -> dict[str, Any]:
+        """Rank the passages by their word overlap with the query."""
+        body = await request.json()
+        query = body["query"]["text"]
+        await asyncio.sleep(settings.rerank_latency)
+        scores = [_overlap(query, passage["text"]) for passage in body["passages"]]
+        order = sorted(range(len(scores)), key=lambda idx: -scores[idx])
+        return {"rankings": [{"index": idx, "logit": scores[idx]} for idx in order]}
+
+    @app.get("/v1/stats")
+    async def stats() -> dict[str, int]:
+        """Report the prompt tokens received and how many of them hit the prefix cache."""
+        return totals
+
+    @app.delete("/v1/stats")
+    async def reset_stats() -> dict[str, int]:
+        """Reset the totals and empty the prefix cache."""
+        totals.update(requests=0, prompt_tokens=0, cached_tokens=0)
+        prefix_cache.clear()
+        return totals
+
+    return app
+
+
+def _parse_arguments() -> argparse.Namespace:
+    """Parse the CLI arguments."""
+    defaults = StubSettings()
+    parser = argparse.ArgumentParser("Stub NIM server")
+    parser.add_argument("--host", default="127.0.0.1", help="The address to listen on.")
+    parser.add_argument("--port", type=int, default=9000, help="The port to listen on.")
+    parser.add_argument("--ttft", type=float, default=defaults.ttft, help="The seconds before the first token.")
+    parser.add_argument(
+        "--tokens-per-second", type=float, default=defaults.tokens_per_second, help="The rate tokens are streamed at."
+    )
+    parser.add_argument(
+        "--answer-tokens", type=int, default=defaults.answer_tokens, help="The number of tokens in every answer."
+    )
+    parser.add_argument(
+        "--embedding-dim", type=int, default=defaults.embedding_dim, help="The size of the embedding vectors."
+    )
+    parser.add_argument(
+        "--embedding-latency",
+        type=float,
+        default=defaults.embedding_latency,
+        help="The seconds every embedding request takes.",
+    )
+    parser.add_argument(
+        "--rerank-latency", type=float, default=defaults.rerank_latency, help="The seconds every ranking takes."
+    )
+    parser.add_argument(
+        "--prefill-tokens-per-second",
+        type=float,
+        default=defaults.prefill_tokens_per_second,
+        help="The rate uncached prompt tokens are processed at before the first token, 0 to skip the prefill time.",
+    )
+    parser.add_argument(
+        "--prefix-cache-tokens",
+        type=int,
+        default=defaults.prefix_cache_tokens,
+        help="The number of prompt tokens the simulated prefix cache holds.",
+    )
+    parser.add_argument("--model", action="append", default=[], help="A model name to list. May be repeated.")
+    return parser.parse_args()
+
+
+def main() -> None:
+    """Serve the stub models."""
+    args = _parse_arguments()
+    settings = StubSettings(
+        ttft=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        answer_tokens=args.answer_tokens,
+        embedding_dim=args.embedding_dim,
+        embedding_latency=args.embedding_latency,
+        rerank_latency=args.rerank_latency,
+        prefill_tokens_per_second=args.prefill_tokens_per_second,
+        prefix_cache_tokens=args.prefix_cache_tokens,
+        models=args.model,
+    )
+    uvicorn.run(create_app(settings), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
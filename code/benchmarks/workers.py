@@ -0,0 +1,137 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure how the Chain Server's throughput scales with the number of pre-forked worker processes.
+
+For every worker count, the benchmark starts the server with `chain_server.workers` against the stub models and a local
+vector index, and drives it with the same number of concurrent clients. The stub answers quickly with long answers, so
+the server's own CPU work dominates and the throughput should grow with the workers until the cores run out. The
+clients are spread across several processes, so the load generator does not become the bottleneck.
+
+A Redis server must be reachable at `--redis-dsn`, as for `benchmarks.load`.
+
+```bash
+cd code
+python -m benchmarks.workers --workers 1 2 4 8 --clients 64
+```
+"""
+
+# pylint: disable=bad-builtin
+
+import argparse
+import asyncio
+import math
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+
+from langserve import RemoteRunnable
+
+from benchmarks.load import chain_server, seed_index, stub_server
+from benchmarks.stream import LevelResult, run_level
+from benchmarks.stubs import StubSettings
+from chain_server.configuration import config as app_config
+
+
+def _client_process(
+    url: str, clients: int, requests_per_client: int, inputs: list[dict[str, Any]], timeout: float
+) -> LevelResult:
+    """Run a share of the clients from one process."""
+    chain: RemoteRunnable[dict[str, Any], str] = RemoteRunnable(url + "/", timeout=timeout)
+    return asyncio.run(run_level(chain, clients, requests_per_client, inputs))
+
+
+def run_distributed(url: str, args: argparse.Namespace, workers: int) -> LevelResult:
+    """Run the clients across several processes and combine their results."""
+    inputs = [
+        {"question": f"How does NIM scale case {idx}?", "use_kb": args.use_kb, "use_reranker": args.use_reranker}
+        for idx in range(args.clients * args.requests)
+    ]
+    processes = min(args.client_processes, args.clients)
+    shares = [args.clients // processes + (idx < args.clients % processes) for idx in range(processes)]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [
+            pool.submit(_client_process, url, share, args.requests, inputs, args.timeout) for share in shares if share
+        ]
+        parts = [future.result() for future in futures]
+    result = LevelResult(clients=workers, wall_time=max(part.wall_time for part in parts))
+    for part in parts:
+        result.timings += part.timings
+        result.errors += part.errors
+    return result
+
+
+def format_report(results: list[LevelResult]) -> str:
+    """Render the results of every worker count as a table."""
+    base = results[0].throughput if results else 0.0
+    lines = [
+        f"{'workers':>8} {'ok':>6} {'errors':>6} {'req/s':>8} {'speedup':>8} "
+        f"{'ttft p50':>9} {'ttft p95':>9} {'lat p50':>9} {'lat p95':>9} {'lat p99':>9}"
+    ]
+    for res in results:
+        speedup = res.throughput / base if base else math.nan
+        lines.append(
+            f"{res.clients:>8} {len(res.timings):>6} {res.errors:>6} {res.throughput:>8.2f} {speedup:>7.2f}x "
+            f"{res.ttft(50):>8.3f}s {res.ttft(95):>8.3f}s "
+            f"{res.latency(50):>8.3f}s {res.latency(95):>8.3f}s {res.latency(99):>8.3f}s"
+        )
+    return "\n".join(lines)
+
+
+def _parse_arguments() -> argparse.Namespace:
+    """Parse the CLI arguments."""
+    parser = argparse.ArgumentParser("Chain Server worker scaling benchmark")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="The worker counts to measure.")
+    parser.add_argument("--clients", type=int, default=64, help="The number of concurrent clients.")
+    parser.add_argument("--requests", type=int, default=4, help="The number of requests sent by each client.")
+    parser.add_argument(
+        "--client-processes", type=int, default=4, help="The number of processes the clients are spread across."
+    )
+    parser.add_argument(
+        "--use-kb", action="store_true", default=False, help="Retrieve context from the knowledge base."
+    )
+    parser.add_argument("--use-reranker", action="store_true", default=False, help="Rerank the retrieved context.")
+    parser.add_argument("--documents", type=int, default=500, help="The number of synthetic documents to index.")
+    parser.add_argument("--answer-tokens", type=int, default=256, help="The number of tokens in every answer.")
+    parser.add_argument(
+        "--redis-dsn", default="redis://localhost:6379/0", help="The Redis server used by the Chain Server."
+    )
+    parser.add_argument("--startup-timeout", type=float, default=120.0, help="The seconds to wait for the server.")
+    parser.add_argument("--timeout", type=float, default=120.0, help="The per request timeout in seconds.")
+    return parser.parse_args()
+
+
+def main() -> None:
+    """Execute main routine."""
+    args = _parse_arguments()
+    settings = StubSettings(
+        ttft=0.05,
+        tokens_per_second=2000,
+        answer_tokens=args.answer_tokens,
+        models=[app_config.llm_model.name, app_config.embedding_model.name, app_config.reranking_model.name],
+    )
+    results = []
+    with tempfile.TemporaryDirectory(prefix="nim-anywhere-workers-") as index_path, stub_server(settings) as stub_url:
+        seed_index(Path(index_path), stub_url, args.documents, args.redis_dsn)
+        for workers in args.workers:
+            print(f"Running {args.clients} clients against {workers} workers...")
+            with chain_server(stub_url, Path(index_path), args.redis_dsn, args.startup_timeout, workers) as url:
+                results.append(run_distributed(url, args, workers))
+    print(format_report(results))
+
+
+if __name__ == "__main__":
+    main()
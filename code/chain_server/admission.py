@@ -0,0 +1,239 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Admission control that bounds the concurrent calls to each upstream service."""
+
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Iterator
+
+from langchain_core.embeddings import Embeddings
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from .metrics import IN_FLIGHT, QUEUE_SECONDS, REJECTED
+
+# the langserve endpoints that run the chain
+_CHAIN_ENDPOINTS = ("/invoke", "/batch", "/stream", "/stream_log", "/stream_events")
+
+
+class Overloaded(Exception):
+    """The queue of an upstream service is full, or a request waited too long in it."""
+
+    def __init__(self, upstream: str, retry_after: int) -> None:
+        """Initialize the exception."""
+        super().__init__(f"The {upstream} service is overloaded, retry after {retry_after} seconds.")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+# pylint: disable-next=too-many-instance-attributes # the limits and the queue state
+class UpstreamLimiter:
+    """A first come, first served limit on the concurrent calls to an upstream service.
+
+    Calls that find every slot taken wait in a bounded queue. A call is rejected with `Overloaded` when the queue is
+    full or when it has waited longer than `max_wait`. Slots can be taken from the event loop and from worker threads,
+    since the NVIDIA and Milvus clients make their blocking calls on the server's thread pool.
+    """
+
+    def __init__(self, name: str, max_concurrent: int, max_queued: int, max_wait: float) -> None:
+        """Initialize the limiter."""
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiters: deque[Any] = deque()
+        # a moving average of how long calls hold a slot, used to suggest when to retry
+        self._hold_time = 1.0
+
+    @property
+    def saturated(self) -> bool:
+        """Whether new calls would be rejected."""
+        return self._active >= self.max_concurrent and len(self._waiters) >= self.max_queued
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Report the limiter's use."""
+        return {"active": self._active, "queued": len(self._waiters), "limit": self.max_concurrent}
+
+    @property
+    def retry_after(self) -> int:
+        """Estimate the seconds until the queue has drained."""
+        rounds = (len(self._waiters) + 1) / self.max_concurrent
+        return max(1, math.ceil(rounds * self._hold_time))
+
+    def reject(self) -> Overloaded:
+        """Count and build a rejection."""
+        REJECTED.labels(upstream=self.name).inc()
+        return Overloaded(self.name, self.retry_after)
+
+    def _enter(self, waiter: Any) -> bool:
+        """Take a slot right away, or queue the waiter. Return whether a slot was taken."""
+        with self._lock:
+            if self._active < self.max_concurrent and not self._waiters:
+                self._active += 1
+                return True
+            if len(self._waiters) >= self.max_queued:
+                raise self.reject()
+            self._waiters.append(waiter)
+            return False
+
+    def _abandon(self, waiter: Any) -> bool:
+        """Remove a waiter that gave up. Return False when it was handed a slot in the meantime."""
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                return True
+            return False
+
+    def _release(self, held: float) -> None:
+        """Hand the slot to the next waiter, or free it."""
+        with self._lock:
+            self._hold_time = 0.9 * self._hold_time + 0.1 * held
+            if not self._waiters:
+                self._active -= 1
+                return
+            waiter = self._waiters.popleft()
+        if isinstance(waiter, threading.Event):
+            waiter.set()
+        else:
+            loop, future = waiter
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+    def _observe(self, start: float) -> float:
+        """Record the time spent queued and return when the slot was taken."""
+        now = time.perf_counter()
+        QUEUE_SECONDS.labels(upstream=self.name).observe(now - start)
+        return now
+
+    @contextmanager
+    def _hold(self, acquired: float) -> Iterator[None]:
+        """Hold a slot until the caller is done with it."""
+        IN_FLIGHT.labels(upstream=self.name).inc()
+        try:
+            yield
+        finally:
+            IN_FLIGHT.labels(upstream=self.name).dec()
+            self._release(time.perf_counter() - acquired)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Wait for a slot on the event loop."""
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        waiter = (asyncio.get_running_loop(), future)
+        if not self._enter(waiter):
+            try:
+                await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+            except asyncio.TimeoutError as err:
+                if self._abandon(waiter):
+                    raise self.reject() from err
+            except asyncio.CancelledError:
+                if not self._abandon(waiter):
+                    self._release(0)
+                raise
+        with self._hold(self._observe(start)):
+            yield
+
+    @contextmanager
+    def thread_slot(self) -> Iterator[None]:
+        """Wait for a slot on a worker thread."""
+        start = time.perf_counter()
+        waiter = threading.Event()
+        if not self._enter(waiter) and not waiter.wait(self.max_wait) and self._abandon(waiter):
+            raise self.reject()
+        with self._hold(self._observe(start)):
+            yield
+
+
+class Upstreams:
+    """The limiters of every upstream service the chain calls."""
+
+    def __init__(self, limits: dict[str, int], max_queued: int, max_wait: float) -> None:
+        """Create a limiter for each upstream."""
+        self.limiters = {
+            name: UpstreamLimiter(name, max_concurrent, max_queued, max_wait) for name, max_concurrent in limits.items()
+        }
+
+    def __getitem__(self, name: str) -> UpstreamLimiter:
+        """Get the limiter of an upstream."""
+        return self.limiters[name]
+
+    def saturated(self) -> list[UpstreamLimiter]:
+        """List the limiters that would reject new calls."""
+        return [limiter for limiter in self.limiters.values() if limiter.saturated]
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        """Report the use of each limiter."""
+        return {name: limiter.stats for name, limiter in self.limiters.items()}
+
+
+class LimitedEmbeddings(Embeddings):
+    """Hold an embedding slot during every query embedding."""
+
+    def __init__(self, embeddings: Embeddings, limiter: UpstreamLimiter) -> None:
+        """Initialize the wrapper."""
+        self.embeddings = embeddings
+        self._limiter = limiter
+
+    def embed_query(self, text: str) -> list[float]:
+        """Embed a query."""
+        with self._limiter.thread_slot():
+            return self.embeddings.embed_query(text)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        """Embed a query."""
+        async with self._limiter.slot():
+            return await self.embeddings.aembed_query(text)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """Embed documents for storage."""
+        return self.embeddings.embed_documents(texts)
+
+
+def overloaded_response(err: Overloaded, status_code: int) -> JSONResponse:
+    """Build the response that tells a client to back off."""
+    return JSONResponse(
+        {"status_code": status_code, "message": str(err)},
+        status_code=status_code,
+        headers={"Retry-After": str(err.retry_after)},
+    )
+
+
+# pylint: disable-next=too-few-public-methods # interface defined by starlette
+class AdmissionMiddleware:
+    """A starlette middleware that turns away chain requests while an upstream's queue is full."""
+
+    def __init__(self, app: ASGIApp, upstreams: Upstreams) -> None:
+        """Initialize the middleware."""
+        self.app = app
+        self.upstreams = upstreams
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Reject the request with a 429 when it would only add to a full queue."""
+        if scope["type"] == "http" and scope["path"].endswith(_CHAIN_ENDPOINTS):
+            saturated = self.upstreams.saturated()
+            if saturated:
+                err = saturated[0].reject()
+                await overloaded_response(err, 429)(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
@@ -0,0 +1,159 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Dynamic batching of model requests from concurrent sessions."""
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+from langchain_core.embeddings import Embeddings
+from langchain_nvidia_ai_endpoints import NVIDIAEmbeddings
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def nvidia_query_embedder(model: NVIDIAEmbeddings) -> Callable[[list[str]], list[list[float]]]:
+    """Embed a batch of texts as queries.
+
+    `NVIDIAEmbeddings.embed_documents` embeds texts as passages, which produces different vectors on asymmetric models
+    like nv-embedqa-e5-v5, so batches of queries are sent through the model's query path directly.
+    """
+
+    def _embed_queries(texts: list[str]) -> list[list[float]]:
+        # pylint: disable-next=protected-access # the query input type is only exposed through the private method
+        return model._embed(texts, model_type="query")
+
+    return _embed_queries
+
+
+# pylint: disable-next=too-many-instance-attributes # batching state is shared by the callers and the dispatcher
+class BatchedEmbeddings(Embeddings):
+    """Query embeddings that are combined into batches across concurrent callers.
+
+    Queries are collected by a dispatcher thread. A batch is sent as soon as it is full or when the oldest query has
+    waited `max_wait` seconds. Batches are sent from a small thread pool, so the next batch is collected while the
+    previous one is in flight. Every caller gets its own vector back, identical queries in a batch are embedded once.
+    Document embeddings are not batched and always go to the wrapped model.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        embed_queries: Callable[[list[str]], list[list[float]]],
+        max_batch_size: int,
+        max_wait: float,
+        max_concurrent_batches: int,
+    ) -> None:
+        """Initialize the batcher. The dispatcher thread is started by the first query."""
+        self.embeddings = embeddings
+        self._embed_queries = embed_queries
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        # a None in the queue stops the dispatcher
+        self._queue: queue.SimpleQueue[tuple[str, Future[list[float]]] | None] = queue.SimpleQueue()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_batches, thread_name_prefix="embedding-batch")
+        self._dispatcher: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self._counts = {"batches": 0, "queries": 0}
+
+    def __getattr__(self, name: str) -> Any:
+        """Expose the wrapped model's attributes, like its name."""
+        if name == "embeddings":
+            raise AttributeError(name)
+        return getattr(self.embeddings, name)
+
+    # %% dispatching
+    def _submit(self, text: str) -> Future[list[float]]:
+        """Queue a query for the next batch."""
+        future: Future[list[float]] = Future()
+        self._queue.put((text, future))
+        with self._lock:
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, name="embedding-dispatch", daemon=True)
+                self._dispatcher.start()
+        return future
+
+    def _dispatch(self) -> None:
+        """Collect queries into batches until the batcher is closed."""
+        closed = False
+        while not closed:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self._max_wait
+            while len(batch) < self._max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    closed = True
+                    break
+                batch.append(item)
+            self._executor.submit(self._run, batch)
+        self._executor.shutdown(wait=False)
+
+    def close(self) -> None:
+        """Stop the dispatcher thread once the queued queries are sent."""
+        with self._lock:
+            if self._dispatcher is None:
+                self._executor.shutdown(wait=False)
+                return
+        self._queue.put(None)
+
+    def _run(self, batch: list[tuple[str, Future[list[float]]]]) -> None:
+        """Embed a batch and hand every caller its vector."""
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        with self._lock:
+            self._counts["batches"] += 1
+            self._counts["queries"] += len(batch)
+        try:
+            vectors = dict(zip(texts, self._embed_queries(texts)))
+        except Exception as err:  # pylint: disable=broad-exception-caught # the error is raised to every caller
+            _LOGGER.debug("An embedding batch of %d queries failed.", len(texts))
+            for _, future in batch:
+                future.set_exception(err)
+            return
+        for text, future in batch:
+            future.set_result(list(vectors[text]))
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        """Report how many queries were sent in how many batches."""
+        with self._lock:
+            batches, queries = self._counts["batches"], self._counts["queries"]
+        return {"batches": batches, "queries": queries, "mean_batch_size": queries / batches if batches else 0.0}
+
+    # %% embeddings interface
+    def embed_query(self, text: str) -> list[float]:
+        """Embed a query as part of the next batch."""
+        return self._submit(text).result()
+
+    async def aembed_query(self, text: str) -> list[float]:
+        """Embed a query as part of the next batch without blocking the event loop."""
+        return await asyncio.wrap_future(self._submit(text))
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """Embed documents with the wrapped model."""
+        return self.embeddings.embed_documents(texts)
@@ -0,0 +1,210 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Answer a file of questions with the RAG chain, in process and with bounded concurrency.
+
+Questions are read from a JSONL file with one object per line. Every object needs a `question` and may set an `id`,
+`use_kb` and `use_reranker`. Lines without an `id` are identified by their line number. Answers are appended to a
+JSONL file as they complete, with the retrieved context and the seconds spent in each stage of the chain. Questions
+that already have an answer in the output file are skipped, so an interrupted run continues where it stopped.
+
+```bash
+cd code
+python -m chain_server.bulk questions.jsonl answers.jsonl --concurrency 16 --use-kb --use-reranker
+```
+
+Name the output `*.parquet` to also convert the answers to Parquet once the run completes. This needs `pyarrow`.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Iterator
+
+from . import metrics
+from .chain import answer_generation, connect, http_pool, redis_pools, retrieve_context  # type: ignore
+from .configuration import config as app_config
+
+
+def report(message: str) -> None:
+    """Report the progress of the run on stderr, so it shows regardless of the log level."""
+    # pylint: disable-next=bad-builtin # the only place the CLI writes to the terminal
+    print(message, file=sys.stderr)
+
+
+def read_questions(path: Path, use_kb: bool, use_reranker: bool) -> Iterator[dict[str, Any]]:
+    """Load the questions, filling in the default retrieval settings."""
+    with open(path, "r", encoding="UTF-8") as questions_file:
+        for line_number, line in enumerate(questions_file, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield {
+                "id": str(record.get("id", line_number)),
+                "question": record["question"],
+                "use_kb": bool(record.get("use_kb", use_kb)),
+                "use_reranker": bool(record.get("use_reranker", use_reranker)),
+            }
+
+
+def answered_ids(path: Path) -> set[str]:
+    """Find the questions that were answered by a previous run."""
+    if not path.exists():
+        return set()
+    done = set()
+    with open(path, "r", encoding="UTF-8") as answers_file:
+        for line in answers_file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of an interrupted run may be incomplete
+                continue
+            if "answer" in record:
+                done.add(record["id"])
+    return done
+
+
+async def answer(question: dict[str, Any]) -> dict[str, Any]:
+    """Run the chain for a single question and record what it did."""
+    timings = metrics.start_request(question["use_kb"], question["use_reranker"])
+    start = time.perf_counter()
+    msg = {**question, "history": []}
+    try:
+        context = await retrieve_context.ainvoke(msg)
+        chunks = [chunk.content async for chunk in answer_generation.astream({**msg, "context": context})]
+    except Exception as err:  # pylint: disable=broad-exception-caught # recorded and retried on the next run
+        return {**question, "error": f"{type(err).__name__}: {err}", "timings": timings}
+    return {
+        **question,
+        "answer": "".join(chunks),
+        "context": context,
+        "latency": time.perf_counter() - start,
+        "timings": timings,
+    }
+
+
+class Progress:
+    """Report the throughput of the run."""
+
+    def __init__(self, total: int, interval: float = 5.0) -> None:
+        """Start the clock."""
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self._interval = interval
+        self._start = self._last_report = time.perf_counter()
+
+    @property
+    def throughput(self) -> float:
+        """The questions answered per second."""
+        return self.done / max(time.perf_counter() - self._start, 1e-9)
+
+    def update(self, record: dict[str, Any]) -> None:
+        """Count a finished question and report periodically."""
+        self.done += 1
+        self.failed += "error" in record
+        now = time.perf_counter()
+        if now - self._last_report >= self._interval or self.done == self.total:
+            self._last_report = now
+            remaining = (self.total - self.done) / self.throughput if self.throughput else float("inf")
+            report(
+                f"{self.done}/{self.total} answered, {self.failed} failed, "
+                f"{self.throughput:.2f} questions/s, {remaining:.0f}s remaining"
+            )
+
+
+async def run(questions: list[dict[str, Any]], output: Path, concurrency: int) -> Progress:
+    """Answer the questions and append the results to the output as they complete."""
+    progress = Progress(len(questions))
+    queue: asyncio.Queue[dict[str, Any]] = asyncio.Queue()
+    for question in questions:
+        queue.put_nowait(question)
+
+    with open(output, "a", encoding="UTF-8") as answers_file:
+
+        async def _worker() -> None:
+            while not queue.empty():
+                record = await answer(queue.get_nowait())
+                answers_file.write(json.dumps(record) + "\n")
+                answers_file.flush()
+                progress.update(record)
+
+        await asyncio.gather(*(_worker() for _ in range(concurrency)))
+    return progress
+
+
+def to_parquet(answers: Path, output: Path) -> None:
+    """Convert the JSONL answers to a Parquet file, keeping the last answer to every question."""
+    # pylint: disable-next=import-outside-toplevel # optional dependency, only needed for Parquet output
+    import pyarrow as pa
+    import pyarrow.parquet as pq  # pylint: disable=import-outside-toplevel
+
+    records: dict[str, dict[str, Any]] = {}
+    with open(answers, "r", encoding="UTF-8") as answers_file:
+        for line in answers_file:
+            record = json.loads(line)
+            if "answer" in record or record["id"] not in records:
+                records[record["id"]] = {**record, "timings": json.dumps(record.get("timings", {}))}
+    pq.write_table(pa.Table.from_pylist(list(records.values())), output)
+
+
+def _parse_arguments() -> argparse.Namespace:
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser("python -m chain_server.bulk", description="Answer a file of questions.")
+    parser.add_argument("questions", type=Path, help="The JSONL file of questions.")
+    parser.add_argument("output", type=Path, help="The JSONL or Parquet file to write the answers to.")
+    parser.add_argument("--concurrency", type=int, default=8, help="The number of questions answered at once.")
+    parser.add_argument(
+        "--use-kb", action="store_true", default=False, help="Retrieve context from the knowledge base."
+    )
+    parser.add_argument("--use-reranker", action="store_true", default=False, help="Rerank the retrieved context.")
+    return parser.parse_args()
+
+
+async def _main(args: argparse.Namespace) -> None:
+    """Answer the questions that are still unanswered."""
+    answers = args.output.with_suffix(".jsonl") if args.output.suffix == ".parquet" else args.output
+    done = answered_ids(answers)
+    questions = [q for q in read_questions(args.questions, args.use_kb, args.use_reranker) if q["id"] not in done]
+    report(f"{len(done)} questions already answered, {len(questions)} to go")
+
+    # the model clients make blocking calls on the default executor, size it like the server does
+    executor = ThreadPoolExecutor(max_workers=app_config.worker_threads, thread_name_prefix="chain-worker")
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(executor)
+    try:
+        await loop.run_in_executor(None, connect)
+        progress = await run(questions, answers, args.concurrency)
+    finally:
+        await redis_pools.aclose()
+        http_pool.close()
+        executor.shutdown(wait=False, cancel_futures=True)
+    report(f"Answered {progress.done} questions at {progress.throughput:.2f} questions/s")
+
+    if args.output.suffix == ".parquet":
+        to_parquet(answers, args.output)
+
+
+def main() -> None:
+    """Run the bulk question answering CLI."""
+    asyncio.run(_main(_parse_arguments()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Caches that let the chain skip repeated work."""
+
+import asyncio
+import hashlib
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, AsyncIterator, cast
+
+import numpy as np
+import redis
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from .filters import RetrievalFilter
+
+_LOGGER = logging.getLogger(__name__)
+_KEY_PREFIX = "nim-anywhere"
+_TOKEN_RE = re.compile(r"\s*\S+|\s+")
+
+
+def collection_version_key(collection_name: str) -> str:
+    """Return the Redis key that counts changes to a vector store collection."""
+    return f"{_KEY_PREFIX}:collection-version:{collection_name}"
+
+
+def _normalize(vector: list[float]) -> np.ndarray:
+    """Convert an embedding to a unit length float32 vector."""
+    arr = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(arr)
+    return arr / norm if norm else arr
+
+
+# pylint: disable-next=too-many-instance-attributes # the limits and the in process mirrors
+class SemanticAnswerCache:
+    """A Redis backed cache of answers, looked up by the similarity of the question embeddings.
+
+    Entries are grouped into scopes. A scope holds the answers that the same LLM generated with the same retrieval
+    settings against the same version of the knowledge base, looked up with the same embedding model. Every scope keeps
+    the vectors of its questions in a hash, the answers in keys that expire after the TTL, and the last access time of
+    every entry in a sorted set that is used for LRU eviction. The vectors of the `max_mirrors` most recently used
+    scopes are mirrored in process and only reloaded when the scope's generation counter changes. Mirrors of older
+    versions of the knowledge base are dropped as soon as a newer version is seen.
+
+    The cache is best effort. When Redis is unavailable, every lookup is a miss and nothing is stored.
+    """
+
+    # pylint: disable-next=too-many-arguments # the models and limits are set once per set of clients
+    def __init__(
+        self,
+        client: Redis,
+        collection_name: str,
+        similarity_threshold: float,
+        ttl: int,
+        max_entries: int,
+        *,
+        max_mirrors: int = 16,
+        llm_model: str,
+        embedding_model: str,
+    ) -> None:
+        """Initialize the cache."""
+        self._client = client
+        self._collection_name = collection_name
+        # answers of another LLM, or question vectors of another embedding space, must never be replayed
+        self._models = f"llm={llm_model}:embedding={embedding_model}"
+        self._similarity_threshold = similarity_threshold
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._max_mirrors = max_mirrors
+        self._mirrors: OrderedDict[str, tuple[bytes | None, list[str], np.ndarray]] = OrderedDict()
+
+    # %% key management
+    async def scope(
+        self, use_kb: bool, use_reranker: bool, retrieval_filter: RetrievalFilter | None = None
+    ) -> str | None:
+        """Determine the cache scope for a set of retrieval settings."""
+        if not use_kb:
+            return f"llm:{self._models}"
+        try:
+            version = await self._client.get(collection_version_key(self._collection_name))
+        except RedisError as err:
+            _LOGGER.warning("The answer cache is unavailable: %s", err)
+            return None
+        kb = f"kb:{self._collection_name}:"
+        current = f"{kb}{int(version or 0)}:"
+        for stale in [name for name in self._mirrors if name.startswith(kb) and not name.startswith(current)]:
+            del self._mirrors[stale]
+        scope = f"{current}rerank={int(use_reranker)}:{self._models}"
+        return f"{scope}:filter={retrieval_filter.key}" if retrieval_filter else scope
+
+    @staticmethod
+    def _key(scope: str, kind: str) -> str:
+        """Build the Redis key for one of a scope's data structures."""
+        return f"{_KEY_PREFIX}:answer-cache:{scope}:{kind}"
+
+    @staticmethod
+    def _entry_id(question: str) -> str:
+        """Identify an entry by its normalized question so repeated stores overwrite each other."""
+        return hashlib.sha256(" ".join(question.lower().split()).encode("UTF-8")).hexdigest()[:32]
+
+    # %% lookups
+    async def _vectors(self, scope: str) -> tuple[list[str], np.ndarray]:
+        """Load the question vectors of a scope, reusing the in process mirror when it is current."""
+        generation = await self._client.get(self._key(scope, "generation"))
+        mirror = self._mirrors.get(scope)
+        if mirror is not None and mirror[0] == generation:
+            self._mirrors.move_to_end(scope)
+            return mirror[1], mirror[2]
+
+        raw = await self._client.hgetall(self._key(scope, "vectors"))
+        ids = [entry_id.decode("UTF-8") for entry_id in raw]
+        matrix = (
+            np.vstack([np.frombuffer(vector, dtype=np.float32) for vector in raw.values()])
+            if raw
+            else np.empty((0, 0), dtype=np.float32)
+        )
+        self._mirrors[scope] = (generation, ids, matrix)
+        self._mirrors.move_to_end(scope)
+        while len(self._mirrors) > self._max_mirrors:
+            self._mirrors.popitem(last=False)
+        return ids, matrix
+
+    async def lookup(self, embedding: list[float], scope: str | None) -> str | None:
+        """Find the cached answer to the most similar question, if it is similar enough."""
+        if scope is None:
+            return None
+        try:
+            return await self._lookup(embedding, scope)
+        except RedisError as err:
+            _LOGGER.warning("The answer cache is unavailable: %s", err)
+            return None
+        except ValueError as err:
+            # vectors of different sizes, stored by an earlier embedding model, can not be compared
+            _LOGGER.warning("Skipping the answer cache scope %s, its vectors do not match: %s", scope, err)
+            return None
+
+    async def _lookup(self, embedding: list[float], scope: str) -> str | None:
+        """Search a scope for a similar question."""
+        ids, matrix = await self._vectors(scope)
+        query = _normalize(embedding)
+        if not ids or matrix.shape[1] != query.shape[0]:
+            return None
+
+        scores = matrix @ query
+        best = int(np.argmax(scores))
+        if scores[best] < self._similarity_threshold:
+            return None
+
+        entry_id = ids[best]
+        answer = await self._client.get(self._key(scope, f"answer:{entry_id}"))
+        if answer is None:
+            # the answer expired, forget about the question too
+            await self._publish(scope, [entry_id])
+            return None
+
+        await self._client.zadd(self._key(scope, "lru"), {entry_id: time.time()})
+        _LOGGER.debug("Answer cache hit in %s with a similarity of %.3f.", scope, scores[best])
+        return str(answer.decode("UTF-8"))
+
+    # %% updates
+    async def store(self, question: str, embedding: list[float], scope: str | None, answer: str) -> None:
+        """Add an answer to the cache and evict any expired or least recently used entries."""
+        if scope is None or not answer:
+            return
+        try:
+            await self._store(question, embedding, scope, answer)
+        except RedisError as err:
+            _LOGGER.warning("The answer cache is unavailable: %s", err)
+
+    async def _store(self, question: str, embedding: list[float], scope: str, answer: str) -> None:
+        """Write an entry to a scope."""
+        entry_id = self._entry_id(question)
+        now = time.time()
+        lru_key = self._key(scope, "lru")
+
+        async with self._client.pipeline(transaction=False) as pipe:
+            pipe.set(self._key(scope, f"answer:{entry_id}"), answer.encode("UTF-8"), ex=self._ttl)
+            pipe.hset(self._key(scope, "vectors"), mapping={entry_id: _normalize(embedding).tobytes()})
+            pipe.zadd(lru_key, {entry_id: now})
+            pipe.zrangebyscore(lru_key, 0, now - self._ttl)
+            pipe.zcard(lru_key)
+            results = await pipe.execute()
+
+        stale = [entry.decode("UTF-8") for entry in results[3]]
+        overflow = results[4] - len(stale) - self._max_entries
+        if overflow > 0:
+            oldest = await self._client.zrange(lru_key, 0, overflow + len(stale) - 1)
+            stale = list(dict.fromkeys(stale + [entry.decode("UTF-8") for entry in oldest]))
+        await self._publish(scope, stale)
+
+    async def _publish(self, scope: str, entry_ids: list[str]) -> None:
+        """Drop entries from a scope and bump its generation so every worker reloads the vectors."""
+        async with self._client.pipeline(transaction=False) as pipe:
+            if entry_ids:
+                pipe.zrem(self._key(scope, "lru"), *entry_ids)
+                pipe.hdel(self._key(scope, "vectors"), *entry_ids)
+                pipe.delete(*[self._key(scope, f"answer:{entry_id}") for entry_id in entry_ids])
+            pipe.incr(self._key(scope, "generation"))
+            # scopes that are no longer used, like old knowledge base versions, expire on their own
+            for kind in ("lru", "vectors", "generation"):
+                pipe.expire(self._key(scope, kind), self._ttl)
+            await pipe.execute()
+
+
+class CondensedQuestionCache:
+    """A short lived Redis cache of standalone questions condensed from a chat history.
+
+    Entries are keyed by a digest of the history, the follow up question and the model that condensed it, so retries
+    and duplicate submissions in the same session skip the condensing LLM call.
+    """
+
+    def __init__(self, client: Redis, model: str, ttl: int) -> None:
+        """Initialize the cache."""
+        self._client = client
+        self._model = model
+        self._ttl = ttl
+
+    def _key(self, history: list[BaseMessage], question: str) -> str:
+        """Build the cache key for a question asked after a chat history."""
+        digest = hashlib.sha256(self._model.encode("UTF-8"))
+        for message in history:
+            digest.update(f"\0{message.type}\0{message.content}".encode("UTF-8"))
+        digest.update(f"\0\0{question}".encode("UTF-8"))
+        return f"{_KEY_PREFIX}:condensed-question:{digest.hexdigest()}"
+
+    async def get(self, history: list[BaseMessage], question: str) -> str | None:
+        """Look up a previously condensed question."""
+        try:
+            condensed = await self._client.get(self._key(history, question))
+        except RedisError as err:
+            _LOGGER.warning("The condensed question cache is unavailable: %s", err)
+            return None
+        return None if condensed is None else str(condensed.decode("UTF-8"))
+
+    async def set(self, history: list[BaseMessage], question: str, condensed: str) -> None:
+        """Remember a condensed question."""
+        try:
+            await self._client.set(self._key(history, question), condensed.encode("UTF-8"), ex=self._ttl)
+        except RedisError as err:
+            _LOGGER.warning("The condensed question cache is unavailable: %s", err)
+
+
+async def replay(answer: str) -> AsyncIterator[AIMessageChunk]:
+    """Stream a cached answer back in the same word sized chunks a model would produce."""
+    for token in _TOKEN_RE.findall(answer):
+        yield AIMessageChunk(content=token)
+
+
+class CachedEmbeddings(Embeddings):
+    """Query embeddings with an in process LRU cache backed by a shared Redis cache.
+
+    Queries are keyed by the wrapped model's name and truncation mode and by the whitespace normalized text. Document
+    embeddings are not cached and always go to the wrapped model.
+    """
+
+    def __init__(self, embeddings: Embeddings, client: redis.Redis, max_size: int, ttl: int) -> None:
+        """Initialize the cache."""
+        self.embeddings = embeddings
+        self._client = client
+        self._max_size = max_size
+        self._ttl = ttl
+        self._memory: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = {"memory_hits": 0, "redis_hits": 0, "misses": 0}
+
+    def _key(self, text: str) -> str:
+        """Build the cache key for a query."""
+        model = getattr(self.embeddings, "model", type(self.embeddings).__name__)
+        truncate = getattr(self.embeddings, "truncate", "")
+        normalized = " ".join(unicodedata.normalize("NFC", text).split())
+        digest = hashlib.sha256(normalized.encode("UTF-8")).hexdigest()
+        return f"{_KEY_PREFIX}:embedding:{model}:{truncate}:query:{digest}"
+
+    def _count(self, counter: str) -> None:
+        """Increment one of the hit counters."""
+        with self._lock:
+            self._counts[counter] += 1
+
+    def _from_memory(self, key: str) -> list[float] | None:
+        """Read a vector from the in process tier."""
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is None:
+                return None
+            self._memory.move_to_end(key)
+            self._counts["memory_hits"] += 1
+            return list(vector)
+
+    def _to_memory(self, key: str, vector: list[float]) -> None:
+        """Write a vector to the in process tier, evicting the least recently used vectors."""
+        with self._lock:
+            self._memory[key] = list(vector)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self._max_size:
+                self._memory.popitem(last=False)
+
+    def _from_redis(self, key: str) -> list[float] | None:
+        """Read a vector from the shared tier."""
+        try:
+            raw = cast(bytes | None, self._client.get(key))
+        except RedisError as err:
+            _LOGGER.warning("The embedding cache is unavailable: %s", err)
+            return None
+        if raw is None:
+            return None
+        self._count("redis_hits")
+        return list(np.frombuffer(raw, dtype=np.float32).tolist())
+
+    def _to_redis(self, key: str, vector: list[float]) -> None:
+        """Write a vector to the shared tier."""
+        try:
+            self._client.set(key, np.asarray(vector, dtype=np.float32).tobytes(), ex=self._ttl)
+        except RedisError as err:
+            _LOGGER.warning("The embedding cache is unavailable: %s", err)
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        """Report the cache's hit counters and hit rate."""
+        with self._lock:
+            counts = dict(self._counts)
+            size = len(self._memory)
+        lookups = sum(counts.values())
+        hits = counts["memory_hits"] + counts["redis_hits"]
+        return {**counts, "lookups": lookups, "hit_rate": hits / lookups if lookups else 0.0, "memory_size": size}
+
+    def embed_query(self, text: str) -> list[float]:
+        """Embed a query, using a cached vector when one is available."""
+        key = self._key(text)
+        vector = self._from_memory(key) or self._from_redis(key)
+        if vector is None:
+            self._count("misses")
+            vector = self.embeddings.embed_query(text)
+            self._to_redis(key, vector)
+        self._to_memory(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> list[float]:
+        """Embed a query, answering from the in process tier without leaving the event loop.
+
+        The shared tier is read on the thread pool, and misses are embedded through the wrapped model's asyncio
+        interface, so they join the query batches without holding a thread while they wait.
+        """
+        key = self._key(text)
+        vector = self._from_memory(key)
+        if vector is not None:
+            return vector
+        loop = asyncio.get_running_loop()
+        vector = await loop.run_in_executor(None, self._from_redis, key)
+        if vector is None:
+            self._count("misses")
+            vector = await self.embeddings.aembed_query(text)
+            # the write does not delay the answer, its errors are logged by _to_redis
+            loop.run_in_executor(None, self._to_redis, key, vector)
+        self._to_memory(key, vector)
+        return vector
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """Embed documents with the wrapped model."""
+        return self.embeddings.embed_documents(texts)
@@ -16,66 +16,291 @@
 
 """This module defines the application's chain."""
 
+import asyncio
+import logging
+import math
+import os
+from contextvars import ContextVar
 from operator import itemgetter
+from typing import Any, Optional
 
-from langchain.retrievers import ContextualCompressionRetriever
-from langchain_community.chat_message_histories import RedisChatMessageHistory
 from langchain_core.documents import Document
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough, chain
 from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_milvus.vectorstores.milvus import Milvus
 from langchain_nvidia_ai_endpoints import ChatNVIDIA, NVIDIAEmbeddings, NVIDIARerank
 from pydantic import BaseModel
 
-from . import prompts
+from . import metrics, prompts
+from .admission import LimitedEmbeddings, Upstreams
+from .batching import BatchedEmbeddings, nvidia_query_embedder
+from .cache import CachedEmbeddings, CondensedQuestionCache, SemanticAnswerCache, replay
+from .configuration import WORKERS_ENV_VAR, Configuration, restart_required
 from .configuration import config as app_config
+from .condense import is_standalone
+from .filters import RetrievalFilter, UnsupportedFilter
+from .connections import HTTPPool, RedisPools
+from .history import BoundedChatMessageHistory, RedisMessageStore
+from .hybrid import HybridRetriever, SparseIndex, backfill_sparse_index
+from .packing import pack_documents
+from .reload import HotSwap, watch_config
+from .reranking import RerankService, nvidia_passage_scorer
+from .streaming import coalesce
+from .vector_stores import connect_vector_store, create_scalar_indexes, search_kwargs
 
-# %% unstructured data retrieval components
-embedding_model = NVIDIAEmbeddings(
-    model=app_config.embedding_model.name,
-    base_url=str(app_config.embedding_model.url),
-    api_key=app_config.nvidia_api_key,
-    truncate="END",
+_LOGGER = logging.getLogger(__name__)
+
+# %% shared connections, these are closed by the server's lifespan
+# the pools connect lazily, so every pre-forked worker process opens its own connections
+redis_pools = RedisPools(
+    str(app_config.redis_dsn),
+    max_connections=app_config.redis_pool.max_connections,
+    timeout=app_config.redis_pool.timeout,
+    socket_timeout=app_config.redis_pool.socket_timeout,
 )
-vector_store = Milvus(
-    embedding_function=embedding_model,
-    connection_args={"uri": app_config.milvus.url},
-    collection_name=app_config.milvus.collection_name,
-    auto_id=True,
+http_pool = HTTPPool(
+    max_connections=app_config.http_pool.max_connections,
+    connect_timeout=app_config.http_pool.connect_timeout,
+    read_timeout=app_config.http_pool.read_timeout,
+    health_check_interval=app_config.http_pool.health_check_interval,
+    eject_seconds=app_config.http_pool.eject_seconds,
 )
-retriever = vector_store.as_retriever()
 
-reranker = NVIDIARerank(
-    model=app_config.reranking_model.name,
-    base_url=str(app_config.reranking_model.url),
-    api_key=app_config.nvidia_api_key,
-    truncate="END",
+
+def _per_worker(limit: int) -> int:
+    """Split a limit between the worker processes the supervisor started, if it started this one."""
+    return max(math.ceil(limit / int(os.environ.get(WORKERS_ENV_VAR, "1"))), 1)
+
+
+upstreams = Upstreams(
+    {
+        "llm": _per_worker(app_config.admission.llm_concurrency),
+        "embedding": _per_worker(app_config.admission.embedding_concurrency),
+        "reranking": _per_worker(app_config.admission.reranking_concurrency),
+        "vector_store": _per_worker(app_config.admission.vector_store_concurrency),
+    },
+    max_queued=_per_worker(app_config.admission.max_queued),
+    max_wait=app_config.admission.max_queue_wait,
 )
-reranking_retriever = ContextualCompressionRetriever(base_compressor=reranker, base_retriever=retriever)
 
 
-def format_docs(docs: list[Document]) -> str:
-    """Take in a list of docs and concatenate the content, separating by newlines."""
-    return "\n\n".join(doc.page_content for doc in docs)
+# %% the clients that are rebuilt when the configuration changes
+# pylint: disable-next=too-many-instance-attributes # one attribute for every client of the chain
+class ChainClients:
+    """The model, vector store and cache clients built from one version of the configuration.
 
+    The connection pools and upstream limits above are shared by every version.
+    """
 
-# %% language model components
-llm = ChatNVIDIA(
-    model=app_config.llm_model.name,
-    curr_mode="nim",
-    base_url=str(app_config.llm_model.url),
-    api_key=app_config.nvidia_api_key,
-)
+    def __init__(self, config: Configuration) -> None:
+        """Connect every client the configuration describes."""
+        self.config = config
+
+        # unstructured data retrieval components
+        nvidia_embeddings = http_pool.attach(
+            NVIDIAEmbeddings(
+                model=config.embedding_model.name,
+                base_url=str(config.embedding_model.url),
+                api_key=config.nvidia_api_key,
+                truncate="END",
+            ),
+            replicas=[str(url) for url in config.embedding_model.replicas],
+            hedge_after=config.embedding_model.hedge_after,
+        )
+        embedding_model = nvidia_embeddings
+        self.batcher = None
+        if config.embedding_batching.enabled:
+            embedding_model = self.batcher = BatchedEmbeddings(
+                embedding_model,
+                nvidia_query_embedder(nvidia_embeddings),
+                max_batch_size=min(config.embedding_batching.max_batch_size, nvidia_embeddings.max_batch_size),
+                max_wait=config.embedding_batching.max_wait_ms / 1000,
+                max_concurrent_batches=config.embedding_batching.max_concurrent_batches,
+            )
+        if config.embedding_cache.enabled:
+            embedding_model = CachedEmbeddings(
+                embedding_model,
+                redis_pools.client,
+                max_size=config.embedding_cache.max_size,
+                ttl=config.embedding_cache.ttl,
+            )
+        self.embedding_model = metrics.TimedEmbeddings(LimitedEmbeddings(embedding_model, upstreams["embedding"]))
+        self.vector_store = connect_vector_store(config, self.embedding_model)
+        create_scalar_indexes(self.vector_store)
+        self.retriever = self.vector_store.as_retriever(search_kwargs={"k": config.milvus.top_k})
+        self.sparse_index = SparseIndex(
+            config.milvus.collection_name,
+            redis_pools.client,
+            redis_pools.async_client,
+            max_postings=config.milvus.keyword_postings,
+        )
+        if config.milvus.hybrid_search:
+            self.retriever = HybridRetriever(dense=self.retriever, sparse=self.sparse_index, k=config.milvus.top_k)
+            backfill_sparse_index(self.vector_store, self.sparse_index)
+
+        self.reranker = http_pool.attach(
+            NVIDIARerank(
+                model=config.reranking_model.name,
+                base_url=str(config.reranking_model.url),
+                api_key=config.nvidia_api_key,
+                truncate="END",
+            ),
+            replicas=[str(url) for url in config.reranking_model.replicas],
+            hedge_after=config.reranking_model.hedge_after,
+        )
+        if config.reranking.enabled:
+            self.reranker = RerankService(
+                scorer=nvidia_passage_scorer(self.reranker),
+                model=self.reranker.model,
+                top_n=self.reranker.top_n,
+                client=redis_pools.client,
+                async_client=redis_pools.async_client,
+                max_wait=config.reranking.max_wait_ms / 1000,
+                ttl=config.reranking.cache_ttl,
+            )
+
+        # language model components
+        self.llm = http_pool.attach(
+            ChatNVIDIA(
+                model=config.llm_model.name,
+                curr_mode="nim",
+                base_url=str(config.llm_model.url),
+                api_key=config.nvidia_api_key,
+            ),
+            replicas=[str(url) for url in config.llm_model.replicas],
+            hedge_after=config.llm_model.hedge_after,
+        )
+        self.condense_llm = self.llm
+        if config.condense.model or config.condense.url:
+            self.condense_llm = http_pool.attach(
+                ChatNVIDIA(
+                    model=config.condense.model or config.llm_model.name,
+                    curr_mode="nim",
+                    base_url=str(config.condense.url or config.llm_model.url),
+                    api_key=config.nvidia_api_key,
+                )
+            )
+        self.chat_prompt = prompts.CHAT_PROMPTS[config.context.layout]
+        self.history_summarizer = (
+            prompts.SUMMARIZE_HISTORY_TEMPLATE.with_config(run_name="summarize_history_prompt")
+            | self.llm
+            | StrOutputParser().with_config(run_name="summarize_history_chain")
+        )
+
+        # caches
+        self.condense_cache = CondensedQuestionCache(
+            redis_pools.async_client,
+            model=config.condense.model or config.llm_model.name,
+            ttl=config.condense_cache.ttl,
+        )
+        self.answer_cache = SemanticAnswerCache(
+            redis_pools.async_client,
+            collection_name=config.milvus.collection_name,
+            similarity_threshold=config.answer_cache.similarity_threshold,
+            ttl=config.answer_cache.ttl,
+            max_entries=config.answer_cache.max_entries,
+            max_mirrors=config.answer_cache.max_mirrors,
+            llm_model=config.llm_model.name,
+            embedding_model=config.embedding_model.name,
+        )
+
+    @property
+    def model_urls(self) -> list[str]:
+        """List the URLs of every model, to warm their connections."""
+        return [
+            str(self.config.llm_model.url),
+            str(self.config.embedding_model.url),
+            str(self.config.reranking_model.url),
+        ]
+
+    def format_docs(self, docs: list[Document]) -> str:
+        """Pack the best, distinct chunks of the docs into the context budget, separating them by newlines."""
+        return "\n\n".join(
+            pack_documents(
+                docs,
+                token_budget=self.config.context.token_budget,
+                duplicate_threshold=self.config.context.duplicate_threshold,
+                chunk_tokens=self.config.context.chunk_tokens,
+                stable_order=self.config.context.layout == "question",
+            )
+        )
+
+    def search_kwargs(self, retrieval_filter: RetrievalFilter | None) -> dict[str, Any]:
+        """Translate a retrieval filter into the arguments of the retriever, pushing it down into the vector search."""
+        if retrieval_filter is None:
+            return {}
+        kwargs = search_kwargs(self.vector_store, retrieval_filter)
+        if isinstance(self.retriever, HybridRetriever):
+            kwargs["keyword_filter"] = retrieval_filter.matches
+        return kwargs
+
+    def close(self) -> None:
+        """Stop the background work of clients that are no longer used."""
+        if self.batcher is not None:
+            self.batcher.close()
+
+
+# the clients are connected by the server's lifespan, so a dependency that is down does not stop the server's start
+chain_clients: HotSwap[ChainClients] = HotSwap(ChainClients.close)
+# the clients the request being handled started with, so a reload does not change them mid request
+_request_clients: ContextVar[ChainClients | None] = ContextVar("request_clients", default=None)
+
+
+def active_clients() -> ChainClients:
+    """Find the clients of the request being handled, or the current clients outside of a request."""
+    return _request_clients.get() or chain_clients.current
+
+
+def connect(config: Configuration = app_config) -> ChainClients:
+    """Connect the clients of a configuration and make new requests use them."""
+    clients = ChainClients(config)
+    chain_clients.swap(clients)
+    return clients
+
+
+async def warm_up(clients: ChainClients) -> None:
+    """Embed and search a dummy query and render the prompts, so the first request skips their lazy setup."""
+    await clients.retriever.ainvoke("warm up")
+    prompts.CONDENSE_QUESTION_TEMPLATE.format(history="", question="warm up")
+    clients.chat_prompt.format_messages(context="", history=[], question="warm up")
+
+
+async def reload_clients(interval: float) -> None:
+    """Swap in new clients every time the configuration files change."""
+    loop = asyncio.get_running_loop()
+    async for config in watch_config(interval):
+        previous = chain_clients.current.config if chain_clients.ready else app_config
+        restart_only = restart_required(config, previous)
+        if restart_only:
+            _LOGGER.warning("Restart the server to apply the changes to: %s", ", ".join(restart_only))
+        try:
+            clients = await loop.run_in_executor(None, ChainClients, config)
+            await loop.run_in_executor(None, http_pool.warm, clients.model_urls, config.http_pool.warm_connections)
+        except Exception as err:  # pylint: disable=broad-exception-caught # keep serving with the old clients
+            _LOGGER.error("Keeping the previous clients, the new configuration failed to connect: %s", err)
+            continue
+        chain_clients.swap(clients)
+        _LOGGER.info("Reloaded the configuration, now serving with version %d of the clients.", chain_clients.version)
 
 
 # %% define the llm powered chain
 
 
 # document retrieval
+def input_filter(msg: dict[str, Any]) -> RetrievalFilter | None:
+    """Read the optional metadata filter of the chain's input."""
+    value = msg.get("filter")
+    if value is None or isinstance(value, RetrievalFilter):
+        return value
+    return RetrievalFilter.model_validate(value)
+
+
+# the NVIDIA and Milvus clients only offer blocking calls, so every step is awaited through its async interface.
+# langchain will run the blocking work on the server's thread pool and keep the event loop free for other sessions.
 @chain
 async def retrieve_context(msg, config) -> str:
     """The Retrieval part of the RAG chain."""
+    clients = active_clients()
     use_kb = msg["use_kb"]
     use_reranker = msg["use_reranker"]
     question = msg["question"]
@@ -83,34 +308,136 @@ async def retrieve_context(msg, config) -> str:
     if not use_kb:
         return ""
 
+    try:
+        kwargs = clients.search_kwargs(input_filter(msg))
+    except UnsupportedFilter as err:
+        _LOGGER.warning("No documents can match the retrieval filter: %s", err)
+        return ""
+    async with upstreams["vector_store"].slot():
+        with metrics.stage("retrieval"):
+            docs = await clients.retriever.ainvoke(question, config, **kwargs)
+
     if use_reranker:
-        return (reranking_retriever | format_docs).invoke(question, config)
+        async with upstreams["reranking"].slot():
+            with metrics.stage("rerank"):
+                docs = await clients.reranker.acompress_documents(docs, question, callbacks=config.get("callbacks"))
 
-    return (retriever | format_docs).invoke(question, config)
+    return clients.format_docs(docs)
 
 
 # create a question and history condensing chain
 @chain
 async def question_parsing(msg, config) -> str:
     """Condense the question with chat history"""
-
+    clients = active_clients()
     condense_question_prompt = prompts.CONDENSE_QUESTION_TEMPLATE.with_config(run_name="condense_question_prompt")
-    condensed_chain = condense_question_prompt | llm | StrOutputParser().with_config(run_name="condense_question_chain")
-    if msg["history"]:
-        return condensed_chain.invoke(msg, config)
-    return msg["question"]
+    condensed_chain = (
+        condense_question_prompt
+        | clients.condense_llm
+        | StrOutputParser().with_config(run_name="condense_question_chain")
+    )
+    if not msg["history"]:
+        return msg["question"]
 
+    condense = clients.config.condense
+    if condense.skip_standalone and is_standalone(msg["question"], condense.min_standalone_words):
+        metrics.CONDENSE_DECISIONS.labels(decision="skipped").inc()
+        return msg["question"]
 
-my_chain = (
-    {
-        "context": retrieve_context,
-        "question": question_parsing,
-        "history": itemgetter("history"),
-    }
-    | RunnablePassthrough().with_config(run_name="LLM Prompt Input")
-    | prompts.CHAT_PROMPT
-    | llm
-)
+    with metrics.stage("condense"):
+        if clients.config.condense_cache.enabled:
+            condensed = await clients.condense_cache.get(msg["history"], msg["question"])
+            if condensed is not None:
+                metrics.CONDENSE_DECISIONS.labels(decision="cached").inc()
+                return condensed
+            async with upstreams["llm"].slot():
+                condensed = await condensed_chain.ainvoke(msg, config)
+            await clients.condense_cache.set(msg["history"], msg["question"], condensed)
+        else:
+            async with upstreams["llm"].slot():
+                condensed = await condensed_chain.ainvoke(msg, config)
+        metrics.CONDENSE_DECISIONS.labels(decision="condensed").inc()
+        return condensed
+
+
+answer_prompt = RunnablePassthrough().with_config(run_name="LLM Prompt Input")
+
+
+@chain
+async def answer_generation(msg, config):
+    """Stream the LLM's answer, measuring its time to first token and token rate."""
+    clients = active_clients()
+    prompt = await (answer_prompt | clients.chat_prompt).ainvoke(msg, config)
+    async with upstreams["llm"].slot():
+        # a cancelled or failed stream still ends its span and records what was generated
+        with metrics.GenerationTimer(prompt.to_string()) as timer:
+            async for chunk in clients.llm.astream(prompt, config):
+                timer.observe(chunk)
+                yield chunk
+
+
+rag_chain = {
+    "context": retrieve_context,
+    "question": question_parsing,
+    "history": itemgetter("history"),
+} | answer_generation
+
+
+# %% semantic answer cache
+def _discard(task: asyncio.Task) -> None:
+    """Cancel a task whose result is no longer needed, consuming its error so it is not reported."""
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled():
+        task.exception()
+
+
+@chain
+async def cached_rag_chain(msg, config):
+    """Replay the answer to a similar question, or generate and cache a new answer.
+
+    The context is retrieved while the question is condensed and looked up, like in the uncached chain, so a miss is no
+    slower than without the cache. The retrieval is cancelled when the answer is replayed.
+    """
+    clients = active_clients()
+    answer_cache = clients.answer_cache
+    retrieval = asyncio.create_task(retrieve_context.ainvoke(msg, config))
+    try:
+        question = await question_parsing.ainvoke(msg, config)
+        embedding = await clients.embedding_model.aembed_query(question)
+        with metrics.stage("answer_cache"):
+            scope = await answer_cache.scope(msg["use_kb"], msg["use_reranker"], input_filter(msg))
+            cached_answer = await answer_cache.lookup(embedding, scope)
+        context = None if cached_answer is not None else await retrieval
+    finally:
+        _discard(retrieval)
+    if cached_answer is not None:
+        async for chunk in replay(cached_answer):
+            yield chunk
+        return
+
+    answer = []
+    async for chunk in answer_generation.astream(
+        {"context": context, "question": question, "history": msg["history"]}, config
+    ):
+        answer.append(chunk.content)
+        yield chunk
+    await answer_cache.store(question, embedding, scope, "".join(answer))
+
+
+@chain
+async def my_chain(msg, config):
+    """Answer the question with the current clients, labeling the request's metrics with its retrieval settings."""
+    metrics.start_request(msg["use_kb"], msg["use_reranker"])
+    with chain_clients.use() as clients:
+        _request_clients.set(clients)
+        streaming = clients.config.streaming
+        answer_chain = cached_rag_chain if clients.config.answer_cache.enabled else rag_chain
+        chunks = answer_chain.astream(msg, config)
+        if streaming.coalesce if msg.get("coalesce") is None else msg["coalesce"]:
+            chunks = coalesce(chunks, streaming.window_ms / 1000, streaming.frame_chars)
+        async for chunk in chunks:
+            yield chunk
 
 
 # %% finalize the chain with history and an explicit API
@@ -120,14 +447,37 @@ class ChainInputs(BaseModel):
     question: str
     use_kb: bool = False
     use_reranker: bool = False
+    coalesce: Optional[bool] = None
+    filter: Optional[RetrievalFilter] = None
 
 
 ChainOutputs = str
 
 
+def session_history(session_id: str) -> BoundedChatMessageHistory:
+    """Load the bounded chat history of a session."""
+    clients = active_clients()
+    config = clients.config.history
+    # without summaries, messages older than the verbatim turns are never read again, with summaries the window holds
+    # up to twice as many turns before they are folded
+    verbatim = max(2 * config.max_turns, 1)
+    return BoundedChatMessageHistory(
+        RedisMessageStore(
+            session_id,
+            redis_pools.client,
+            redis_pools.async_client,
+            max_messages=max(config.max_messages, 2 * verbatim) if config.summarize else verbatim,
+            ttl=config.ttl,
+        ),
+        summarizer=clients.history_summarizer if config.summarize else None,
+        max_turns=config.max_turns,
+        token_budget=config.token_budget,
+    )
+
+
 my_chain = RunnableWithMessageHistory(
     my_chain,
-    lambda session_id: RedisChatMessageHistory(session_id, url=str(app_config.redis_dsn)),
+    session_history,
     input_messages_key="question",
     output_messages_key="output",
     history_messages_key="history",
@@ -0,0 +1,47 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local check for follow up questions that can be answered without condensing them."""
+
+import re
+
+_WORD_RE = re.compile(r"[a-z0-9']+")
+# words that point back to something said earlier in the conversation
+_REFERRING_WORDS = frozenset(
+    {
+        "it", "its", "it's", "itself", "they", "them", "their", "theirs", "themselves",
+        "he", "him", "his", "she", "her", "hers",
+        "this", "that", "these", "those", "there", "then",
+        "one", "ones", "other", "others", "another", "former", "latter", "same", "such",
+        "above", "previous", "previously", "earlier", "before", "again", "else", "more",
+    }
+)  # fmt: skip
+# openings that continue the previous question instead of asking a new one
+_CONTINUATION_RE = re.compile(
+    r"^\s*(and|or|but|also|so|what about|how about|why not|why|what else|anything else|elaborate|explain|continue)\b",
+    re.IGNORECASE,
+)
+
+
+def is_standalone(question: str, min_words: int) -> bool:
+    """Guess whether a follow up question can be understood without the chat history.
+
+    The check errs on the side of condensing: short questions, questions that continue the previous one, and questions
+    with words that refer back to the conversation are all sent to the condensing model.
+    """
+    words = _WORD_RE.findall(question.lower())
+    if len(words) < min_words or _CONTINUATION_RE.match(question):
+        return False
+    return _REFERRING_WORDS.isdisjoint(words)
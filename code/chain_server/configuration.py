@@ -48,10 +48,13 @@ The variable names will be in the form: `APP_FIELD__SUB_FIELD`
 Values specified as environment variables will take precedence over all values from files.
 
 """
+
+# pylint: disable=too-many-lines # every option is declared here, so the configuration docs can be generated
 import logging
 import os
 from enum import Enum
-from typing import Annotated, Any, Callable, Optional, cast
+from pathlib import Path
+from typing import Annotated, Any, Callable, Literal, Optional, cast
 
 from confz import BaseConfig, EnvSource, FileSource
 from pydantic import (
@@ -66,6 +69,8 @@ from pydantic import (
 
 _ENV_VAR_PREFIX = "APP_"
 _CONFIG_FILE_ENV_VAR: str = f"{_ENV_VAR_PREFIX}CONFIG"
+# the number of worker processes, set by `chain_server.workers` for the processes it starts
+WORKERS_ENV_VAR = "NIM_ANYWHERE_WORKERS"
 
 
 class LogLevels(Enum):
@@ -86,6 +91,62 @@ class MilvusConfig(BaseModel):
         description="The host machine running Milvus vector DB.",
     )
     collection_name: str = Field("collection_1", description="The name of the Milvus collection.")
+    top_k: int = Field(4, gt=0, description="The number of documents to retrieve for each question.")
+    hybrid_search: bool = Field(
+        False,
+        description="Fuse the vector search with a keyword (BM25) search using reciprocal rank fusion. "
+        + "Documents are keyword indexed as they are uploaded, and the documents stored before it was enabled are "
+        + "indexed when the chain connects.",
+    )
+    keyword_postings: int = Field(
+        1000,
+        gt=0,
+        description="The most documents the keyword search reads for each query term, those where the term occurs "
+        + "most often. Terms in more than half of the documents are not searched once they are in more documents "
+        + "than this.",
+    )
+
+
+class VectorStoreConfig(BaseModel):
+    """The selection of the vector store backend and the settings of the local vector index."""
+
+    backend: Annotated[
+        Literal["milvus", "local"],
+        Field(
+            "milvus",
+            description="The vector store to use. The local index runs in process and needs no Milvus server.",
+        ),
+    ]
+    path: Annotated[
+        Path,
+        Field(
+            Path("/project/data/vector_store"),
+            description="The directory where the local index stores its collections.",
+        ),
+    ]
+    dtype: Annotated[
+        Literal["float32", "float16"],
+        Field(
+            "float32",
+            description="The precision of the stored vectors. float16 halves the size of the local index.",
+        ),
+    ]
+    ann: Annotated[
+        bool,
+        Field(
+            False,
+            description="Search large local collections with an HNSW graph instead of scanning every vector. "
+            + "Requires the hnswlib package.",
+        ),
+    ]
+    ann_min_documents: Annotated[
+        int,
+        Field(10000, gt=0, description="The collection size at which the local index starts using the graph."),
+    ]
+    ann_ef: Annotated[
+        int,
+        Field(64, gt=0, description="The breadth of the graph search. Larger values are slower and more accurate."),
+    ]
 
 
 class LLMModelConfig(BaseModel):
@@ -105,6 +166,23 @@ class LLMModelConfig(BaseModel):
             description="The URL to the model API.",
         ),
     ]
+    replicas: Annotated[
+        list[HttpUrl],
+        Field(
+            default_factory=list,
+            description="The URLs of more replicas serving the same model. "
+            + "Requests are balanced across the URL and its replicas by the fewest outstanding requests.",
+        ),
+    ]
+    hedge_after: Annotated[
+        Optional[float],
+        Field(
+            None,
+            gt=0,
+            description="The number of seconds after which a request that has not been answered is also sent to "
+            + "a second replica, taking whichever answer comes first. Streamed responses are never hedged.",
+        ),
+    ]
 
 
 class RerankingModelConfig(BaseModel):
@@ -124,6 +202,23 @@ class RerankingModelConfig(BaseModel):
             description="The URL to the model API.",
         ),
     ]
+    replicas: Annotated[
+        list[HttpUrl],
+        Field(
+            default_factory=list,
+            description="The URLs of more replicas serving the same model. "
+            + "Requests are balanced across the URL and its replicas by the fewest outstanding requests.",
+        ),
+    ]
+    hedge_after: Annotated[
+        Optional[float],
+        Field(
+            None,
+            gt=0,
+            description="The number of seconds after which a request that has not been answered is also sent to "
+            + "a second replica, taking whichever answer comes first. Streamed responses are never hedged.",
+        ),
+    ]
 
 
 class EmbeddingModelConfig(BaseModel):
@@ -143,6 +238,329 @@ class EmbeddingModelConfig(BaseModel):
             description="The URL to the model API.",
         ),
     ]
+    replicas: Annotated[
+        list[HttpUrl],
+        Field(
+            default_factory=list,
+            description="The URLs of more replicas serving the same model. "
+            + "Requests are balanced across the URL and its replicas by the fewest outstanding requests.",
+        ),
+    ]
+    hedge_after: Annotated[
+        Optional[float],
+        Field(
+            None,
+            gt=0,
+            description="The number of seconds after which a request that has not been answered is also sent to "
+            + "a second replica, taking whichever answer comes first. Streamed responses are never hedged.",
+        ),
+    ]
+
+
+class HTTPPoolConfig(BaseModel):
+    """Configuration for the pool of keep-alive connections to the model APIs."""
+
+    max_connections: Annotated[
+        int, Field(64, gt=0, description="The maximum number of open connections to each model API host.")
+    ]
+    connect_timeout: Annotated[
+        float, Field(5.0, gt=0, description="The number of seconds to wait for a connection to a model API.")
+    ]
+    read_timeout: Annotated[
+        float, Field(120.0, gt=0, description="The number of seconds to wait for data from a model API.")
+    ]
+    warm_connections: Annotated[
+        int, Field(2, ge=0, description="The number of connections opened to each model API on startup.")
+    ]
+    health_check_interval: Annotated[
+        float, Field(10.0, gt=0, description="The number of seconds between health checks of model replicas.")
+    ]
+    eject_seconds: Annotated[
+        float,
+        Field(30.0, gt=0, description="The number of seconds a failing model replica is taken out of rotation."),
+    ]
+
+
+class RedisPoolConfig(BaseModel):
+    """Configuration for the pool of connections to Redis shared by the server."""
+
+    max_connections: Annotated[
+        int, Field(64, gt=0, description="The maximum number of open connections per pool and server process.")
+    ]
+    timeout: Annotated[
+        float, Field(5.0, gt=0, description="The number of seconds to wait for a free connection from the pool.")
+    ]
+    socket_timeout: Annotated[
+        float, Field(5.0, gt=0, description="The number of seconds to wait for Redis to answer a command.")
+    ]
+
+
+class AdmissionConfig(BaseModel):
+    """Configuration for the limits on concurrent calls to each upstream service."""
+
+    llm_concurrency: Annotated[int, Field(16, gt=0, description="The number of concurrent requests sent to the LLM.")]
+    embedding_concurrency: Annotated[int, Field(32, gt=0, description="The number of concurrent query embeddings.")]
+    reranking_concurrency: Annotated[int, Field(16, gt=0, description="The number of concurrent reranking requests.")]
+    vector_store_concurrency: Annotated[
+        int, Field(32, gt=0, description="The number of concurrent vector store searches.")
+    ]
+    max_queued: Annotated[
+        int,
+        Field(
+            64,
+            ge=0,
+            description="The number of calls that may wait for each upstream. "
+            + "New chain requests are rejected with a 429 while any queue is full.",
+        ),
+    ]
+    max_queue_wait: Annotated[
+        float,
+        Field(
+            10.0,
+            gt=0,
+            description="The number of seconds a call may wait for an upstream before it fails with a 503.",
+        ),
+    ]
+
+
+class HistoryConfig(BaseModel):
+    """Configuration for how much of the conversation history is sent to the models."""
+
+    max_turns: Annotated[
+        int,
+        Field(
+            4,
+            ge=0,
+            description="The number of recent question and answer turns that are kept verbatim. With summaries, up "
+            + "to twice as many are kept before all but the latest are summarized at once, so the history only "
+            + "grows between summaries and consecutive prompts of a session share a prefix the LLM can cache.",
+        ),
+    ]
+    token_budget: Annotated[
+        int, Field(1024, gt=0, description="The maximum number of tokens of history, including the summary.")
+    ]
+    summarize: Annotated[
+        bool, Field(True, description="Summarize older turns instead of dropping them from the history.")
+    ]
+    max_messages: Annotated[
+        int,
+        Field(
+            64,
+            gt=0,
+            description=(
+                "The most messages stored per session, older messages are trimmed as new ones arrive. "
+                "Never fewer than the verbatim turns, only those are stored when summaries are disabled."
+            ),
+        ),
+    ]
+    ttl: Annotated[
+        int,
+        Field(
+            7 * 24 * 3600,
+            ge=0,
+            description="The seconds a session is stored after it was last used, 0 stores sessions forever. "
+            + "The sweeper applies changes to the sessions it finds without an expiry on restart.",
+            json_schema_extra={"restart": True},
+        ),
+    ]
+    sweep_interval: Annotated[
+        float,
+        Field(
+            300,
+            gt=0,
+            description=(
+                "The seconds between sweeps that compact the stored sessions, expire stale ones and measure their "
+                "memory use. Takes effect on restart."
+            ),
+            json_schema_extra={"restart": True},
+        ),
+    ]
+
+
+class ContextConfig(BaseModel):
+    """Configuration for how the retrieved documents are packed into the prompt."""
+
+    token_budget: Annotated[
+        int, Field(2048, gt=0, description="The maximum number of tokens of retrieved context in the prompt.")
+    ]
+    chunk_tokens: Annotated[
+        int,
+        Field(256, gt=0, description="The size of the chunks, in tokens, that documents are split into for packing."),
+    ]
+    duplicate_threshold: Annotated[
+        float,
+        Field(
+            0.9,
+            gt=0,
+            le=1,
+            description="The similarity at which a chunk is dropped as a near duplicate of a chunk already packed.",
+        ),
+    ]
+    layout: Annotated[
+        Literal["system", "question"],
+        Field(
+            "system",
+            description=(
+                "Where the retrieved context is placed in the prompt. `system` puts it in the system message. "
+                "`question` sends it with the latest question, in a deterministic order, so the instructions and the "
+                "history form a prompt prefix that the LLM can reuse from its prefix cache."
+            ),
+        ),
+    ]
+
+
+class EmbeddingBatchingConfig(BaseModel):
+    """Configuration for combining the query embeddings of concurrent sessions into batches."""
+
+    enabled: Annotated[bool, Field(True, description="Send concurrent query embeddings in batches.")]
+    max_batch_size: Annotated[int, Field(32, gt=0, description="The maximum number of queries in a batch.")]
+    max_wait_ms: Annotated[
+        float, Field(5.0, ge=0, description="The number of milliseconds a query waits for others to join its batch.")
+    ]
+    max_concurrent_batches: Annotated[
+        int, Field(4, gt=0, description="The number of batches that may be in flight at the same time.")
+    ]
+
+
+class EmbeddingCacheConfig(BaseModel):
+    """Configuration for the cache of query embeddings."""
+
+    enabled: Annotated[bool, Field(True, description="Reuse the embeddings of previously seen queries.")]
+    max_size: Annotated[
+        int, Field(4096, gt=0, description="The number of embeddings kept in each server process's memory.")
+    ]
+    ttl: Annotated[int, Field(86400, gt=0, description="The number of seconds an embedding is kept in Redis.")]
+
+
+class RerankingConfig(BaseModel):
+    """Configuration for batching and caching the reranker's relevance scores."""
+
+    enabled: Annotated[
+        bool, Field(True, description="Cache relevance scores and coalesce concurrent requests for the same query.")
+    ]
+    max_wait_ms: Annotated[
+        float, Field(5.0, ge=0, description="The number of milliseconds a request waits for others to join it.")
+    ]
+    cache_ttl: Annotated[int, Field(3600, gt=0, description="The number of seconds a relevance score is kept.")]
+
+
+class CondenseConfig(BaseModel):
+    """Configuration for condensing follow up questions with the chat history."""
+
+    skip_standalone: Annotated[
+        bool,
+        Field(
+            True,
+            description="Skip the condensing model for follow up questions that do not refer back to the conversation.",
+        ),
+    ]
+    min_standalone_words: Annotated[
+        int, Field(4, ge=0, description="Follow up questions with fewer words than this are always condensed.")
+    ]
+    model: Annotated[
+        Optional[str],
+        Field(None, description="The name of a smaller model to condense questions with. Defaults to the LLM model."),
+    ]
+    url: Annotated[
+        Optional[HttpUrl],
+        Field(None, description="The URL of the condensing model's API. Defaults to the LLM model's URL."),
+    ]
+
+
+class CondenseCacheConfig(BaseModel):
+    """Configuration for the cache of questions condensed with the chat history."""
+
+    enabled: Annotated[bool, Field(True, description="Reuse condensed questions for repeated follow up questions.")]
+    ttl: Annotated[int, Field(300, gt=0, description="The number of seconds a condensed question is kept.")]
+
+
+class AnswerCacheConfig(BaseModel):
+    """Configuration for the semantic cache of generated answers."""
+
+    enabled: Annotated[
+        bool,
+        Field(False, description="Replay cached answers for questions similar to ones that were already answered."),
+    ]
+    similarity_threshold: Annotated[
+        float,
+        Field(
+            0.95,
+            ge=0,
+            le=1,
+            description="The minimum cosine similarity between two questions for them to share an answer.",
+        ),
+    ]
+    ttl: Annotated[int, Field(3600, gt=0, description="The number of seconds a cached answer is valid.")]
+    max_entries: Annotated[
+        int,
+        Field(
+            1000,
+            gt=0,
+            description="The number of answers kept per retrieval setting. The least recently used are evicted.",
+        ),
+    ]
+    max_mirrors: Annotated[
+        int,
+        Field(
+            16,
+            gt=0,
+            description="The number of retrieval settings whose question vectors each worker keeps in memory. "
+            + "The least recently used are dropped and reloaded from Redis when needed.",
+        ),
+    ]
+
+
+class StreamingConfig(BaseModel):
+    """Configuration for how the answer tokens are framed in the response stream."""
+
+    coalesce: Annotated[
+        bool,
+        Field(
+            False,
+            description="Merge the answer's tokens into larger stream events. "
+            + "The first token is always sent on its own. Requests may override this with their `coalesce` input.",
+        ),
+    ]
+    window_ms: Annotated[
+        int, Field(20, gt=0, description="The longest time, in milliseconds, that tokens are held to fill an event.")
+    ]
+    frame_chars: Annotated[
+        int, Field(64, gt=0, description="The number of characters at which an event is sent without waiting.")
+    ]
+
+
+class ReadinessConfig(BaseModel):
+    """Configuration for the warm up at startup and the readiness probes of the dependencies."""
+
+    warm_up: Annotated[
+        bool,
+        Field(True, description="Embed and search a dummy query and render the prompts before reporting ready."),
+    ]
+    probe_interval: Annotated[
+        float, Field(10.0, gt=0, description="The number of seconds between the probes of the dependencies.")
+    ]
+    probe_timeout: Annotated[
+        float,
+        Field(5.0, gt=0, description="The number of seconds a probe may take before its dependency is not ready."),
+    ]
+
+
+class ReloadConfig(BaseModel):
+    """Configuration for applying changes to the configuration files without restarting the server."""
+
+    enabled: Annotated[
+        bool,
+        Field(
+            True,
+            description="Watch the configuration files and swap in new model and vector store clients when they "
+            + "change. Requests in flight finish on the old clients. "
+            + "Changes to the options that are only read on start, like the connection pools and admission limits, "
+            + "are logged and require a restart.",
+        ),
+    ]
+    interval: Annotated[
+        float, Field(2.0, gt=0, description="The number of seconds between checks of the configuration files.")
+    ]
 
 
 class Configuration(BaseConfig):
@@ -162,6 +580,17 @@ class Configuration(BaseConfig):
         Field(
             "redis://localhost:6379/0",
             description="The Data Source Name for your Redis DB.",
+            json_schema_extra={"restart": True},
+        ),
+    ]
+    http_pool: Annotated[
+        HTTPPoolConfig,
+        Field(default_factory=HTTPPoolConfig, description=HTTPPoolConfig.__doc__, json_schema_extra={"restart": True}),
+    ]
+    redis_pool: Annotated[
+        RedisPoolConfig,
+        Field(
+            default_factory=RedisPoolConfig, description=RedisPoolConfig.__doc__, json_schema_extra={"restart": True}
         ),
     ]
     llm_model: Annotated[
@@ -186,6 +615,79 @@ class Configuration(BaseConfig):
         MilvusConfig,
         Field(default_factory=cast(Callable[[], MilvusConfig], MilvusConfig)),
     ]
+    vector_store: Annotated[
+        VectorStoreConfig,
+        Field(default_factory=VectorStoreConfig, description=VectorStoreConfig.__doc__),
+    ]
+    admission: Annotated[
+        AdmissionConfig,
+        Field(
+            default_factory=AdmissionConfig, description=AdmissionConfig.__doc__, json_schema_extra={"restart": True}
+        ),
+    ]
+    history: Annotated[HistoryConfig, Field(default_factory=HistoryConfig, description=HistoryConfig.__doc__)]
+    context: Annotated[
+        ContextConfig,
+        Field(default_factory=ContextConfig, description=ContextConfig.__doc__),
+    ]
+    embedding_batching: Annotated[
+        EmbeddingBatchingConfig,
+        Field(default_factory=EmbeddingBatchingConfig, description=EmbeddingBatchingConfig.__doc__),
+    ]
+    embedding_cache: Annotated[
+        EmbeddingCacheConfig,
+        Field(default_factory=EmbeddingCacheConfig, description=EmbeddingCacheConfig.__doc__),
+    ]
+    reranking: Annotated[
+        RerankingConfig,
+        Field(default_factory=RerankingConfig, description=RerankingConfig.__doc__),
+    ]
+    condense: Annotated[
+        CondenseConfig,
+        Field(default_factory=CondenseConfig, description=CondenseConfig.__doc__),
+    ]
+    condense_cache: Annotated[
+        CondenseCacheConfig,
+        Field(default_factory=CondenseCacheConfig, description=CondenseCacheConfig.__doc__),
+    ]
+    answer_cache: Annotated[
+        AnswerCacheConfig,
+        Field(default_factory=AnswerCacheConfig, description=AnswerCacheConfig.__doc__),
+    ]
+    streaming: Annotated[
+        StreamingConfig,
+        Field(default_factory=StreamingConfig, description=StreamingConfig.__doc__),
+    ]
+    readiness: Annotated[
+        ReadinessConfig,
+        Field(
+            default_factory=ReadinessConfig, description=ReadinessConfig.__doc__, json_schema_extra={"restart": True}
+        ),
+    ]
+    reload: Annotated[
+        ReloadConfig,
+        Field(default_factory=ReloadConfig, description=ReloadConfig.__doc__, json_schema_extra={"restart": True}),
+    ]
+    worker_threads: Annotated[
+        int,
+        Field(
+            64,
+            gt=0,
+            description="The number of threads used to run blocking model and database calls off the event loop.",
+            json_schema_extra={"restart": True},
+        ),
+    ]
+    workers: Annotated[
+        int,
+        Field(
+            1,
+            gt=0,
+            description="The number of server processes started by `python -m chain_server.workers`. "
+            + "Every process gets its own connection pools and threads, the admission limits are split between them. "
+            + "Servers started any other way keep the full limits.",
+            json_schema_extra={"restart": True},
+        ),
+    ]
     log_level: Annotated[LogLevels, Field(LogLevels.WARNING, description=LogLevels.__doc__)]
 
     # sources where config is looked for
@@ -244,5 +746,19 @@ class Configuration(BaseConfig):
         return val
 
 
+def restart_required(current: BaseModel, previous: BaseModel, prefix: str = "") -> list[str]:
+    """List the changed options that are marked as only taking effect when the server restarts."""
+    changed = []
+    for name, field in type(current).model_fields.items():
+        value = getattr(current, name)
+        if value == getattr(previous, name):
+            continue
+        if isinstance(field.json_schema_extra, dict) and field.json_schema_extra.get("restart"):
+            changed.append(prefix + name)
+        elif isinstance(value, BaseModel):
+            changed += restart_required(value, getattr(previous, name), f"{prefix}{name}.")
+    return changed
+
+
 # load the runtime configuration
 config = Configuration()
@@ -0,0 +1,368 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Connection pools shared by every request to the Chain Server."""
+
+import logging
+import threading
+import weakref
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures import wait
+from typing import Any, Callable, Iterable, Sequence, TypeVar
+
+import redis
+import redis.asyncio
+import requests
+from requests.adapters import HTTPAdapter
+
+from .replicas import Replica, ReplicaSet
+
+_LOGGER = logging.getLogger(__name__)
+_ModelT = TypeVar("_ModelT")
+
+
+class RedisPools:
+    """Bounded Redis connection pools for the blocking and the asyncio clients.
+
+    Clients are cheap views onto the pools, so every cache and chat history shares the same connections instead of
+    opening new ones for each request. When all of the connections are busy, callers wait up to the pool timeout for one
+    to be released.
+    """
+
+    def __init__(self, url: str, max_connections: int, timeout: float, socket_timeout: float) -> None:
+        """Initialize the pools without connecting."""
+        self._pool = redis.BlockingConnectionPool.from_url(
+            url, max_connections=max_connections, timeout=timeout, socket_timeout=socket_timeout
+        )
+        self._async_pool = redis.asyncio.BlockingConnectionPool.from_url(
+            url, max_connections=max_connections, timeout=timeout, socket_timeout=socket_timeout
+        )
+        self.client = redis.Redis(connection_pool=self._pool)
+        self.async_client = redis.asyncio.Redis(connection_pool=self._async_pool)
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        """Report the usage of both pools."""
+        # pylint: disable=protected-access # redis-py does not expose pool usage publicly
+        idle = sum(1 for conn in self._pool.pool.queue if conn is not None)
+        return {
+            "blocking": {
+                "max_connections": self._pool.max_connections,
+                "open": len(self._pool._connections),
+                "in_use": len(self._pool._connections) - idle,
+                "idle": idle,
+            },
+            "async": {
+                "max_connections": self._async_pool.max_connections,
+                "open": len(self._async_pool._in_use_connections) + len(self._async_pool._available_connections),
+                "in_use": len(self._async_pool._in_use_connections),
+                "idle": len(self._async_pool._available_connections),
+            },
+        }
+
+    async def aclose(self) -> None:
+        """Close every connection in both pools."""
+        self._pool.disconnect()
+        await self._async_pool.disconnect()
+
+
+class _TimeoutAdapter(HTTPAdapter):
+    """An HTTP adapter that applies default timeouts to every request."""
+
+    def __init__(self, timeout: tuple[float, float], **kwargs: Any) -> None:
+        """Initialize the adapter."""
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(  # pylint: disable=too-many-arguments,too-many-positional-arguments # interface defined by requests
+        self,
+        request: requests.PreparedRequest,
+        stream: bool = False,
+        timeout: Any = None,
+        verify: bool | str = True,
+        cert: Any = None,
+        proxies: Any = None,
+    ) -> requests.Response:
+        """Send a request with the default timeouts, unless the caller set its own."""
+        return super().send(
+            request, stream=stream, timeout=timeout or self.timeout, verify=verify, cert=cert, proxies=proxies
+        )
+
+
+def _releaser(replica_set: ReplicaSet, replica: Replica) -> Callable[[], None]:
+    """Build a callback that counts a replica's request as finished the first time it is called."""
+    lock = threading.Lock()
+    pending = [True]
+
+    def release() -> None:
+        with lock:
+            if not pending:
+                return
+            pending.clear()
+        replica_set.release(replica)
+
+    return release
+
+
+def _close_response(future: "Future[requests.Response]") -> None:
+    """Return the connection of a hedged request that lost the race to the pool."""
+    if future.exception() is None:
+        future.result().close()
+
+
+class _BalancingAdapter(_TimeoutAdapter):
+    """An HTTP adapter that spreads the requests addressed to a replica set across its replicas."""
+
+    def __init__(self, timeout: tuple[float, float], **kwargs: Any) -> None:
+        """Initialize the adapter."""
+        super().__init__(timeout, **kwargs)
+        self.replica_sets: list[ReplicaSet] = []
+        self._hedging = ThreadPoolExecutor(thread_name_prefix="http-hedge")
+
+    def send(  # pylint: disable=too-many-arguments,too-many-positional-arguments # interface defined by requests
+        self,
+        request: requests.PreparedRequest,
+        stream: bool = False,
+        timeout: Any = None,
+        verify: bool | str = True,
+        cert: Any = None,
+        proxies: Any = None,
+    ) -> requests.Response:
+        """Send a request to the least loaded replica of its model, if it has replicas."""
+        kwargs: dict[str, Any] = {
+            "stream": stream,
+            "timeout": timeout,
+            "verify": verify,
+            "cert": cert,
+            "proxies": proxies,
+        }
+        replica_set = next((rs for rs in self.replica_sets if rs.matches(str(request.url))), None)
+        if replica_set is None:
+            return super().send(request, **kwargs)
+        # streamed responses are consumed as they arrive, so they can not be raced
+        if replica_set.hedge_after is not None and not stream:
+            return self._send_hedged(replica_set, request, kwargs)
+        return self._send_balanced(replica_set, request, kwargs)
+
+    def _send_to(
+        self, replica_set: ReplicaSet, replica: Replica, request: requests.PreparedRequest, kwargs: dict[str, Any]
+    ) -> requests.Response:
+        """Send a request to a replica that was acquired for it, releasing the replica once the response is read."""
+        routed = request.copy()
+        routed.url = replica_set.route(str(request.url), replica)
+        release = _releaser(replica_set, replica)
+        streaming = False
+        try:
+            response = super().send(routed, **kwargs)
+            if kwargs["stream"]:
+                # the request is outstanding until the client reads the stream to the end or closes it, urllib3 then
+                # returns the connection to the pool, the finalizer covers the streams that are abandoned
+                raw_release = response.raw.release_conn
+
+                def release_conn() -> None:
+                    raw_release()
+                    release()
+
+                response.raw.release_conn = release_conn
+                weakref.finalize(response, release)
+                streaming = True
+            else:
+                # requests would read the body right after this returns, read it here to release the replica now
+                _ = response.content
+        except requests.RequestException as err:
+            replica_set.eject(replica, err)
+            raise
+        finally:
+            if not streaming:
+                release()
+        if response.status_code >= 500:
+            replica_set.eject(replica, f"HTTP {response.status_code}")
+        return response
+
+    def _send_balanced(
+        self, replica_set: ReplicaSet, request: requests.PreparedRequest, kwargs: dict[str, Any]
+    ) -> requests.Response:
+        """Send a request to the least loaded replica, failing over once if the connection fails."""
+        replica = replica_set.acquire()
+        assert replica is not None
+        try:
+            return self._send_to(replica_set, replica, request, kwargs)
+        except requests.ConnectionError:
+            fallback = replica_set.acquire(exclude=replica)
+            if fallback is None:
+                raise
+            if not fallback.healthy:
+                replica_set.release(fallback)
+                raise
+            return self._send_to(replica_set, fallback, request, kwargs)
+
+    def _send_hedged(
+        self, replica_set: ReplicaSet, request: requests.PreparedRequest, kwargs: dict[str, Any]
+    ) -> requests.Response:
+        """Send a request, and race a copy on another replica if the first is slower than the hedging delay."""
+        first = replica_set.acquire()
+        assert first is not None
+        primary = self._hedging.submit(self._send_to, replica_set, first, request, kwargs)
+        try:
+            return primary.result(timeout=replica_set.hedge_after)
+        except FutureTimeoutError:
+            pass
+
+        second = replica_set.acquire(exclude=first)
+        if second is None:
+            return primary.result()
+        replica_set.count_hedge()
+        backup = self._hedging.submit(self._send_to, replica_set, second, request, kwargs)
+        done, _ = wait([primary, backup], return_when=FIRST_COMPLETED)
+        winner = done.pop()
+        loser = backup if winner is primary else primary
+        if winner.exception() is not None:
+            return loser.result()
+        loser.add_done_callback(_close_response)
+        return winner.result()
+
+    def close(self) -> None:
+        """Close the connections and stop the hedging threads."""
+        self._hedging.shutdown(wait=False, cancel_futures=True)
+        super().close()
+
+
+class HTTPPool:
+    """A keep-alive HTTP connection pool shared by every model client.
+
+    The NVIDIA model clients open a new `requests.Session` for every call, which means a new connection and, for the
+    hosted API, a new TLS handshake on every request. Attaching the clients to this pool makes them reuse one session
+    with a bounded number of persistent connections per host.
+    """
+
+    def __init__(
+        self,
+        max_connections: int,
+        connect_timeout: float,
+        read_timeout: float,
+        health_check_interval: float = 10.0,
+        eject_seconds: float = 30.0,
+    ) -> None:
+        """Initialize the pool without connecting."""
+        self._health_check_interval = health_check_interval
+        self._eject_seconds = eject_seconds
+        self._stopped = threading.Event()
+        self._adapter = _BalancingAdapter(
+            timeout=(connect_timeout, read_timeout),
+            pool_connections=8,
+            pool_maxsize=max_connections,
+            pool_block=True,
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", self._adapter)
+        self.session.mount("https://", self._adapter)
+
+    def attach(self, model: _ModelT, replicas: Sequence[str] = (), hedge_after: float | None = None) -> _ModelT:
+        """Make an NVIDIA model client send its requests through this pool.
+
+        When replicas are given, the requests to the model's base URL are balanced across it and the replicas. Attaching
+        the same replicas again keeps their health, attaching different replicas for the URL replaces them.
+        """
+        # pylint: disable-next=protected-access # the session factory is only reachable on the private client
+        model._client.get_session_fn = lambda: self.session  # type: ignore[attr-defined]
+        if replicas:
+            primary = str(model.base_url)  # type: ignore[attr-defined]
+            replica_set = ReplicaSet([primary, *replicas], self._eject_seconds, hedge_after)
+            replica_sets = self._adapter.replica_sets
+            for idx, existing in enumerate(replica_sets):
+                if existing.primary != replica_set.primary:
+                    continue
+                if [rep.url for rep in existing.replicas] != [rep.url for rep in replica_set.replicas]:
+                    _LOGGER.info("Replacing the replicas of %s with %s", primary, list(replicas))
+                    # swap in a new list, so requests being routed keep a consistent view
+                    self._adapter.replica_sets = [*replica_sets[:idx], replica_set, *replica_sets[idx + 1 :]]
+                else:
+                    existing.hedge_after = hedge_after
+                break
+            else:
+                self._adapter.replica_sets = [*replica_sets, replica_set]
+        return model
+
+    @property
+    def urls(self) -> list[str]:
+        """List every replica URL the pool balances across."""
+        return [replica.url for rs in self._adapter.replica_sets for replica in rs.replicas]
+
+    def _check_health(self, probe: requests.Session) -> None:
+        """Probe every replica, ejecting the failing ones and restoring the recovered ones."""
+        for replica_set in self._adapter.replica_sets:
+            for replica in replica_set.replicas:
+                try:
+                    response = probe.get(f"{replica.url}/models", timeout=self._adapter.timeout)
+                except requests.RequestException as err:
+                    replica_set.eject(replica, err)
+                    continue
+                if response.status_code >= 500:
+                    replica_set.eject(replica, f"HTTP {response.status_code}")
+                else:
+                    replica_set.restore(replica)
+
+    def _health_checks(self) -> None:
+        """Probe the replicas until the pool is closed."""
+        with requests.Session() as probe:
+            while not self._stopped.wait(self._health_check_interval):
+                self._check_health(probe)
+
+    def start_health_checks(self) -> None:
+        """Start probing the replicas in the background."""
+        if self._adapter.replica_sets:
+            threading.Thread(target=self._health_checks, name="http-health", daemon=True).start()
+
+    def _touch(self, url: str) -> None:
+        """Send a cheap request to an endpoint, any response means the connection is established."""
+        try:
+            self.session.get(f"{url}/models")
+        except requests.RequestException as err:
+            _LOGGER.warning("Unable to warm up the connection to %s: %s", url, err)
+
+    def warm(self, urls: Iterable[str], connections: int) -> None:
+        """Open connections to every model endpoint so the first requests skip the connection setup."""
+        targets = [url for url in dict.fromkeys(url.rstrip("/") for url in urls) for _ in range(connections)]
+        # concurrent requests are needed to open more than one connection per host
+        with ThreadPoolExecutor(max_workers=max(len(targets), 1), thread_name_prefix="http-warmup") as executor:
+            list(executor.map(self._touch, targets))
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        """Report the usage of the connections to every host."""
+        hosts = {}
+        for key in self._adapter.poolmanager.pools.keys():
+            pool = self._adapter.poolmanager.pools[key]
+            if pool is None or pool.pool is None:
+                continue
+            idle = sum(1 for conn in list(pool.pool.queue) if conn is not None)
+            hosts[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "max_connections": pool.pool.maxsize,
+                "idle": idle,
+                "opened": pool.num_connections,
+                "requests": pool.num_requests,
+            }
+        return hosts
+
+    @property
+    def replica_stats(self) -> dict[str, Any]:
+        """Report the load and health of the replicas of every balanced model."""
+        return {replica_set.primary: replica_set.stats for replica_set in self._adapter.replica_sets}
+
+    def close(self) -> None:
+        """Close every connection in the pool."""
+        self._stopped.set()
+        self.session.close()
@@ -15,6 +15,10 @@
 
 """This module contains the error messages that can be returned from the server."""
 
+import json
+
+from .admission import Overloaded
+
 _SSE_ERROR_MESSAGE = {
     "type": "http.response.body",
     "body": (
@@ -26,9 +30,35 @@ _SSE_ERROR_MESSAGE = {
 }
 
 
+def _sse_overloaded_message(err: Overloaded) -> dict:
+    """Build the last event of a stream whose upstream call waited too long for a slot."""
+    data = {"status_code": 503, "message": str(err), "retry_after": err.retry_after}
+    return {
+        "type": "http.response.body",
+        "body": b"event: error\r\ndata: " + json.dumps(data).encode("UTF-8") + b"\r\n\r\n",
+        "more_body": False,
+    }
+
+
+def _overload(err: BaseException) -> Overloaded | None:
+    """Find an overload among the errors a streaming response was cancelled with."""
+    if isinstance(err, Overloaded):
+        return err
+    if isinstance(err, BaseExceptionGroup):
+        for inner in err.exceptions:
+            found = _overload(inner)
+            if found is not None:
+                return found
+    return None
+
+
 # pylint: disable-next=too-few-public-methods # interface defined by starlette
 class ErrorHandlerMiddleware:
-    """A starlette middleware class for rewriting langserve sse errors."""
+    """A starlette middleware class for rewriting langserve sse errors.
+
+    Streams have already sent their headers when an upstream call is rejected, so the `Overloaded` handler can not
+    answer with a 503. The stream's error event carries the 503 and the seconds to wait before retrying instead.
+    """
 
     def __init__(self, app):
         """Initialize the middleware."""
@@ -39,11 +69,26 @@ class ErrorHandlerMiddleware:
         if scope["type"] != "http":
             return await self.app(scope, receive, send)
 
+        failed = False
+
         async def intercept_sse_errors(message):
+            nonlocal failed
             if message["type"] == "http.response.body":
                 if message["body"].startswith(b"event: error"):
-                    await send(_SSE_ERROR_MESSAGE)
+                    # langserve raises the error after sending its event, which one to send depends on the error
+                    failed = True
                     return
             await send(message)
 
-        await self.app(scope, receive, intercept_sse_errors)
+        try:
+            await self.app(scope, receive, intercept_sse_errors)
+        except Exception as err:  # pylint: disable=broad-exception-caught # re-raised unless it is an overload
+            overload = _overload(err)
+            if not failed or overload is None:
+                if failed:
+                    await send(_SSE_ERROR_MESSAGE)
+                raise
+            await send(_sse_overloaded_message(overload))
+            return
+        if failed:
+            await send(_SSE_ERROR_MESSAGE)
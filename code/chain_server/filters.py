@@ -0,0 +1,129 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Structured filters on the metadata of the retrieved documents."""
+
+import hashlib
+import json
+import re
+from datetime import datetime, timezone
+from typing import Any, Collection, Optional
+
+from pydantic import BaseModel, Field
+
+# the limits of the tags stored with each document
+MAX_TAGS = 64
+MAX_TAG_LENGTH = 256
+_TAG_SEPARATORS_RE = re.compile(r"[,;]")
+
+
+class UnsupportedFilter(ValueError):
+    """A filter reads metadata fields that the searched documents do not have, so no document can match it."""
+
+
+def parse_tags(*texts: str | None) -> list[str]:
+    """Read the tags from comma or semicolon separated lists, like a PDF's keywords, keeping the first of repeats."""
+    tags = (tag.strip()[:MAX_TAG_LENGTH] for text in texts if text for tag in _TAG_SEPARATORS_RE.split(text))
+    return list(dict.fromkeys(tag for tag in tags if tag))[:MAX_TAGS]
+
+
+def _timestamp(moment: datetime) -> int:
+    """Convert a moment to Unix seconds, reading times without a time zone as UTC."""
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp())
+
+
+def _strings(values: list[str]) -> str:
+    """Format strings as a Milvus list literal, Milvus strings use the same escapes as JSON."""
+    return "[" + ", ".join(json.dumps(value) for value in values) + "]"
+
+
+class RetrievalFilter(BaseModel):
+    """Restrict the knowledge base search to documents whose metadata matches every given field."""
+
+    source: Optional[list[str]] = Field(None, description="The paths of the documents to search.")
+    simple_file_name: Optional[list[str]] = Field(None, description="The uploaded file names of the documents.")
+    tags: Optional[list[str]] = Field(None, description="Search the documents with any of these tags.")
+    after: Optional[datetime] = Field(None, description="Search the documents dated at or after this time.")
+    before: Optional[datetime] = Field(None, description="Search the documents dated at or before this time.")
+
+    @property
+    def fields(self) -> set[str]:
+        """The metadata fields the filter reads."""
+        names = {name for name in ("source", "simple_file_name", "tags") if getattr(self, name)}
+        if self.after is not None or self.before is not None:
+            names.add("date")
+        return names
+
+    @property
+    def key(self) -> str:
+        """A short, stable identifier of the filter."""
+        canonical = self.model_dump_json(exclude_none=True)
+        return hashlib.sha256(canonical.encode("UTF-8")).hexdigest()[:16]
+
+    def milvus_expr(self, fields: Collection[str]) -> str | None:
+        """Translate the filter into a Milvus boolean expression over the collection's scalar fields.
+
+        Raises `UnsupportedFilter` when the filter reads fields the collection does not have, since Milvus rejects the
+        expression and none of its documents could match.
+        """
+        missing = self.fields - set(fields)
+        if missing:
+            raise UnsupportedFilter(f"The collection has no {', '.join(sorted(missing))} field.")
+        clauses = []
+        for name in ("source", "simple_file_name"):
+            values = getattr(self, name)
+            if values:
+                clauses.append(f"{name} in {_strings(values)}")
+        if self.tags:
+            clauses.append(f"array_contains_any(tags, {_strings(self.tags)})")
+        if self.after is not None:
+            clauses.append(f"date >= {_timestamp(self.after)}")
+        if self.before is not None:
+            clauses.append(f"date <= {_timestamp(self.before)}")
+        return " and ".join(clauses) or None
+
+    def metadata_filter(self) -> dict[str, Any]:
+        """Translate the filter for the local vector index."""
+        local: dict[str, Any] = {}
+        for name in ("source", "simple_file_name", "tags"):
+            values = getattr(self, name)
+            if values:
+                local[name] = values
+        if self.after is not None or self.before is not None:
+            local["date"] = {
+                "min": None if self.after is None else _timestamp(self.after),
+                "max": None if self.before is None else _timestamp(self.before),
+            }
+        return local
+
+    def matches(self, metadata: dict[str, Any]) -> bool:
+        """Check a document's metadata, for results from indexes that can not filter themselves."""
+        for name in ("source", "simple_file_name"):
+            values = getattr(self, name)
+            if values and metadata.get(name) not in values:
+                return False
+        if self.tags and not set(self.tags).intersection(metadata.get("tags") or []):
+            return False
+        if self.after is not None or self.before is not None:
+            date = metadata.get("date")
+            if date is None:
+                return False
+            if self.after is not None and date < _timestamp(self.after):
+                return False
+            if self.before is not None and date > _timestamp(self.before):
+                return False
+        return True
@@ -0,0 +1,377 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Conversation memory with a bounded size."""
+
+import asyncio
+import json
+import logging
+import zlib
+from dataclasses import dataclass
+from typing import Any, Sequence
+
+import redis
+import redis.asyncio
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    SystemMessage,
+    get_buffer_string,
+    message_to_dict,
+    messages_from_dict,
+)
+from langchain_core.runnables import Runnable
+from redis.exceptions import WatchError
+
+from .tokens import estimate_tokens
+
+_LOGGER = logging.getLogger(__name__)
+KEY_PREFIX = "nim-anywhere:history:"
+_META_PREFIX = "nim-anywhere:history-meta:"
+# sessions written by langchain's RedisChatMessageHistory before the compact store, the sweeper lets them expire
+LEGACY_KEY_PREFIX = "message_store:"
+_SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+# the first byte of an encoded message holds its type, the high bit marks compressed content
+_TYPES: tuple[type[BaseMessage], ...] = (HumanMessage, AIMessage, SystemMessage)
+_JSON_TYPE = 0x7F
+_COMPRESSED = 0x80
+_COMPRESS_OVER = 256
+
+# references to the running background summaries so they are not garbage collected
+_BACKGROUND_TASKS: set[asyncio.Task[None]] = set()
+
+
+def _encode_message(message: BaseMessage) -> bytes:
+    """Pack a message into a type byte followed by its content.
+
+    Only the type and content of chat messages are kept, which is all the prompts use. Long content is compressed. Any
+    other message falls back to langchain's JSON encoding.
+    """
+    code = next((code for code, kind in enumerate(_TYPES) if isinstance(message, kind)), None)
+    if code is None or not isinstance(message.content, str):
+        return bytes([_JSON_TYPE]) + json.dumps(message_to_dict(message)).encode("UTF-8")
+    content = message.content.encode("UTF-8")
+    if len(content) > _COMPRESS_OVER:
+        compressed = zlib.compress(content)
+        if len(compressed) < len(content):
+            return bytes([code | _COMPRESSED]) + compressed
+    return bytes([code]) + content
+
+
+def _decode_message(raw: bytes) -> BaseMessage:
+    """Unpack a message stored by `_encode_message`."""
+    code, body = raw[0], raw[1:]
+    if code == _JSON_TYPE:
+        return messages_from_dict([json.loads(body)])[0]
+    if code & _COMPRESSED:
+        body = zlib.decompress(body)
+    return _TYPES[code & ~_COMPRESSED](content=body.decode("UTF-8"))
+
+
+@dataclass
+class StoredHistory:
+    """The most recent messages of a session, along with its summary.
+
+    `summarized` and `total` count every message the session ever stored, the first of `messages` is message number
+    `total - len(messages)`.
+    """
+
+    summary: str
+    summarized: int
+    total: int
+    messages: list[BaseMessage]
+
+    @property
+    def offset(self) -> int:
+        """The number of the first loaded message."""
+        return self.total - len(self.messages)
+
+    def since(self, start: int) -> list[BaseMessage]:
+        """The loaded messages from message number `start` onwards."""
+        return self.messages[max(start - self.offset, 0) :]
+
+
+class RedisMessageStore:
+    """The recent chat history of a session and its summary, stored compactly in Redis.
+
+    Messages are packed into a type byte and their (compressed) content and pushed onto a list that is trimmed to
+    `max_messages`, newest first. The summary, the number of messages it covers and the number of messages ever stored
+    are kept in a hash next to the list. Every read and write of a turn is a single transaction on the server's shared
+    connection pools, reads only fetch the messages they need, and both refresh the session's expiry so idle sessions
+    are evicted after `ttl` seconds.
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        client: redis.Redis,
+        async_client: redis.asyncio.Redis,
+        max_messages: int | None = None,
+        ttl: int | None = None,
+    ) -> None:
+        """Initialize the store."""
+        self.session_id = session_id
+        self.key = KEY_PREFIX + session_id
+        self.meta_key = _META_PREFIX + session_id
+        self._client = client
+        self._async_client = async_client
+        self._max_messages = max_messages
+        self._ttl = ttl
+
+    @staticmethod
+    def _decode(raw_meta: list[bytes | None], raw_messages: list[bytes]) -> StoredHistory:
+        """Parse the stored summary and messages."""
+        summary, summarized, total = raw_meta
+        return StoredHistory(
+            summary=summary.decode("UTF-8") if summary else "",
+            summarized=int(summarized or 0),
+            total=int(total or 0),
+            messages=[_decode_message(raw) for raw in reversed(raw_messages)],
+        )
+
+    def _queue_load(self, pipe: Any, count: int | None) -> None:
+        """Add the commands that read the latest `count` messages, or all of them, to a pipeline."""
+        pipe.hmget(self.meta_key, ["summary", "summarized", "total"])
+        pipe.lrange(self.key, 0, -1 if count is None else count - 1)
+        self._queue_expire(pipe)
+
+    def _queue_expire(self, pipe: Any) -> None:
+        """Add the commands that extend the session's lifetime to a pipeline."""
+        if self._ttl:
+            pipe.expire(self.key, self._ttl)
+            pipe.expire(self.meta_key, self._ttl)
+
+    def _queue_writes(self, pipe: Any, messages: Sequence[BaseMessage]) -> None:
+        """Add the commands that store new messages to a pipeline."""
+        pipe.lpush(self.key, *[_encode_message(message) for message in messages])
+        if self._max_messages:
+            pipe.ltrim(self.key, 0, self._max_messages - 1)
+        pipe.hincrby(self.meta_key, "total", len(messages))
+        self._queue_expire(pipe)
+
+    def _queue_summary(self, pipe: Any, summary: str, summarized: int) -> None:
+        """Add the commands that store a summary to a pipeline."""
+        pipe.hset(self.meta_key, mapping={"summary": summary, "summarized": summarized})
+        self._queue_expire(pipe)
+
+    def _queue_usage(self, pipe: Any) -> None:
+        """Add the commands that measure the session to a pipeline."""
+        pipe.hmget(self.meta_key, ["summarized", "total"])
+        pipe.llen(self.key)
+        pipe.ttl(self.key)
+        pipe.memory_usage(self.key)
+        pipe.memory_usage(self.meta_key)
+
+    def _usage(self, results: list[Any]) -> dict[str, Any]:
+        """Report the size of the session."""
+        (summarized, total), stored, ttl, *sizes = results
+        return {
+            "session_id": self.session_id,
+            "messages": int(total or 0),
+            "summarized": int(summarized or 0),
+            "stored": stored,
+            # some managed Redis services do not allow the MEMORY command
+            "bytes": None if any(isinstance(size, Exception) for size in sizes) else sum(size or 0 for size in sizes),
+            "ttl": ttl if ttl >= 0 else None,
+        }
+
+    # %% blocking interface
+    def load(self, count: int | None = None) -> StoredHistory:
+        """Read the summary and the latest `count` messages, or every stored message."""
+        with self._client.pipeline() as pipe:
+            self._queue_load(pipe, count)
+            return self._decode(*pipe.execute()[:2])
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """Append messages to the session."""
+        with self._client.pipeline() as pipe:
+            self._queue_writes(pipe, messages)
+            pipe.execute()
+
+    def save_summary(self, summary: str, summarized: int) -> None:
+        """Replace the session's summary."""
+        with self._client.pipeline() as pipe:
+            self._queue_summary(pipe, summary, summarized)
+            pipe.execute()
+
+    def clear(self) -> None:
+        """Remove the session."""
+        self._client.delete(self.key, self.meta_key)
+
+    def usage(self) -> dict[str, Any]:
+        """Report the number of messages of the session and the memory it uses in Redis."""
+        with self._client.pipeline(transaction=False) as pipe:
+            self._queue_usage(pipe)
+            return self._usage(pipe.execute(raise_on_error=False))
+
+    # %% asyncio interface
+    async def aload(self, count: int | None = None) -> StoredHistory:
+        """Read the summary and the latest `count` messages, or every stored message."""
+        async with self._async_client.pipeline() as pipe:
+            self._queue_load(pipe, count)
+            return self._decode(*(await pipe.execute())[:2])
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """Append messages to the session."""
+        async with self._async_client.pipeline() as pipe:
+            self._queue_writes(pipe, messages)
+            await pipe.execute()
+
+    async def asave_summary(self, summary: str, summarized: int) -> None:
+        """Replace the session's summary."""
+        async with self._async_client.pipeline() as pipe:
+            self._queue_summary(pipe, summary, summarized)
+            await pipe.execute()
+
+    async def aclear(self) -> None:
+        """Remove the session."""
+        await self._async_client.delete(self.key, self.meta_key)
+
+    async def ausage(self) -> dict[str, Any]:
+        """Report the number of messages of the session and the memory it uses in Redis."""
+        async with self._async_client.pipeline(transaction=False) as pipe:
+            self._queue_usage(pipe)
+            return self._usage(await pipe.execute(raise_on_error=False))
+
+    async def acompact(self) -> bool:
+        """Drop the stored messages that are already summarized and have left the window.
+
+        Returns False, leaving the session as it is, when the session was written to while it was being compacted.
+        """
+        async with self._async_client.pipeline() as pipe:
+            try:
+                await pipe.watch(self.meta_key)
+                summarized, total = await pipe.hmget(self.meta_key, ["summarized", "total"])
+                keep = int(total or 0) - int(summarized or 0)
+                pipe.multi()
+                if keep > 0:
+                    pipe.ltrim(self.key, 0, keep - 1)
+                else:
+                    pipe.delete(self.key)
+                await pipe.execute()
+            except WatchError:
+                return False
+        return True
+
+
+class BoundedChatMessageHistory(BaseChatMessageHistory):
+    """A chat history that only exposes a bounded window of the conversation.
+
+    Reading the history returns the turns that are not summarized yet verbatim, trimmed from the oldest if they would
+    exceed the token budget. Without a summarizer, that is the last `max_turns` turns. With one, the window grows to
+    `2 * max_turns` turns, and the next turn folds all but the last `max_turns` turns into a running summary. Between
+    folds the summary stays the same and the window only grows, so consecutive prompts of a session share their
+    history as a prefix, until a fold or the token budget trims the window. The summary is saved next to the session,
+    along with the number of messages it covers, and is returned as a system message in front of the window. Only the
+    window is read from the store to answer a question.
+    """
+
+    def __init__(
+        self,
+        store: RedisMessageStore,
+        summarizer: Runnable[dict[str, str], str] | None,
+        max_turns: int,
+        token_budget: int,
+    ) -> None:
+        """Initialize the history."""
+        self.store = store
+        self.summarizer = summarizer
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+
+    # %% reading
+    @property
+    def _window_size(self) -> int:
+        """The number of messages read from the store to build the window."""
+        turns = 2 * self.max_turns if self.summarizer is not None else self.max_turns
+        return max(2 * turns, 1)
+
+    def _window(self, stored: StoredHistory) -> list[BaseMessage]:
+        """Select the messages that are sent to the models."""
+        recent = stored.since(stored.summarized)[-self._window_size :] if self.max_turns else []
+
+        budget = self.token_budget - estimate_tokens(stored.summary)
+        window: list[BaseMessage] = []
+        for message in reversed(recent):
+            budget -= estimate_tokens(str(message.content))
+            if budget < 0:
+                break
+            window.insert(0, message)
+        # never start the window in the middle of a turn
+        if window and window[0].type != "human":
+            window.pop(0)
+
+        if stored.summary:
+            return [SystemMessage(content=_SUMMARY_PREFIX + stored.summary), *window]
+        return window
+
+    @property
+    def messages(self) -> list[BaseMessage]:  # type: ignore[override]
+        """The summary of the older turns followed by the most recent turns."""
+        return self._window(self.store.load(self._window_size))
+
+    async def aget_messages(self) -> list[BaseMessage]:
+        """The summary of the older turns followed by the most recent turns."""
+        return self._window(await self.store.aload(self._window_size))
+
+    # %% writing
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """Store new messages and fold the turns that left the window into the summary."""
+        self.store.add_messages(messages)
+        pending = self._pending_summary(self.store.load()) if self.summarizer is not None else None
+        if pending is not None and self.summarizer is not None:
+            summary, summarized, new_lines = pending
+            self.store.save_summary(self.summarizer.invoke({"summary": summary, "new_lines": new_lines}), summarized)
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """Store new messages and update the summary in the background."""
+        await self.store.aadd_messages(messages)
+        if self.summarizer is not None:
+            task = asyncio.create_task(self._asummarize())
+            _BACKGROUND_TASKS.add(task)
+            task.add_done_callback(_BACKGROUND_TASKS.discard)
+
+    def clear(self) -> None:
+        """Remove the conversation and its summary."""
+        self.store.clear()
+
+    async def aclear(self) -> None:
+        """Remove the conversation and its summary."""
+        await self.store.aclear()
+
+    # %% summarization
+    def _pending_summary(self, stored: StoredHistory) -> tuple[str, int, str] | None:
+        """Find the block of turns to fold once the window outgrows twice `max_turns` turns."""
+        if stored.total - stored.summarized <= 4 * self.max_turns:
+            return None
+        fold_until = stored.total - 2 * self.max_turns
+        # messages that were trimmed from the store before they were summarized are skipped
+        folded = stored.since(stored.summarized)[: fold_until - max(stored.summarized, stored.offset)]
+        return stored.summary, fold_until, get_buffer_string(folded)
+
+    async def _asummarize(self) -> None:
+        """Fold the messages that left the window into the summary."""
+        try:
+            pending = self._pending_summary(await self.store.aload())
+            if pending is None or self.summarizer is None:
+                return
+            summary, summarized, new_lines = pending
+            new_summary = await self.summarizer.ainvoke({"summary": summary, "new_lines": new_lines})
+            await self.store.asave_summary(new_summary, summarized)
+        except Exception:  # pylint: disable=broad-exception-caught # a failed summary must not fail the chat
+            _LOGGER.exception("Unable to summarize the chat history of session %s.", self.store.session_id)
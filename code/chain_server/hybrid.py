@@ -0,0 +1,337 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Hybrid retrieval that fuses a BM25 keyword index with the dense vector search."""
+
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import re
+from collections import Counter
+from typing import Any, Callable, Iterable, Sequence, cast
+
+import redis
+import redis.asyncio
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+from pydantic import ConfigDict
+from pymilvus import MilvusException
+
+from .vector_stores import iter_documents
+
+_LOGGER = logging.getLogger(__name__)
+_KEY_PREFIX = "nim-anywhere:sparse"
+# the keyword index can not filter, so filtered searches fetch more keyword matches to filter afterwards
+_FILTERED_OVERFETCH = 4
+# terms in more than this share of the documents are not scored once their postings exceed the read limit
+_COMMON_TERM_RATIO = 0.5
+# keep identifiers like nv-embedqa-e5-v5 or llama3.1 together as a single term
+_TERM_RE = re.compile(r"\w(?:[\w.\-]*\w)?")
+
+
+def tokenize(text: str) -> list[str]:
+    """Split text into lowercase terms."""
+    return _TERM_RE.findall(text.lower())
+
+
+def document_id(doc: Document) -> str:
+    """Identify a document by its vector store primary key, or by its content."""
+    if "pk" in doc.metadata:
+        return f"pk:{doc.metadata['pk']}"
+    return "sha256:" + hashlib.sha256(doc.page_content.encode("UTF-8")).hexdigest()
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Document]], k: int = 60) -> list[Document]:
+    """Merge ranked lists of documents, scoring each document by the sum of 1 / (k + rank)."""
+    scores: dict[str, float] = {}
+    documents: dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            doc_id = document_id(doc)
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1 / (k + rank)
+            documents.setdefault(doc_id, doc)
+    return [documents[doc_id] for doc_id in sorted(scores, key=scores.__getitem__, reverse=True)]
+
+
+class SparseIndex:
+    """A BM25 keyword index of a collection's documents, stored in Redis.
+
+    Documents are indexed during ingestion under the primary keys Milvus assigned to them, so keyword and vector
+    results refer to the same documents. Documents stored before the index existed are added with `backfill`. Each
+    term has a sorted set of the documents that contain it, scored by the term count, so a search reads no more than
+    the `max_postings` documents with the most occurrences of each term. Terms that are in most documents and have
+    more postings than that are skipped, since a few of their postings would not tell documents apart. A search takes
+    one round trip to load the postings, one for the lengths of the documents they name and one to load the best
+    documents.
+    """
+
+    def __init__(
+        self,
+        collection_name: str,
+        client: redis.Redis,
+        async_client: redis.asyncio.Redis | None = None,
+        *,
+        k1: float = 1.5,
+        b: float = 0.75,
+        max_postings: int = 1000,
+    ) -> None:
+        """Initialize the index."""
+        self._prefix = f"{_KEY_PREFIX}:{collection_name}"
+        self._client = client
+        self._async_client = async_client
+        self._k1 = k1
+        self._b = b
+        self._max_postings = max_postings
+
+    def _key(self, *parts: str) -> str:
+        """Build a key in the index's namespace."""
+        return ":".join((self._prefix, *parts))
+
+    # %% ingestion
+    def add_documents(self, documents: Sequence[Document], ids: Sequence[Any]) -> None:
+        """Index documents under their vector store primary keys."""
+        with self._client.pipeline(transaction=False) as pipe:
+            for pk, doc in zip(ids, documents):
+                doc_id = str(pk)
+                terms = Counter(tokenize(doc.page_content))
+                length = sum(terms.values())
+                for term, count in terms.items():
+                    pipe.zadd(self._key("postings", term), {doc_id: count})
+                if terms:
+                    pipe.sadd(self._key("terms", doc_id), *terms)
+                pipe.hset(self._key("lengths"), mapping={doc_id: length})
+                pipe.incrby(self._key("total_length"), length)
+                content = {"page_content": doc.page_content, "metadata": {**doc.metadata, "pk": pk}}
+                pipe.hset(self._key("documents"), doc_id, json.dumps(content))
+                if "simple_file_name" in doc.metadata:
+                    pipe.sadd(self._key("files", doc.metadata["simple_file_name"]), doc_id)
+            pipe.execute()
+
+    def backfill(self, batches: Iterable[Sequence[Document]]) -> int:
+        """Index the stored documents the index is missing, like those uploaded before hybrid search was enabled.
+
+        The documents must carry their vector store primary keys in the `pk` metadata field. Returns the number of
+        documents that were added.
+        """
+        added = 0
+        for batch in batches:
+            doc_ids = [str(doc.metadata["pk"]) for doc in batch]
+            if not doc_ids:
+                continue
+            lengths = cast(list[bytes | None], self._client.hmget(self._key("lengths"), doc_ids))
+            missing = [doc for doc, length in zip(batch, lengths) if length is None]
+            if missing:
+                self.add_documents(missing, [doc.metadata["pk"] for doc in missing])
+                added += len(missing)
+        return added
+
+    def clear(self) -> None:
+        """Remove every document from the index."""
+        keys = list(self._client.scan_iter(match=self._key("*"), count=1000))
+        for start in range(0, len(keys), 1000):
+            self._client.delete(*keys[start : start + 1000])
+
+    def delete_file(self, simple_file_name: str) -> None:
+        """Remove the documents that were uploaded from a file."""
+        files_key = self._key("files", simple_file_name)
+        doc_ids = [doc_id.decode("UTF-8") for doc_id in cast(set[bytes], self._client.smembers(files_key))]
+        if not doc_ids:
+            return
+        with self._client.pipeline(transaction=False) as pipe:
+            for doc_id in doc_ids:
+                pipe.smembers(self._key("terms", doc_id))
+            pipe.hmget(self._key("lengths"), doc_ids)
+            *doc_terms, lengths = pipe.execute()
+
+        with self._client.pipeline(transaction=False) as pipe:
+            for doc_id, terms in zip(doc_ids, doc_terms):
+                for term in terms:
+                    pipe.zrem(self._key("postings", term.decode("UTF-8")), doc_id)
+                pipe.delete(self._key("terms", doc_id))
+            pipe.hdel(self._key("lengths"), *doc_ids)
+            pipe.hdel(self._key("documents"), *doc_ids)
+            pipe.decrby(self._key("total_length"), sum(int(length or 0) for length in lengths))
+            pipe.delete(files_key)
+            pipe.execute()
+
+    # %% search
+    def _queue_postings(self, pipe: Any, terms: list[str]) -> None:
+        """Queue the commands that load the collection size and the best postings of the query terms."""
+        pipe.hlen(self._key("lengths"))
+        pipe.get(self._key("total_length"))
+        for term in terms:
+            pipe.zcard(self._key("postings", term))
+            pipe.zrevrange(self._key("postings", term), 0, self._max_postings - 1, withscores=True)
+
+    def _select(self, results: list[Any]) -> tuple[int, float, list[tuple[int, list[tuple[bytes, float]]]]]:
+        """Read the collection size, the average document length and the postings of the terms worth scoring."""
+        doc_count, total_length, *per_term = results
+        if not doc_count:
+            return 0, 1.0, []
+        postings = []
+        for frequency, posting in zip(per_term[::2], per_term[1::2]):
+            if frequency > self._max_postings and frequency > _COMMON_TERM_RATIO * doc_count:
+                continue
+            if posting:
+                postings.append((frequency, posting))
+        return doc_count, max(int(total_length or 0) / doc_count, 1.0), postings
+
+    @staticmethod
+    def _candidates(postings: list[tuple[int, list[tuple[bytes, float]]]]) -> list[bytes]:
+        """List the documents named by any of the postings."""
+        return sorted({doc_id for _, posting in postings for doc_id, _ in posting})
+
+    def _rank(
+        self,
+        doc_count: int,
+        avg_length: float,
+        postings: list[tuple[int, list[tuple[bytes, float]]]],
+        lengths: dict[bytes, bytes | None],
+        k: int,
+    ) -> list[str]:
+        """Score the documents that contain any of the query terms and return the ids of the best k."""
+        scores: dict[bytes, float] = {}
+        for frequency, posting in postings:
+            idf = math.log(1 + (doc_count - frequency + 0.5) / (frequency + 0.5))
+            for doc_id, count in posting:
+                # documents deleted since the postings were read have no length anymore
+                if lengths.get(doc_id) is None:
+                    continue
+                norm = self._k1 * (1 - self._b + self._b * int(lengths[doc_id] or 0) / avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * count * (self._k1 + 1) / (count + norm)
+        return [doc_id.decode("UTF-8") for doc_id in sorted(scores, key=scores.__getitem__, reverse=True)[:k]]
+
+    @staticmethod
+    def _documents(contents: list[bytes | None]) -> list[Document]:
+        """Rebuild the stored documents, skipping any that were deleted in the meantime."""
+        return [Document(**json.loads(content)) for content in contents if content is not None]
+
+    def search(self, query: str, k: int = 4) -> list[Document]:
+        """Find the k documents that best match the query's terms."""
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return []
+        with self._client.pipeline(transaction=False) as pipe:
+            self._queue_postings(pipe, terms)
+            doc_count, avg_length, postings = self._select(pipe.execute())
+        candidates = self._candidates(postings)
+        if not candidates:
+            return []
+        lengths = cast(list[bytes | None], self._client.hmget(self._key("lengths"), candidates))
+        doc_ids = self._rank(doc_count, avg_length, postings, dict(zip(candidates, lengths)), k)
+        if not doc_ids:
+            return []
+        return self._documents(cast(list[bytes | None], self._client.hmget(self._key("documents"), doc_ids)))
+
+    async def asearch(self, query: str, k: int = 4) -> list[Document]:
+        """Find the k documents that best match the query's terms."""
+        if self._async_client is None:
+            return await asyncio.get_running_loop().run_in_executor(None, self.search, query, k)
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return []
+        async with self._async_client.pipeline(transaction=False) as pipe:
+            self._queue_postings(pipe, terms)
+            doc_count, avg_length, postings = self._select(await pipe.execute())
+        candidates = self._candidates(postings)
+        if not candidates:
+            return []
+        lengths = await self._async_client.hmget(self._key("lengths"), candidates)  # type: ignore[misc]
+        doc_ids = self._rank(doc_count, avg_length, postings, dict(zip(candidates, lengths)), k)
+        if not doc_ids:
+            return []
+        contents = await self._async_client.hmget(self._key("documents"), doc_ids)  # type: ignore[misc]
+        return self._documents(cast(list[bytes | None], contents))
+
+
+def backfill_sparse_index(vector_store: VectorStore, sparse_index: SparseIndex) -> None:
+    """Keyword index the documents that were stored before hybrid search was enabled."""
+    try:
+        added = sparse_index.backfill(iter_documents(vector_store))
+    except (redis.RedisError, MilvusException) as err:
+        _LOGGER.warning("Unable to backfill the keyword index, only the vector search finds older documents: %s", err)
+        return
+    if added:
+        _LOGGER.info("Added %d stored documents to the keyword index.", added)
+
+
+class HybridRetriever(BaseRetriever):
+    """Run the dense and keyword searches side by side and merge their rankings with reciprocal rank fusion.
+
+    Search arguments, like a metadata filter, are passed on to the dense search. Keyword matches are checked against
+    the metadata with the `keyword_filter` argument instead.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    dense: BaseRetriever
+    sparse: SparseIndex
+    k: int = 4
+    rrf_k: int = 60
+
+    def _fuse(
+        self,
+        dense: list[Document],
+        sparse: list[Document],
+        keyword_filter: Callable[[dict[str, Any]], bool] | None,
+    ) -> list[Document]:
+        """Merge the rankings, dropping the keyword matches that fail the filter."""
+        if keyword_filter is not None:
+            sparse = [doc for doc in sparse if keyword_filter(doc.metadata)][: self.k]
+        return reciprocal_rank_fusion([dense, sparse], self.rrf_k)[: self.k]
+
+    def _get_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun,
+        keyword_filter: Callable[[dict[str, Any]], bool] | None = None,
+        **kwargs: Any,
+    ) -> list[Document]:
+        """Search both indexes and fuse the results."""
+        dense = self.dense.invoke(query, {"callbacks": run_manager.get_child()}, **kwargs)
+        try:
+            sparse = self.sparse.search(query, self.k * _FILTERED_OVERFETCH if keyword_filter else self.k)
+        except redis.RedisError as err:
+            _LOGGER.warning("Keyword search failed, using the vector search results only: %s", err)
+            sparse = []
+        return self._fuse(dense, sparse, keyword_filter)
+
+    async def _aget_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: AsyncCallbackManagerForRetrieverRun,
+        keyword_filter: Callable[[dict[str, Any]], bool] | None = None,
+        **kwargs: Any,
+    ) -> list[Document]:
+        """Search both indexes concurrently and fuse the results."""
+        dense, sparse = await asyncio.gather(
+            self.dense.ainvoke(query, {"callbacks": run_manager.get_child()}, **kwargs),
+            self.sparse.asearch(query, self.k * _FILTERED_OVERFETCH if keyword_filter else self.k),
+            return_exceptions=True,
+        )
+        if isinstance(dense, BaseException):
+            raise dense
+        if isinstance(sparse, BaseException):
+            if not isinstance(sparse, redis.RedisError):
+                raise sparse
+            _LOGGER.warning("Keyword search failed, using the vector search results only: %s", sparse)
+            sparse = []
+        return self._fuse(dense, sparse, keyword_filter)
@@ -0,0 +1,218 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Latency and throughput metrics for each stage of the chain, exported to Prometheus and OpenTelemetry."""
+
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import BaseMessageChunk
+from opentelemetry import trace
+from prometheus_client import Counter, Gauge, Histogram
+
+from .tokens import estimate_tokens
+
+_LABELS = ("use_kb", "use_reranker")
+_TOKEN_RATE_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500)
+
+STAGE_SECONDS = Histogram(
+    "nim_anywhere_stage_seconds",
+    "The time spent in each stage of the chain.",
+    ("stage", *_LABELS),
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "nim_anywhere_time_to_first_token_seconds",
+    "The time from sending the prompt to the LLM until its first token arrives.",
+    _LABELS,
+)
+TOKENS_PER_SECOND = Histogram(
+    "nim_anywhere_generation_tokens_per_second",
+    "The rate at which the LLM streams answer tokens after the first one.",
+    _LABELS,
+    buckets=_TOKEN_RATE_BUCKETS,
+)
+PROMPT_TOKENS = Counter("nim_anywhere_prompt_tokens", "The tokens sent to the LLM to answer questions.", _LABELS)
+COMPLETION_TOKENS = Counter("nim_anywhere_completion_tokens", "The tokens the LLM generated as answers.", _LABELS)
+CONDENSE_DECISIONS = Counter(
+    "nim_anywhere_condense_decisions",
+    "How follow up questions were handled: skipped as standalone, answered from the cache, or condensed.",
+    ("decision",),
+)
+QUEUE_SECONDS = Histogram(
+    "nim_anywhere_queue_seconds", "The time calls waited for a free slot of an upstream service.", ("upstream",)
+)
+IN_FLIGHT = Gauge(
+    "nim_anywhere_in_flight_calls",
+    "The calls an upstream service is handling.",
+    ("upstream",),
+    multiprocess_mode="livesum",
+)
+REJECTED = Counter(
+    "nim_anywhere_rejected_calls", "The calls turned away because an upstream service was overloaded.", ("upstream",)
+)
+EVENT_LOOP_LAG = Histogram(
+    "nim_anywhere_event_loop_lag_seconds",
+    "How late the server's event loop woke up from a timer, a measure of blocking work on the loop.",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+STARTUP_SECONDS = Gauge(
+    "nim_anywhere_startup_seconds",
+    "The time each phase of the server's cold start took: booting the process, connecting and warming up.",
+    ("phase",),
+    multiprocess_mode="max",
+)
+HISTORY_SESSIONS = Gauge(
+    "nim_anywhere_history_sessions",
+    "The chat sessions stored in Redis, as of the latest sweep.",
+    multiprocess_mode="mostrecent",
+)
+HISTORY_BYTES = Gauge(
+    "nim_anywhere_history_bytes",
+    "The memory the stored chat sessions use in Redis, as of the latest sweep.",
+    multiprocess_mode="mostrecent",
+)
+
+_tracer = trace.get_tracer(__name__)
+# the retrieval settings of the request being handled, set once at the start of every request
+_request_labels: ContextVar[dict[str, str]] = ContextVar("request_labels", default={"use_kb": "", "use_reranker": ""})
+# the seconds spent in each stage of the request being handled
+_request_timings: ContextVar[dict[str, float] | None] = ContextVar("request_timings", default=None)
+
+
+def start_request(use_kb: bool, use_reranker: bool) -> dict[str, float]:
+    """Label the metrics of the current request with its retrieval settings and collect its stage timings."""
+    _request_labels.set({"use_kb": str(use_kb).lower(), "use_reranker": str(use_reranker).lower()})
+    timings: dict[str, float] = {}
+    _request_timings.set(timings)
+    return timings
+
+
+def _record(stage_name: str, seconds: float) -> None:
+    """Add the time spent in a stage to the current request's timings."""
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage_name] = timings.get(stage_name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name: str) -> Iterator[trace.Span]:
+    """Time a stage of the chain and trace it as a span."""
+    labels = _request_labels.get()
+    with _tracer.start_as_current_span(name, attributes=labels) as span:
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            elapsed = time.perf_counter() - start
+            STAGE_SECONDS.labels(stage=name, **labels).observe(elapsed)
+            _record(name, elapsed)
+
+
+# pylint: disable-next=too-many-instance-attributes # the labels, span, clock and counts of one stream
+class GenerationTimer:
+    """Measure the time to first token, token rate and token counts of a streamed LLM answer.
+
+    The span of the generation is not made current, so it can be ended from whichever context consumes the stream.
+    Used as a context manager, the totals are recorded even if the stream fails or its consumer stops reading it.
+    """
+
+    def __init__(self, prompt: str) -> None:
+        """Start timing as the prompt is sent."""
+        self._labels = _request_labels.get()
+        self._timings = _request_timings.get()
+        self._prompt_tokens = estimate_tokens(prompt)
+        self._usage: dict[str, Any] | None = None
+        self._text: list[str] = []
+        self._span = _tracer.start_span("generation", attributes=self._labels)
+        self._start = time.perf_counter()
+        self._first_token: float | None = None
+
+    def observe(self, chunk: BaseMessageChunk) -> None:
+        """Record a streamed chunk."""
+        if self._first_token is None and chunk.content:
+            self._first_token = time.perf_counter()
+            TIME_TO_FIRST_TOKEN.labels(**self._labels).observe(self._first_token - self._start)
+            if self._timings is not None:
+                self._timings["time_to_first_token"] = self._first_token - self._start
+            self._span.add_event("first_token")
+        self._text.append(str(chunk.content))
+        # the NVIDIA endpoints report the exact token usage on the last chunk of the stream
+        usage = getattr(chunk, "usage_metadata", None)
+        if usage:
+            self._usage = dict(usage)
+
+    def __enter__(self) -> "GenerationTimer":
+        """Time the stream in a block."""
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, exc: BaseException | None, traceback: Any) -> None:
+        """Record the totals of the stream, and mark the span if it ended early."""
+        if exc is not None:
+            self._span.set_attribute("completed", False)
+            if isinstance(exc, Exception):
+                self._span.record_exception(exc)
+                self._span.set_status(trace.Status(trace.StatusCode.ERROR, str(exc)))
+        self.finish()
+
+    def finish(self) -> None:
+        """Record the totals once the stream is complete."""
+        end = time.perf_counter()
+        completion = "".join(self._text)
+        prompt_tokens = self._usage["input_tokens"] if self._usage else self._prompt_tokens
+        completion_tokens = self._usage["output_tokens"] if self._usage else estimate_tokens(completion)
+        PROMPT_TOKENS.labels(**self._labels).inc(prompt_tokens)
+        COMPLETION_TOKENS.labels(**self._labels).inc(completion_tokens)
+        STAGE_SECONDS.labels(stage="generation", **self._labels).observe(end - self._start)
+        if self._timings is not None:
+            self._timings["generation"] = end - self._start
+        if self._first_token is not None and completion_tokens > 1 and end > self._first_token:
+            TOKENS_PER_SECOND.labels(**self._labels).observe((completion_tokens - 1) / (end - self._first_token))
+        self._span.set_attributes({"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens})
+        self._span.end()
+
+
+class TimedEmbeddings(Embeddings):
+    """Time the query embeddings of an embedding model as the chain's embedding stage."""
+
+    def __init__(self, embeddings: Embeddings) -> None:
+        """Initialize the wrapper."""
+        self.embeddings = embeddings
+
+    def embed_query(self, text: str) -> list[float]:
+        """Embed a query."""
+        with stage("embed"):
+            return self.embeddings.embed_query(text)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        """Embed a query."""
+        with stage("embed"):
+            return await self.embeddings.aembed_query(text)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """Embed documents for storage."""
+        return self.embeddings.embed_documents(texts)
+
+
+async def monitor_event_loop(interval: float = 0.1) -> None:
+    """Measure the event loop's lag by sleeping for a fixed interval and recording how late it wakes up."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(loop.time() - start - interval, 0.0))
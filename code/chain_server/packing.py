@@ -0,0 +1,114 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Packing of retrieved documents into a bounded prompt context."""
+
+import re
+import zlib
+from typing import Iterator, Sequence
+
+import numpy as np
+from langchain_core.documents import Document
+
+from .tokens import estimate_tokens, max_chars
+
+_WORD_RE = re.compile(r"\w+")
+_PARAGRAPH_RE = re.compile(r"\n\s*\n")
+# the number of hashed features used to compare chunks
+_FEATURES = 4096
+
+
+def _ranked(docs: Sequence[Document]) -> list[Document]:
+    """Order documents by their reranker score, or keep the retriever's order when they are not scored."""
+    if docs and all("relevance_score" in doc.metadata for doc in docs):
+        return sorted(docs, key=lambda doc: -float(doc.metadata["relevance_score"]))
+    return list(docs)
+
+
+def _chunks(text: str, chunk_tokens: int) -> list[str]:
+    """Split a document into chunks of whole paragraphs, cutting paragraphs that are too long at whitespace."""
+    limit = max_chars(chunk_tokens)
+    pieces = []
+    for paragraph in _PARAGRAPH_RE.split(text.strip()):
+        while len(paragraph) > limit:
+            cut = paragraph.rfind(" ", 0, limit)
+            cut = cut if cut > 0 else limit
+            pieces.append(paragraph[:cut].strip())
+            paragraph = paragraph[cut:]
+        if paragraph.strip():
+            pieces.append(paragraph.strip())
+
+    chunks: list[str] = []
+    for piece in pieces:
+        if chunks and len(chunks[-1]) + len(piece) + 2 <= limit:
+            chunks[-1] += "\n\n" + piece
+        else:
+            chunks.append(piece)
+    return chunks
+
+
+def _fingerprint(chunk: str) -> np.ndarray:
+    """Represent a chunk as a unit length vector of hashed word pair counts."""
+    vector = np.zeros(_FEATURES, dtype=np.float32)
+    words = _WORD_RE.findall(chunk.lower())
+    pairs = [f"{first} {second}" for first, second in zip(words, words[1:])] or words
+    np.add.at(vector, [zlib.crc32(pair.encode("UTF-8")) % _FEATURES for pair in pairs], 1)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _candidates(docs: Sequence[Document], chunk_tokens: int) -> Iterator[tuple[tuple[str, int], str]]:
+    """Chunk the documents in ranking order, one document at a time, keyed by their source and position."""
+    for doc in _ranked(docs):
+        source = str(doc.metadata.get("source", ""))
+        for position, chunk in enumerate(_chunks(doc.page_content, chunk_tokens)):
+            yield (source, position), chunk
+
+
+def pack_documents(
+    docs: Sequence[Document],
+    token_budget: int,
+    duplicate_threshold: float,
+    chunk_tokens: int,
+    stable_order: bool = False,
+) -> list[str]:
+    """Select the chunks of the retrieved documents that fit in the context's token budget.
+
+    Chunks are taken in ranking order. A chunk is dropped when it is nearly identical to one that was already taken,
+    and packing stops at the first chunk that would exceed the budget. Documents are chunked and fingerprinted as they
+    are reached, and each chunk is only compared to the packed ones, so the work ends with the budget. With
+    `stable_order`, the packed chunks are sorted by their source and position instead of their rank, so the same chunks
+    always serialize identically.
+    """
+    packed: list[tuple[tuple[str, int], str]] = []
+    # the fingerprints of the packed chunks, grown by doubling
+    fingerprints = np.zeros((8, _FEATURES), dtype=np.float32)
+    used = 0
+    for key, chunk in _candidates(docs, chunk_tokens):
+        fingerprint = _fingerprint(chunk)
+        if packed and (fingerprints[: len(packed)] @ fingerprint).max() >= duplicate_threshold:
+            continue
+        used += estimate_tokens(chunk)
+        if used > token_budget:
+            break
+        if len(packed) == len(fingerprints):
+            fingerprints = np.concatenate([fingerprints, np.zeros_like(fingerprints)])
+        fingerprints[len(packed)] = fingerprint
+        packed.append((key, chunk))
+        if used == token_budget:
+            break
+    if stable_order:
+        packed.sort()
+    return [chunk for _, chunk in packed]
@@ -32,6 +32,18 @@ CONDENSE_QUESTION_TEMPLATE = PromptTemplate.from_template(
     Standalone question:"""
 )
 
+SUMMARIZE_HISTORY_TEMPLATE = PromptTemplate.from_template(
+    """Progressively summarize the lines of conversation provided,
+    adding onto the previous summary and returning a new summary.
+    Keep it brief, but keep every name, number and fact the user may refer back to.
+    Don't frame your response.
+    Current summary:
+    {summary}
+    New lines of conversation:
+    {new_lines}
+    New summary:"""
+)
+
 
 # Primary Chat Prompt template
 CHAT_PROMPT = ChatPromptTemplate.from_messages(
@@ -45,3 +57,22 @@ CHAT_PROMPT = ChatPromptTemplate.from_messages(
         ("human", "{question}"),
     ]
 )
+
+# Chat prompt that keeps the instructions and the history in front, so consecutive turns of a session share a prompt
+# prefix that the LLM can reuse from its prefix cache. The retrieved context changes with every question, so it is
+# sent along with the latest question instead. The history summary is only rewritten when a block of turns is folded
+# into it, so the prefix only breaks at those folds, or when the token budget trims the oldest turns.
+PREFIX_CACHED_CHAT_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "You're an honest and helpful assistant. Answer the question to the best of your ability, "
+            "based on the context that is provided with it.",
+        ),
+        MessagesPlaceholder(variable_name="history"),
+        ("human", "Context:\n{context}\n\nQuestion: {question}"),
+    ]
+)
+
+# the chat prompt of each context layout
+CHAT_PROMPTS = {"system": CHAT_PROMPT, "question": PREFIX_CACHED_CHAT_PROMPT}
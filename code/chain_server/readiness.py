@@ -0,0 +1,114 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Readiness probes of the chain server's dependencies and the timing of its cold start."""
+
+import asyncio
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Awaitable, Callable
+
+from .metrics import STARTUP_SECONDS
+
+_LOGGER = logging.getLogger(__name__)
+
+Probe = Callable[[], Awaitable[None]]
+
+
+@dataclass
+class ProbeResult:
+    """The outcome of the latest probe of a dependency."""
+
+    ready: bool
+    latency: float
+    checked_at: float
+    error: str | None = None
+
+
+def process_age() -> float | None:
+    """The seconds since the server's process started, on platforms with a /proc file system."""
+    try:
+        with open("/proc/uptime", "r", encoding="UTF-8") as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+        with open("/proc/self/stat", "r", encoding="UTF-8") as stat_file:
+            stat = stat_file.read()
+    except OSError:
+        return None
+    # the start time is the 22nd field, counted in clock ticks since boot, the command name may contain spaces
+    started = int(stat.rsplit(")", 1)[1].split()[19]) / os.sysconf("SC_CLK_TCK")
+    return uptime - started
+
+
+class Readiness:
+    """Probe the server's dependencies in the background and keep the latest results for the readiness endpoint.
+
+    The server is ready once its clients are connected and warmed up and the latest probe of every dependency
+    succeeded. Requests to the readiness endpoint never wait on a dependency, they report the cached results.
+    """
+
+    def __init__(self, probes: dict[str, Probe], interval: float, timeout: float) -> None:
+        """Initialize the probes. No dependency is ready before it is first probed."""
+        self._probes = probes
+        self._interval = interval
+        self._timeout = timeout
+        self.results: dict[str, ProbeResult] = {}
+        self.warm = False
+        self.startup: dict[str, float] = {}
+
+    def record_phase(self, phase: str, seconds: float) -> None:
+        """Record how long a phase of the cold start took."""
+        self.startup[phase] = seconds
+        STARTUP_SECONDS.labels(phase=phase).set(seconds)
+
+    async def _probe(self, name: str, probe: Probe) -> None:
+        """Run one probe and store its result."""
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(probe(), self._timeout)
+        except Exception as err:  # pylint: disable=broad-exception-caught # any failure means not ready
+            error = str(err) or type(err).__name__
+            # failures are expected while the server is starting, only report the dependencies that went away
+            if self.warm and self.results.get(name, ProbeResult(True, 0, 0)).ready:
+                _LOGGER.warning("The %s dependency is not ready: %s", name, error)
+            self.results[name] = ProbeResult(False, time.perf_counter() - start, time.time(), error)
+        else:
+            self.results[name] = ProbeResult(True, time.perf_counter() - start, time.time())
+
+    async def probe_all(self) -> None:
+        """Probe every dependency concurrently."""
+        await asyncio.gather(*(self._probe(name, probe) for name, probe in self._probes.items()))
+
+    async def run(self) -> None:
+        """Probe the dependencies until cancelled."""
+        while True:
+            await self.probe_all()
+            await asyncio.sleep(self._interval)
+
+    @property
+    def ready(self) -> bool:
+        """Whether the server should receive traffic."""
+        return self.warm and len(self.results) == len(self._probes) and all(r.ready for r in self.results.values())
+
+    @property
+    def report(self) -> dict[str, Any]:
+        """Describe the readiness of the server and of every dependency."""
+        return {
+            "ready": self.ready,
+            "warm": self.warm,
+            "dependencies": {name: asdict(result) for name, result in self.results.items()},
+            "startup_seconds": self.startup,
+        }
@@ -0,0 +1,145 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reload the configuration when its files change and swap in new clients while requests finish on the old ones."""
+
+import asyncio
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import AsyncIterator, Callable, Generic, Iterator, TypeVar
+
+from confz import FileSource
+
+from .configuration import Configuration
+
+_LOGGER = logging.getLogger(__name__)
+_ClientsT = TypeVar("_ClientsT")
+
+
+def config_files() -> list[Path]:
+    """List the files the configuration may be loaded from, whether or not they exist yet."""
+    paths = []
+    for source in Configuration.CONFIG_SOURCES or []:  # type: ignore[union-attr]
+        if not isinstance(source, FileSource):
+            continue
+        if isinstance(source.file, (str, os.PathLike)):
+            paths.append(Path(source.file).expanduser())
+        elif source.file_from_env and os.environ.get(source.file_from_env):
+            paths.append(Path(os.environ[source.file_from_env]).expanduser())
+    return paths
+
+
+def _fingerprint(paths: list[Path]) -> list[tuple[int, int] | None]:
+    """Identify the version of every file by its modification time and size."""
+    fingerprint: list[tuple[int, int] | None] = []
+    for path in paths:
+        try:
+            stat = path.stat()
+        except OSError:
+            fingerprint.append(None)
+        else:
+            fingerprint.append((stat.st_mtime_ns, stat.st_size))
+    return fingerprint
+
+
+async def watch_config(interval: float) -> AsyncIterator[Configuration]:
+    """Load the configuration again every time one of its files changes.
+
+    A configuration that fails to load or validate is logged and skipped, the next change to the files is tried again.
+    """
+    paths = config_files()
+    seen = _fingerprint(paths)
+    while True:
+        await asyncio.sleep(interval)
+        current = _fingerprint(paths)
+        if current == seen:
+            continue
+        seen = current
+        try:
+            config = Configuration(config_sources=Configuration.CONFIG_SOURCES)
+        except Exception as err:  # pylint: disable=broad-exception-caught # a bad edit must not stop the server
+            _LOGGER.error("Ignoring the changed configuration files, they are not valid: %s", err)
+            continue
+        yield config
+
+
+class NotReady(Exception):
+    """The clients have not been connected yet."""
+
+
+class HotSwap(Generic[_ClientsT]):
+    """Hold the current version of the clients, closing a replaced version once its last request is done.
+
+    The holder starts out empty, the first version is swapped in once it has connected.
+    """
+
+    def __init__(self, close: Callable[[_ClientsT], None]) -> None:
+        """Initialize the empty holder."""
+        self._current: _ClientsT | None = None
+        self._close = close
+        self._lock = threading.Lock()
+        self._in_use: dict[int, int] = {}
+        self._retired: dict[int, _ClientsT] = {}
+        self.version = 0
+
+    @property
+    def ready(self) -> bool:
+        """Whether any version of the clients has been swapped in."""
+        return self._current is not None
+
+    @property
+    def current(self) -> _ClientsT:
+        """The clients new requests should use."""
+        if self._current is None:
+            raise NotReady("The chain server is still connecting to its dependencies.")
+        return self._current
+
+    @contextmanager
+    def use(self) -> Iterator[_ClientsT]:
+        """Use the current clients for the duration of a request, they are not closed before it is done."""
+        with self._lock:
+            clients = self.current
+            self._in_use[id(clients)] = self._in_use.get(id(clients), 0) + 1
+        try:
+            yield clients
+        finally:
+            with self._lock:
+                remaining = self._in_use.pop(id(clients)) - 1
+                if remaining:
+                    self._in_use[id(clients)] = remaining
+                drained = None if remaining else self._retired.pop(id(clients), None)
+            if drained is not None:
+                self._close(drained)
+
+    def swap(self, clients: _ClientsT) -> None:
+        """Make new requests use the new clients and close the old ones once their requests are done."""
+        with self._lock:
+            old, self._current = self._current, clients
+            self.version += 1
+            busy = id(old) in self._in_use
+            if busy and old is not None:
+                self._retired[id(old)] = old
+        if not busy and old is not None:
+            self._close(old)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Report the current version and the requests still using replaced versions."""
+        with self._lock:
+            draining = sum(self._in_use.get(key, 0) for key in self._retired)
+            return {"version": self.version, "retired": len(self._retired), "draining_requests": draining}
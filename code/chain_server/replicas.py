@@ -0,0 +1,126 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load balancing across the replicas of a model API."""
+
+import itertools
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Sequence
+
+_LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class Replica:
+    """One endpoint serving a model, with its current load and health."""
+
+    url: str
+    outstanding: int = 0
+    requests: int = 0
+    failures: int = 0
+    ejected_until: float = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        """Whether the replica may receive requests."""
+        return self.ejected_until <= time.monotonic()
+
+
+class ReplicaSet:
+    """The replicas of a model API, balanced by least outstanding requests.
+
+    Requests are addressed to the primary URL that the model client is configured with, and are sent to the healthy
+    replica with the fewest requests in flight. Ties are broken in turn so an idle set is used round robin. Replicas
+    that fail a request or a health check are ejected for `eject_seconds`; when every replica is ejected, the least
+    loaded one is used anyway.
+    """
+
+    def __init__(self, urls: Sequence[str], eject_seconds: float, hedge_after: float | None = None) -> None:
+        """Initialize the set. The first URL is the primary URL."""
+        self.primary = urls[0].rstrip("/")
+        self.replicas = [Replica(url) for url in dict.fromkeys(url.rstrip("/") for url in urls)]
+        self.eject_seconds = eject_seconds
+        self.hedge_after = hedge_after
+        self.hedged = 0
+        self._lock = threading.Lock()
+        self._turn = itertools.count()
+
+    def matches(self, url: str) -> bool:
+        """Whether a request URL is addressed to this set."""
+        return url == self.primary or url.startswith(self.primary + "/")
+
+    def route(self, url: str, replica: Replica) -> str:
+        """Readdress a request URL to a replica."""
+        return replica.url + url[len(self.primary) :]
+
+    def acquire(self, exclude: Replica | None = None) -> Replica | None:
+        """Choose the replica for a request and count it as outstanding."""
+        with self._lock:
+            candidates = [replica for replica in self.replicas if replica is not exclude]
+            if not candidates:
+                return None
+            candidates = [replica for replica in candidates if replica.healthy] or candidates
+            offset = next(self._turn)
+            replica = min(
+                candidates,
+                key=lambda r: (r.outstanding, (self.replicas.index(r) - offset) % len(self.replicas)),
+            )
+            replica.outstanding += 1
+            replica.requests += 1
+            return replica
+
+    def release(self, replica: Replica) -> None:
+        """Count a request as finished."""
+        with self._lock:
+            replica.outstanding -= 1
+
+    def count_hedge(self) -> None:
+        """Count a request that was raced against a second replica."""
+        with self._lock:
+            self.hedged += 1
+
+    def eject(self, replica: Replica, reason: Any) -> None:
+        """Stop sending requests to a failing replica for a while."""
+        with self._lock:
+            replica.failures += 1
+            if replica.healthy and len(self.replicas) > 1:
+                _LOGGER.warning("Ejecting %s for %ss: %s", replica.url, self.eject_seconds, reason)
+            replica.ejected_until = time.monotonic() + self.eject_seconds
+
+    def restore(self, replica: Replica) -> None:
+        """Return a replica that passed a health check to the rotation."""
+        with self._lock:
+            if not replica.healthy:
+                _LOGGER.info("Restoring %s", replica.url)
+            replica.ejected_until = 0.0
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        """Report the load and health of every replica."""
+        return {
+            "hedged": self.hedged,
+            "replicas": {
+                replica.url: {
+                    "healthy": replica.healthy,
+                    "outstanding": replica.outstanding,
+                    "requests": replica.requests,
+                    "failures": replica.failures,
+                }
+                for replica in self.replicas
+            },
+        }
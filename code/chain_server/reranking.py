@@ -0,0 +1,227 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A reranking service that batches and caches relevance scores."""
+
+import asyncio
+import hashlib
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional, Sequence, cast
+
+import redis
+import redis.asyncio
+from langchain_core.callbacks import Callbacks
+from langchain_core.documents import BaseDocumentCompressor, Document
+from langchain_core.runnables.config import run_in_executor
+from langchain_nvidia_ai_endpoints import NVIDIARerank
+from pydantic import ConfigDict, PrivateAttr
+from redis.exceptions import RedisError
+
+_LOGGER = logging.getLogger(__name__)
+_KEY_PREFIX = "nim-anywhere:rerank"
+_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+
+Scorer = Callable[[str, list[str]], list[float]]
+
+
+def nvidia_passage_scorer(model: NVIDIARerank) -> Scorer:
+    """Score every passage against a query.
+
+    `NVIDIARerank.compress_documents` only returns the `top_n` passages of each request, so passages are scored
+    through the model's ranking call directly to get a score for all of them.
+    """
+    scorer = model.model_copy(update={"top_n": model.max_batch_size})
+
+    def _score(query: str, passages: list[str]) -> list[float]:
+        scores = [0.0] * len(passages)
+        for start in range(0, len(passages), model.max_batch_size):
+            # pylint: disable-next=protected-access # the raw rankings are only exposed through the private method
+            for ranking in scorer._rank(passages[start : start + model.max_batch_size], query):
+                scores[start + ranking.index] = ranking.logit
+        return scores
+
+    return _score
+
+
+@dataclass
+class _PendingBatch:
+    """Passages waiting to be scored against the same query."""
+
+    query: str
+    future: asyncio.Future[dict[str, float]]
+    passages: dict[str, str] = field(default_factory=dict)
+
+
+class RerankService(BaseDocumentCompressor):
+    """Rerank documents with cached and batched relevance scores.
+
+    Scores are cached in Redis for every pair of query and document. Queries are compared after lowercasing and
+    removing punctuation and extra whitespace, documents by their Milvus primary key or by a hash of their content.
+    Only the documents without a cached score are sent to the reranking model.
+
+    Concurrent requests that rerank documents for the same query within `max_wait` seconds are coalesced into a
+    single request containing the union of their uncached documents.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    scorer: Scorer
+    model: str
+    top_n: int
+    client: redis.Redis
+    async_client: redis.asyncio.Redis
+    max_wait: float
+    ttl: int
+
+    _pending: dict[str, _PendingBatch] = PrivateAttr(default_factory=dict)
+    _tasks: set[asyncio.Task[None]] = PrivateAttr(default_factory=set)
+    _counts: dict[str, int] = PrivateAttr(
+        default_factory=lambda: {"requests": 0, "cached_pairs": 0, "uncached_pairs": 0, "batches": 0, "scored_pairs": 0}
+    )
+
+    # %% keys
+    def _key(self, query: str) -> str:
+        """Build the Redis key holding a query's document scores."""
+        canonical = " ".join(_PUNCTUATION_RE.sub(" ", query.lower()).split())
+        return f"{_KEY_PREFIX}:{self.model}:{hashlib.sha256(canonical.encode('UTF-8')).hexdigest()}"
+
+    @staticmethod
+    def _document_id(document: Document) -> str:
+        """Identify a document by its primary key, or by its content if it has none."""
+        if "pk" in document.metadata:
+            return f"pk:{document.metadata['pk']}"
+        return f"sha256:{hashlib.sha256(document.page_content.encode('UTF-8')).hexdigest()}"
+
+    # %% results
+    def _select(self, documents: list[Document], ids: list[str], scores: dict[str, float]) -> list[Document]:
+        """Order the documents by score and keep the best."""
+        ranked = sorted(zip(documents, ids), key=lambda pair: scores[pair[1]], reverse=True)[: self.top_n]
+        for document, doc_id in ranked:
+            document.metadata["relevance_score"] = scores[doc_id]
+        return [document for document, _ in ranked]
+
+    def _count(self, **counts: int) -> None:
+        """Update the statistics."""
+        for name, value in counts.items():
+            self._counts[name] += value
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        """Report how many scores were served from the cache and how many requests were sent."""
+        counts = dict(self._counts)
+        pairs = counts["cached_pairs"] + counts["uncached_pairs"]
+        return {**counts, "cache_hit_rate": counts["cached_pairs"] / pairs if pairs else 0.0}
+
+    @staticmethod
+    def _decode(ids: list[str], raw: list[Any]) -> dict[str, float]:
+        """Parse the cached scores that were found."""
+        return {doc_id: float(score) for doc_id, score in zip(ids, raw) if score is not None}
+
+    # %% blocking interface
+    def compress_documents(
+        self, documents: Sequence[Document], query: str, callbacks: Optional[Callbacks] = None
+    ) -> Sequence[Document]:
+        """Rerank documents, only scoring the pairs that are not cached."""
+        docs = list(documents)
+        if not docs or self.top_n < 1:
+            return []
+        ids = [self._document_id(doc) for doc in docs]
+        key = self._key(query)
+
+        try:
+            scores = self._decode(ids, cast(list[Any], self.client.hmget(key, ids)))
+        except RedisError as err:
+            _LOGGER.warning("The rerank cache is unavailable: %s", err)
+            scores = {}
+        missing = {doc_id: doc.page_content for doc_id, doc in zip(ids, docs) if doc_id not in scores}
+        self._count(requests=1, cached_pairs=len(docs) - len(missing), uncached_pairs=len(missing))
+
+        if missing:
+            self._count(batches=1, scored_pairs=len(missing))
+            new_scores = dict(zip(missing, self.scorer(query, list(missing.values()))))
+            scores.update(new_scores)
+            try:
+                with self.client.pipeline(transaction=False) as pipe:
+                    pipe.hset(key, mapping=new_scores)
+                    pipe.expire(key, self.ttl)
+                    pipe.execute()
+            except RedisError as err:
+                _LOGGER.warning("The rerank cache is unavailable: %s", err)
+
+        return self._select(docs, ids, scores)
+
+    # %% asyncio interface
+    async def acompress_documents(
+        self, documents: Sequence[Document], query: str, callbacks: Optional[Callbacks] = None
+    ) -> Sequence[Document]:
+        """Rerank documents, only scoring the pairs that are not cached or being scored for another request."""
+        docs = list(documents)
+        if not docs or self.top_n < 1:
+            return []
+        ids = [self._document_id(doc) for doc in docs]
+        key = self._key(query)
+
+        try:
+            scores = self._decode(ids, await self.async_client.hmget(key, ids))
+        except RedisError as err:
+            _LOGGER.warning("The rerank cache is unavailable: %s", err)
+            scores = {}
+        missing = {doc_id: doc.page_content for doc_id, doc in zip(ids, docs) if doc_id not in scores}
+        self._count(requests=1, cached_pairs=len(docs) - len(missing), uncached_pairs=len(missing))
+
+        if missing:
+            scores.update(await self._ascore(key, query, missing))
+        return self._select(docs, ids, scores)
+
+    async def _ascore(self, key: str, query: str, passages: dict[str, str]) -> dict[str, float]:
+        """Add passages to the query's pending batch and wait for their scores."""
+        loop = asyncio.get_running_loop()
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = _PendingBatch(query, loop.create_future())
+            loop.call_later(self.max_wait, self._flush, key)
+        batch.passages.update(passages)
+        scores = await asyncio.shield(batch.future)
+        return {doc_id: scores[doc_id] for doc_id in passages}
+
+    def _flush(self, key: str) -> None:
+        """Start scoring a query's pending batch."""
+        batch = self._pending.pop(key)
+        task = asyncio.get_running_loop().create_task(self._run(key, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key: str, batch: _PendingBatch) -> None:
+        """Score a batch, hand out the results and cache them."""
+        self._count(batches=1, scored_pairs=len(batch.passages))
+        ids = list(batch.passages)
+        try:
+            scores = dict(
+                zip(ids, await run_in_executor(None, self.scorer, batch.query, list(batch.passages.values())))
+            )
+        except Exception as err:  # pylint: disable=broad-exception-caught # the error is raised to every caller
+            batch.future.set_exception(err)
+            return
+        batch.future.set_result(scores)
+
+        try:
+            async with self.async_client.pipeline(transaction=False) as pipe:
+                pipe.hset(key, mapping=scores)
+                pipe.expire(key, self.ttl)
+                await pipe.execute()
+        except RedisError as err:
+            _LOGGER.warning("The rerank cache is unavailable: %s", err)
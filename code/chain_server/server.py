@@ -15,24 +15,166 @@
 
 """The definition of the NVIDIA Conversational RAG API server."""
 
+import asyncio
+import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Any, AsyncIterator
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware import Middleware
-from fastapi.responses import PlainTextResponse, RedirectResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, Response
 from langserve import add_routes
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest, multiprocess
 
 from . import errors
-from .chain import my_chain  # type: ignore
+from .admission import AdmissionMiddleware, Overloaded, overloaded_response
+from .batching import BatchedEmbeddings
+from .cache import CachedEmbeddings
+from .metrics import monitor_event_loop
+from .reranking import RerankService
+from .chain import (  # type: ignore
+    chain_clients,
+    connect,
+    http_pool,
+    my_chain,
+    redis_pools,
+    reload_clients,
+    upstreams,
+    warm_up,
+)
+from .configuration import config as app_config
+from .history import RedisMessageStore
+from .readiness import Readiness, process_age
+from .reload import NotReady
+from .sweeper import HistorySweeper
+from .vector_stores import ping
 
 PROXY_PREFIX = os.environ.get("PROXY_PREFIX", None)
+_LOGGER = logging.getLogger(__name__)
+
+
+# %% readiness probes of the dependencies
+def _current_config() -> Any:
+    """The configuration of the current clients, or the startup configuration before they connect."""
+    return chain_clients.current.config if chain_clients.ready else app_config
+
+
+async def _probe_redis() -> None:
+    """Ping Redis through the shared pool."""
+    await redis_pools.async_client.ping()
+
+
+def _model_probe(name: str) -> Any:
+    """Probe a model by listing the models its API serves."""
+
+    async def _probe() -> None:
+        url = str(getattr(_current_config(), name).url).rstrip("/")
+        get = partial(http_pool.session.get, f"{url}/models", timeout=app_config.readiness.probe_timeout)
+        response = await asyncio.get_running_loop().run_in_executor(None, get)
+        response.raise_for_status()
+
+    return _probe
+
+
+async def _probe_vector_store() -> None:
+    """Read the vector store's collection list, or the local index's files."""
+    await asyncio.get_running_loop().run_in_executor(None, ping, chain_clients.current.vector_store)
+
+
+readiness = Readiness(
+    {
+        "redis": _probe_redis,
+        "llm": _model_probe("llm_model"),
+        "embedding": _model_probe("embedding_model"),
+        "reranking": _model_probe("reranking_model"),
+        "vector_store": _probe_vector_store,
+    },
+    interval=app_config.readiness.probe_interval,
+    timeout=app_config.readiness.probe_timeout,
+)
+history_sweeper = HistorySweeper(
+    redis_pools.client,
+    redis_pools.async_client,
+    ttl=app_config.history.ttl,
+    interval=app_config.history.sweep_interval,
+)
+
+
+async def start_chain() -> None:
+    """Connect and warm up the chain's clients, retrying until the dependencies can be reached."""
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    while True:
+        try:
+            clients = await loop.run_in_executor(None, connect)
+            break
+        except Exception as err:  # pylint: disable=broad-exception-caught # keep serving the health checks
+            _LOGGER.error("Unable to connect the chain's clients, retrying: %s", err)
+            await asyncio.sleep(app_config.readiness.probe_interval)
+    readiness.record_phase("connect", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    model_urls = clients.model_urls + http_pool.urls
+    await loop.run_in_executor(None, http_pool.warm, model_urls, app_config.http_pool.warm_connections)
+    http_pool.start_health_checks()
+    if app_config.readiness.warm_up:
+        try:
+            await warm_up(clients)
+        except Exception as err:  # pylint: disable=broad-exception-caught # the probes report the failing dependency
+            _LOGGER.warning("Unable to warm up the chain: %s", err)
+    readiness.record_phase("warm_up", time.perf_counter() - start)
+    await readiness.probe_all()
+    readiness.warm = True
+    total = process_age()
+    if total is not None:
+        readiness.record_phase("total", total)
+
+    if app_config.reload.enabled:
+        await reload_clients(app_config.reload.interval)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    """Manage the resources shared by all of the server's requests.
+
+    The clients are connected in the background, the server answers its health checks while they connect.
+    """
+    boot = process_age()
+    if boot is not None:
+        readiness.record_phase("boot", boot)
+    # blocking client calls are offloaded to the default executor, size it for many concurrent sessions
+    executor = ThreadPoolExecutor(max_workers=app_config.worker_threads, thread_name_prefix="chain-worker")
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(executor)
+    background = [
+        asyncio.create_task(monitor_event_loop()),
+        asyncio.create_task(start_chain()),
+        asyncio.create_task(readiness.run()),
+        asyncio.create_task(history_sweeper.run()),
+    ]
+    yield
+    for task in background:
+        task.cancel()
+    await redis_pools.aclose()
+    http_pool.close()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
 app = FastAPI(
     title="NVIDIA Conversational RAG",
     version="0.1.0",
     description="More advanced conversational RAG using NVIDIA components.",
     root_path=PROXY_PREFIX or "",
-    middleware=[Middleware(errors.ErrorHandlerMiddleware)],
+    middleware=[
+        Middleware(errors.ErrorHandlerMiddleware),
+        Middleware(AdmissionMiddleware, upstreams=upstreams),
+    ],
+    lifespan=lifespan,
 )
 
 
@@ -42,6 +184,22 @@ add_routes(
 )
 
 
+@app.exception_handler(Overloaded)
+async def overloaded(_: Request, err: Overloaded) -> Response:
+    """Ask the client to retry later when an upstream call waited too long for a slot."""
+    return overloaded_response(err, 503)
+
+
+@app.exception_handler(NotReady)
+async def not_ready(_: Request, err: NotReady) -> Response:
+    """Ask the client to retry once the server has connected to its dependencies."""
+    return JSONResponse(
+        {"status_code": 503, "message": str(err)},
+        status_code=503,
+        headers={"Retry-After": str(round(app_config.readiness.probe_interval))},
+    )
+
+
 # add a health check
 @app.get("/healthz", response_class=PlainTextResponse)
 def healthz() -> str:
@@ -49,6 +207,56 @@ def healthz() -> str:
     return "success"
 
 
+@app.get("/readyz")
+def readyz() -> JSONResponse:
+    """Report whether the server is warmed up and its dependencies answered their latest probes."""
+    return JSONResponse(readiness.report, status_code=200 if readiness.ready else 503)
+
+
+def _embedding_stats(wrapper: type[Any]) -> dict[str, Any] | None:
+    """Find a wrapper around the embedding model and report its statistics."""
+    model: Any = chain_clients.current.embedding_model if chain_clients.ready else None
+    while model is not None:
+        if isinstance(model, wrapper):
+            return model.stats
+        model = getattr(model, "embeddings", None)
+    return None
+
+
+@app.get("/stats")
+def stats() -> dict[str, Any]:
+    """Report on the server's caches and connection pools."""
+    reranker = chain_clients.current.reranker if chain_clients.ready else None
+    return {
+        "http_pool": http_pool.stats,
+        "replicas": http_pool.replica_stats,
+        "redis_pool": redis_pools.stats,
+        "embedding_cache": _embedding_stats(CachedEmbeddings),
+        "embedding_batching": _embedding_stats(BatchedEmbeddings),
+        "reranking": reranker.stats if isinstance(reranker, RerankService) else None,
+        "upstreams": upstreams.stats,
+        "clients": chain_clients.stats,
+        "history": history_sweeper.report(),
+    }
+
+
+@app.get("/stats/history/{session_id}")
+def session_stats(session_id: str) -> dict[str, Any]:
+    """Report on the messages of a chat session and the memory it uses in Redis."""
+    return RedisMessageStore(session_id, redis_pools.client, redis_pools.async_client).usage()
+
+
+@app.get("/metrics", response_class=Response)
+def metrics() -> Response:
+    """Export the per-stage latency and token metrics in the Prometheus format."""
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # the server runs as several workers, combine the metrics every worker wrote to the shared directory
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get("/", response_class=RedirectResponse)
 def root() -> str:
     """Handle requests to the root directory."""
@@ -0,0 +1,79 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Coalesce streamed LLM chunks into larger frames to cut the per event overhead of the SSE stream."""
+
+import asyncio
+from typing import AsyncIterator
+
+from langchain_core.messages import BaseMessageChunk
+
+
+async def coalesce(
+    chunks: AsyncIterator[BaseMessageChunk], window: float, frame_chars: int
+) -> AsyncIterator[BaseMessageChunk]:
+    """Merge streamed chunks into frames that are sent once they hold `frame_chars` or have waited `window` seconds.
+
+    The first chunk with content is sent on its own as soon as it arrives, so the time to first token is unaffected.
+    A frame is flushed when its window ends even if the model has stalled, so coalescing never delays text by more than
+    the window.
+    """
+    iterator = aiter(chunks)
+    async for chunk in iterator:
+        yield chunk
+        if chunk.content:
+            break
+    async for frame in _frames(iterator, window, frame_chars):
+        yield frame
+
+
+async def _frames(
+    iterator: AsyncIterator[BaseMessageChunk], window: float, frame_chars: int
+) -> AsyncIterator[BaseMessageChunk]:
+    """Merge the chunks into frames, flushing them by size or when their window ends."""
+    loop = asyncio.get_running_loop()
+    pending: asyncio.Future[BaseMessageChunk] | None = None
+    frame: BaseMessageChunk | None = None
+    deadline = 0.0
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(anext(iterator))
+            if frame is not None:
+                done, _ = await asyncio.wait({pending}, timeout=max(deadline - loop.time(), 0.0))
+                if not done:
+                    yield frame
+                    frame = None
+                    continue
+            try:
+                chunk = await pending
+            except StopAsyncIteration:
+                break
+            finally:
+                pending = None
+
+            if frame is None:
+                frame = chunk
+                deadline = loop.time() + window
+            else:
+                frame = frame + chunk
+            if len(frame.content) >= frame_chars:
+                yield frame
+                frame = None
+        if frame is not None:
+            yield frame
+    finally:
+        if pending is not None:
+            pending.cancel()
@@ -0,0 +1,167 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A background sweep that keeps the chat histories stored in Redis small."""
+
+import asyncio
+import heapq
+import json
+import logging
+import time
+from typing import Any, AsyncIterator, cast
+
+import redis
+import redis.asyncio
+from redis.exceptions import RedisError
+
+from .history import KEY_PREFIX, LEGACY_KEY_PREFIX, RedisMessageStore
+from .metrics import HISTORY_BYTES, HISTORY_SESSIONS
+
+_LOGGER = logging.getLogger(__name__)
+_SWEEP_LOCK = "nim-anywhere:history-sweep"
+_USAGE_KEY = "nim-anywhere:history-usage"
+
+
+class HistorySweeper:
+    """Compact the stored sessions in the background, evict stale keys and measure the memory the sessions use.
+
+    Every sweep trims the sessions down to the messages that are not summarized yet, gives keys without an expiry the
+    session lifetime, deletes message lists whose summary has expired and tallies the memory used per session and in
+    total. Every server worker runs a sweeper, a lock in Redis lets only one of them sweep in each interval. The latest
+    report is saved in Redis so that any worker can serve it.
+    """
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        async_client: redis.asyncio.Redis,
+        ttl: int | None,
+        interval: float,
+        largest: int = 10,
+    ) -> None:
+        """Initialize the sweeper."""
+        self._client = client
+        self._async_client = async_client
+        self._ttl = ttl
+        self._interval = interval
+        self._largest = largest
+
+    async def _scan(self, prefix: str) -> AsyncIterator[list[bytes]]:
+        """Iterate over the keys with a prefix in batches."""
+        cursor = 0
+        while True:
+            cursor, keys = await self._async_client.scan(cursor, match=prefix + "*", count=500)
+            if keys:
+                yield keys
+            if not cursor:
+                return
+
+    async def _measure(self, keys: list[bytes]) -> list[tuple[RedisMessageStore, dict[str, Any]]]:
+        """Measure a batch of sessions in one round trip."""
+        stores = [
+            RedisMessageStore(key.decode("UTF-8").removeprefix(KEY_PREFIX), self._client, self._async_client)
+            for key in keys
+        ]
+        async with self._async_client.pipeline(transaction=False) as pipe:
+            for store in stores:
+                store._queue_usage(pipe)  # pylint: disable=protected-access # the sweeper measures the stores
+            results = await pipe.execute(raise_on_error=False)
+        step = len(results) // max(len(stores), 1)
+        return [
+            (store, store._usage(results[step * index : step * (index + 1)]))  # pylint: disable=protected-access
+            for index, store in enumerate(stores)
+        ]
+
+    async def _sweep_session(self, store: RedisMessageStore, usage: dict[str, Any], counts: dict[str, int]) -> bool:
+        """Compact and expire a session, returns False if the session was evicted."""
+        if not usage["messages"]:
+            # the message count expired or was removed, the messages can not be placed in the conversation anymore
+            await self._async_client.delete(store.key)
+            counts["evicted"] += 1
+            return False
+        if usage["ttl"] is None and self._ttl:
+            async with self._async_client.pipeline(transaction=False) as pipe:
+                pipe.expire(store.key, self._ttl)
+                pipe.expire(store.meta_key, self._ttl)
+                await pipe.execute()
+            counts["expired"] += 1
+        if usage["stored"] > usage["messages"] - usage["summarized"] and await store.acompact():
+            counts["compacted"] += 1
+        return True
+
+    async def _expire_legacy(self, counts: dict[str, int]) -> None:
+        """Give the sessions stored before the compact store an expiry, so they are eventually evicted."""
+        if not self._ttl:
+            return
+        async for keys in self._scan(LEGACY_KEY_PREFIX):
+            async with self._async_client.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.expire(key, self._ttl, nx=True)
+                counts["expired"] += sum(await pipe.execute())
+
+    async def sweep(self) -> dict[str, Any]:
+        """Sweep every session once and report on the memory they use."""
+        counts = {"compacted": 0, "expired": 0, "evicted": 0}
+        report: dict[str, Any] = {"sessions": 0, "messages": 0, "stored": 0, "bytes": 0}
+        largest: list[tuple[int, str]] = []
+
+        async for keys in self._scan(KEY_PREFIX):
+            for store, usage in await self._measure(keys):
+                compacted = counts["compacted"]
+                if not await self._sweep_session(store, usage, counts):
+                    continue
+                if counts["compacted"] > compacted:
+                    usage = await store.ausage()
+                report["sessions"] += 1
+                report["messages"] += usage["messages"]
+                report["stored"] += usage["stored"]
+                if usage["bytes"] is None or report["bytes"] is None:
+                    report["bytes"] = None
+                    continue
+                report["bytes"] += usage["bytes"]
+                heapq.heappush(largest, (usage["bytes"], store.session_id))
+                if len(largest) > self._largest:
+                    heapq.heappop(largest)
+        await self._expire_legacy(counts)
+
+        report["largest"] = [
+            {"session_id": session_id, "bytes": size} for size, session_id in sorted(largest, reverse=True)
+        ]
+        report.update(counts, swept_at=time.time())
+        HISTORY_SESSIONS.set(report["sessions"])
+        if report["bytes"] is not None:
+            HISTORY_BYTES.set(report["bytes"])
+        await self._async_client.set(_USAGE_KEY, json.dumps(report), ex=round(3 * self._interval))
+        return report
+
+    async def run(self) -> None:
+        """Sweep the sessions in every interval."""
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                if await self._async_client.set(_SWEEP_LOCK, 1, nx=True, ex=max(round(self._interval), 1)):
+                    report = await self.sweep()
+                    _LOGGER.debug("Swept the chat histories: %s", report)
+            except RedisError as err:
+                _LOGGER.warning("Unable to sweep the chat histories: %s", err)
+
+    def report(self) -> dict[str, Any] | None:
+        """The latest report of any worker's sweep, if there was one."""
+        try:
+            raw = cast(bytes | None, self._client.get(_USAGE_KEY))
+        except RedisError as err:
+            _LOGGER.warning("The chat history report is unavailable: %s", err)
+            return None
+        return json.loads(raw) if raw else None
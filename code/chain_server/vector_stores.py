@@ -0,0 +1,494 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The vector store backends that hold the knowledge base."""
+
+import fcntl
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, Sequence, cast
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from langchain_milvus.vectorstores.milvus import Milvus
+from pymilvus import DataType, MilvusException
+
+from .configuration import Configuration
+from .filters import MAX_TAG_LENGTH, MAX_TAGS, RetrievalFilter
+
+_LOGGER = logging.getLogger(__name__)
+_MANIFEST = "documents.json"
+_MIN_CAPACITY = 1024
+# rows scored per matrix product, bounds the float32 copies made of float16 matrices
+_BLOCK_ROWS = 65536
+# the scalar fields that retrieval filters read, and the Milvus index that serves each of them
+_SCALAR_INDEXES = {"source": "INVERTED", "simple_file_name": "INVERTED", "tags": "INVERTED", "date": "STL_SORT"}
+# langchain stores the page content of Milvus documents in this field, the other scalar fields are the metadata
+_MILVUS_TEXT_FIELD = "text"
+_MILVUS_VECTOR_TYPES = {
+    DataType.FLOAT_VECTOR,
+    DataType.FLOAT16_VECTOR,
+    DataType.BFLOAT16_VECTOR,
+    DataType.BINARY_VECTOR,
+    DataType.SPARSE_FLOAT_VECTOR,
+}
+
+MetadataFilter = dict[str, Any]
+
+
+def _normalize(vectors: Sequence[Sequence[float]]) -> np.ndarray:
+    """Convert embeddings to unit length float32 rows."""
+    arr = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+    norms = np.linalg.norm(arr, axis=1, keepdims=True)
+    return arr / np.where(norms == 0, 1, norms)
+
+
+# pylint: disable-next=too-many-instance-attributes,abstract-method # no maximal marginal relevance search
+class LocalVectorStore(VectorStore):
+    """An in-process vector index stored as memory-mapped NumPy matrices.
+
+    A collection is a directory holding a `.npy` matrix of unit length embeddings and a JSON manifest listing the
+    documents in row order. Searches score the mapped matrix with a matrix product, so only the pages that are read are
+    loaded into memory. Writers append to the matrix in place, or write a new matrix when it is full or rows are
+    deleted, and then atomically replace the manifest. Readers in other processes pick up the new manifest on their
+    next search.
+
+    Metadata filters select the rows whose metadata fields equal one of the given values, or, for list fields, contain
+    one of them. A `{"min": ..., "max": ...}` value selects a range instead. When `ann` is set, searches
+    without a filter on collections of at least `ann_min_documents` rows use an HNSW graph from the optional `hnswlib`
+    package instead of scanning every row.
+    """
+
+    # pylint: disable-next=too-many-arguments # the index options are set once at startup
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        path: str | Path,
+        collection_name: str,
+        *,
+        dtype: str = "float32",
+        ann: bool = False,
+        ann_min_documents: int = 10000,
+        ann_ef: int = 64,
+    ) -> None:
+        """Initialize the store."""
+        self.embedding_function = embedding_function
+        self._dir = Path(path).joinpath(collection_name)
+        self._dtype = np.dtype(dtype)
+        self._ann = ann
+        self._ann_min_documents = ann_min_documents
+        self._ann_ef = ann_ef
+        if ann:
+            # pylint: disable-next=import-outside-toplevel,unused-import,import-error # optional dependency
+            import hnswlib  # noqa: F401
+
+        self._lock = threading.RLock()
+        self._stamp: tuple[int, int] | None = None
+        self._manifest: dict[str, Any] = {"vectors": None, "next_pk": 1, "documents": []}
+        self._vectors: np.ndarray | None = None
+        self._columns: dict[str, np.ndarray] = {}
+        self._graph: Any = None
+        self._graph_rows = 0
+
+    @property
+    def embeddings(self) -> Embeddings:
+        """Access the query embedding object."""
+        return self.embedding_function
+
+    @property
+    def _documents(self) -> list[dict[str, Any]]:
+        """The stored documents in row order."""
+        return self._manifest["documents"]
+
+    # %% reading the collection
+    def ping(self) -> None:
+        """Check that the collection's files can be read."""
+        with self._lock:
+            self._refresh()
+
+    def iter_documents(self, batch_size: int = 1000) -> Iterator[list[Document]]:
+        """Read every stored document in batches, with its primary key in the `pk` metadata field."""
+        with self._lock:
+            self._refresh()
+            documents = self._documents
+        for start in range(0, len(documents), batch_size):
+            yield [self._document(doc) for doc in documents[start : start + batch_size]]
+
+    @staticmethod
+    def _document(doc: dict[str, Any]) -> Document:
+        """Rebuild a stored document, with its primary key in the `pk` metadata field."""
+        return Document(page_content=doc["page_content"], metadata={**doc["metadata"], "pk": doc["pk"]})
+
+    def _refresh(self) -> None:
+        """Reload the collection if another writer replaced its manifest."""
+        manifest_path = self._dir.joinpath(_MANIFEST)
+        for _ in range(3):
+            try:
+                stat = manifest_path.stat()
+            except FileNotFoundError:
+                return
+            if (stat.st_mtime_ns, stat.st_ino) == self._stamp:
+                return
+            try:
+                with open(manifest_path, "r", encoding="UTF-8") as manifest_file:
+                    manifest = json.load(manifest_file)
+                vectors = np.load(self._dir.joinpath(manifest["vectors"]), mmap_mode="r")
+            except FileNotFoundError:
+                # the writer removed the files between the reads, try the newer manifest
+                continue
+            if manifest["vectors"] != self._manifest["vectors"]:
+                self._graph = None
+            self._manifest, self._vectors, self._stamp = manifest, vectors, (stat.st_mtime_ns, stat.st_ino)
+            self._columns = {}
+            return
+
+    def _column(self, field: str) -> np.ndarray:
+        """The values of a metadata field in row order."""
+        if field not in self._columns:
+            self._columns[field] = np.fromiter(
+                (doc["metadata"].get(field) for doc in self._documents), dtype=object, count=len(self._documents)
+            )
+        return self._columns[field]
+
+    def _mask(self, metadata_filter: MetadataFilter) -> np.ndarray:
+        """Select the rows whose metadata matches every field of the filter."""
+        mask = np.ones(len(self._documents), dtype=bool)
+        for field, values in metadata_filter.items():
+            column = self._column(field)
+            if isinstance(values, dict):
+                low, high = values.get("min"), values.get("max")
+                mask &= np.fromiter(
+                    (
+                        value is not None and (low is None or value >= low) and (high is None or value <= high)
+                        for value in column
+                    ),
+                    dtype=bool,
+                    count=len(column),
+                )
+                continue
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            if any(isinstance(value, list) for value in column):
+                wanted = set(values)
+                mask &= np.fromiter(
+                    (not wanted.isdisjoint(value or []) for value in column), dtype=bool, count=len(column)
+                )
+            else:
+                mask &= np.isin(column, list(values))
+        return mask
+
+    @staticmethod
+    def _scores(vectors: np.ndarray, rows: np.ndarray | None, count: int, query: np.ndarray) -> np.ndarray:
+        """Score rows against the query, in blocks so float16 matrices are never copied whole."""
+        if rows is not None:
+            return np.concatenate(
+                [
+                    vectors[rows[start : start + _BLOCK_ROWS]].astype(np.float32) @ query
+                    for start in range(0, len(rows), _BLOCK_ROWS)
+                ]
+                or [np.empty(0, dtype=np.float32)]
+            )
+        return np.concatenate(
+            [
+                vectors[start : min(start + _BLOCK_ROWS, count)].astype(np.float32) @ query
+                for start in range(0, count, _BLOCK_ROWS)
+            ]
+        )
+
+    def _graph_search(self, query: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Find the approximate nearest rows with the HNSW graph, adding any rows appended since it was built."""
+        # pylint: disable-next=import-outside-toplevel,import-error # optional dependency, checked in __init__
+        import hnswlib
+
+        assert self._vectors is not None
+        count = len(self._documents)
+        if self._graph is None:
+            self._graph = hnswlib.Index(space="ip", dim=self._vectors.shape[1])
+            self._graph.init_index(max_elements=self._vectors.shape[0], ef_construction=200, M=16)
+            self._graph_rows = 0
+        if self._graph_rows < count:
+            if self._graph.get_max_elements() < count:
+                self._graph.resize_index(self._vectors.shape[0])
+            new_rows = np.arange(self._graph_rows, count)
+            self._graph.add_items(self._vectors[self._graph_rows : count].astype(np.float32), new_rows)
+            self._graph_rows = count
+        self._graph.set_ef(max(self._ann_ef, k))
+        labels, distances = self._graph.knn_query(query, k=k)
+        # inner product distances are 1 - similarity
+        return labels[0].astype(np.int64), 1 - distances[0]
+
+    def _search(
+        self, embedding: list[float], k: int, metadata_filter: MetadataFilter | None
+    ) -> list[tuple[Document, float]]:
+        """Find the k rows most similar to an embedding."""
+        query = _normalize([embedding])[0]
+        with self._lock:
+            self._refresh()
+            count = len(self._documents)
+            if self._vectors is None or not count or k <= 0:
+                return []
+            if metadata_filter:
+                rows: np.ndarray | None = np.flatnonzero(self._mask(metadata_filter))
+                scores = self._scores(self._vectors, rows, count, query)
+            elif self._ann and count >= self._ann_min_documents:
+                rows, scores = self._graph_search(query, min(k, count))
+            else:
+                rows = None
+                scores = self._scores(self._vectors, None, count, query)
+            documents = self._documents
+
+        best = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+        best = best[np.argsort(-scores[best])]
+        results = []
+        for position in best:
+            doc = documents[int(rows[position]) if rows is not None else int(position)]
+            results.append((self._document(doc), float(scores[position])))
+        return results
+
+    # %% writing the collection
+    @contextmanager
+    def _writing(self) -> Iterator[None]:
+        """Hold the collection's write lock, shared with writers in other processes."""
+        self._dir.mkdir(parents=True, exist_ok=True)
+        with self._lock, open(self._dir.joinpath(".lock"), "w", encoding="UTF-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _new_matrix(self, rows: int, dim: int) -> tuple[str, np.memmap]:
+        """Create the next generation of the vector matrix with room for at least the given rows."""
+        generation = int(self._manifest.get("generation", 0)) + 1
+        name = f"vectors-{generation}.npy"
+        matrix = np.lib.format.open_memmap(
+            self._dir.joinpath(name), mode="w+", dtype=self._dtype, shape=(max(2 * rows, _MIN_CAPACITY), dim)
+        )
+        self._manifest["generation"] = generation
+        return name, matrix
+
+    def _publish(self, vectors_name: str, documents: list[dict[str, Any]]) -> None:
+        """Atomically replace the manifest and remove matrices that are no longer referenced."""
+        manifest = {**self._manifest, "vectors": vectors_name, "documents": documents}
+        tmp_path = self._dir.joinpath(f".{_MANIFEST}.tmp")
+        with open(tmp_path, "w", encoding="UTF-8") as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(tmp_path, self._dir.joinpath(_MANIFEST))
+        for old in self._dir.glob("vectors-*.npy"):
+            if old.name != vectors_name:
+                old.unlink(missing_ok=True)
+        self._stamp = None
+        self._refresh()
+
+    def add_embeddings(
+        self, texts: Sequence[str], embeddings: Sequence[Sequence[float]], metadatas: Sequence[dict] | None = None
+    ) -> list[int]:
+        """Store texts with their embeddings and return their primary keys."""
+        if not texts:
+            return []
+        new_vectors = _normalize(embeddings)
+        with self._writing():
+            count = len(self._documents)
+            current = self._vectors
+            if current is None or current.shape[0] < count + len(texts) or current.shape[1] != new_vectors.shape[1]:
+                if current is not None and count and current.shape[1] != new_vectors.shape[1]:
+                    raise ValueError(
+                        f"Embeddings have {new_vectors.shape[1]} dimensions, the collection has {current.shape[1]}."
+                    )
+                vectors_name, matrix = self._new_matrix(count + len(texts), new_vectors.shape[1])
+                if current is not None and count:
+                    matrix[:count] = current[:count]
+            else:
+                vectors_name = self._manifest["vectors"]
+                matrix = cast(np.memmap, np.load(self._dir.joinpath(vectors_name), mmap_mode="r+"))
+            matrix[count : count + len(texts)] = new_vectors
+            matrix.flush()
+
+            first_pk = int(self._manifest["next_pk"])
+            pks = list(range(first_pk, first_pk + len(texts)))
+            self._manifest["next_pk"] = first_pk + len(texts)
+            documents = self._documents + [
+                {"pk": pk, "page_content": text, "metadata": dict(metadata)}
+                for pk, text, metadata in zip(pks, texts, metadatas or [{}] * len(texts))
+            ]
+            self._publish(vectors_name, documents)
+        return pks
+
+    def add_texts(
+        self, texts: Iterable[str], metadatas: list[dict] | None = None, **kwargs: Any
+    ) -> list[int]:  # type: ignore[override]
+        """Embed and store texts, returning their primary keys."""
+        texts = list(texts)
+        return self.add_embeddings(texts, self.embedding_function.embed_documents(texts), metadatas)
+
+    def delete(
+        self, ids: Sequence[Any] | None = None, metadata_filter: MetadataFilter | None = None, **kwargs: Any
+    ) -> bool:
+        """Remove documents by primary key or by metadata and compact the matrix."""
+        with self._writing():
+            if self._vectors is None:
+                return False
+            keep = np.ones(len(self._documents), dtype=bool)
+            if ids is not None:
+                keep &= ~np.isin([doc["pk"] for doc in self._documents], [int(pk) for pk in ids])
+            if metadata_filter:
+                keep &= ~self._mask(metadata_filter)
+            if keep.all():
+                return False
+            rows = np.flatnonzero(keep)
+            vectors_name, matrix = self._new_matrix(len(rows), self._vectors.shape[1])
+            if len(rows):
+                matrix[: len(rows)] = self._vectors[rows]
+            matrix.flush()
+            self._publish(vectors_name, [self._documents[row] for row in rows])
+        return True
+
+    # %% langchain search interface
+    def similarity_search_with_score(  # pylint: disable=arguments-differ # adds the metadata filter
+        self, query: str, k: int = 4, metadata_filter: MetadataFilter | None = None, **kwargs: Any
+    ) -> list[tuple[Document, float]]:
+        """Find the documents most similar to a query, with their cosine similarity."""
+        return self._search(self.embedding_function.embed_query(query), k, metadata_filter)
+
+    def similarity_search(
+        self, query: str, k: int = 4, metadata_filter: MetadataFilter | None = None, **kwargs: Any
+    ) -> list[Document]:
+        """Find the documents most similar to a query."""
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, metadata_filter)]
+
+    def similarity_search_by_vector(
+        self, embedding: list[float], k: int = 4, metadata_filter: MetadataFilter | None = None, **kwargs: Any
+    ) -> list[Document]:
+        """Find the documents most similar to an embedding."""
+        return [doc for doc, _ in self._search(embedding, k, metadata_filter)]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        """Map cosine similarities onto the 0 to 1 relevance scale."""
+        return lambda score: (score + 1) / 2
+
+    @classmethod
+    def from_texts(  # type: ignore[override]
+        cls,
+        texts: list[str],
+        embedding: Embeddings,
+        metadatas: list[dict] | None = None,
+        *,
+        path: str | Path = "",
+        collection_name: str = "collection_1",
+        **kwargs: Any,
+    ) -> "LocalVectorStore":
+        """Create a store and add texts to it."""
+        store = cls(embedding, path, collection_name, **kwargs)
+        store.add_texts(texts, metadatas)
+        return store
+
+
+# %% backend selection
+def connect_vector_store(config: Configuration, embedding: Embeddings) -> VectorStore:
+    """Open the vector store backend selected in the configuration."""
+    if config.vector_store.backend == "local":
+        _LOGGER.info("Using the local vector index in %s", config.vector_store.path)
+        return LocalVectorStore(
+            embedding,
+            config.vector_store.path,
+            config.milvus.collection_name,
+            dtype=config.vector_store.dtype,
+            ann=config.vector_store.ann,
+            ann_min_documents=config.vector_store.ann_min_documents,
+            ann_ef=config.vector_store.ann_ef,
+        )
+    return Milvus(
+        embedding_function=embedding,
+        connection_args={"uri": config.milvus.url},
+        collection_name=config.milvus.collection_name,
+        auto_id=True,
+        # langchain can not infer the type of list fields when it creates the collection
+        metadata_schema={
+            "tags": {
+                "dtype": DataType.ARRAY,
+                "kwargs": {
+                    "element_type": DataType.VARCHAR,
+                    "max_capacity": MAX_TAGS,
+                    "max_length": MAX_TAG_LENGTH,
+                },
+            }
+        },
+    )
+
+
+def create_scalar_indexes(vector_store: VectorStore) -> None:
+    """Index the Milvus collection's fields that retrieval filters read, so filtered searches skip the other rows."""
+    if not isinstance(vector_store, Milvus) or vector_store.col is None:
+        return
+    fields = {field.name for field in vector_store.col.schema.fields}
+    indexed = {index.field_name for index in vector_store.col.indexes}
+    for field, index_type in _SCALAR_INDEXES.items():
+        if field not in fields or field in indexed:
+            continue
+        try:
+            vector_store.col.create_index(field, {"index_type": index_type}, index_name=f"{field}_index")
+        except MilvusException as err:
+            _LOGGER.warning("Unable to index the %s field, filters on it scan the collection: %s", field, err)
+
+
+def search_kwargs(vector_store: VectorStore, retrieval_filter: RetrievalFilter) -> dict[str, Any]:
+    """Translate a retrieval filter into the search arguments of the vector store backend."""
+    if isinstance(vector_store, LocalVectorStore):
+        return {"metadata_filter": retrieval_filter.metadata_filter()}
+    if isinstance(vector_store, Milvus) and vector_store.col is not None:
+        expr = retrieval_filter.milvus_expr([field.name for field in vector_store.col.schema.fields])
+        return {"expr": expr} if expr else {}
+    return {}
+
+
+def iter_documents(vector_store: VectorStore, batch_size: int = 1000) -> Iterator[list[Document]]:
+    """Read every document in the collection in batches, with its primary key in the `pk` metadata field."""
+    if isinstance(vector_store, LocalVectorStore):
+        yield from vector_store.iter_documents(batch_size)
+        return
+    if not isinstance(vector_store, Milvus) or vector_store.col is None:
+        return
+    fields = [field.name for field in vector_store.col.schema.fields if field.dtype not in _MILVUS_VECTOR_TYPES]
+    iterator = vector_store.col.query_iterator(batch_size=batch_size, expr="", output_fields=fields)
+    try:
+        while batch := iterator.next():
+            rows = [dict(row) for row in batch]
+            yield [Document(page_content=row.pop(_MILVUS_TEXT_FIELD), metadata=row) for row in rows]
+    finally:
+        iterator.close()
+
+
+def ping(vector_store: VectorStore) -> None:
+    """Check that the vector store backend can be reached, raising its error when it cannot."""
+    if isinstance(vector_store, LocalVectorStore):
+        vector_store.ping()
+    elif isinstance(vector_store, Milvus):
+        vector_store.client.list_collections()
+
+
+def delete_file(vector_store: VectorStore, simple_file_name: str) -> None:
+    """Remove the documents that were uploaded from a file."""
+    if isinstance(vector_store, LocalVectorStore):
+        vector_store.delete(metadata_filter={"simple_file_name": simple_file_name})
+    else:
+        # Milvus strings use the same escapes as JSON, so quotes in the file name can not end the literal
+        vector_store.delete(expr=f"simple_file_name == {json.dumps(simple_file_name)}")
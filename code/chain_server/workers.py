@@ -0,0 +1,147 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run the chain server as several pre-forked worker processes that share one listening socket.
+
+The supervisor imports the application once and then forks the workers, so they share its memory and skip the slow
+imports. Every worker runs the server's lifespan on its own, with its own event loop, connection pools and clients, so
+the CPU bound work of formatting prompts and serializing the stream is spread across cores. The caches already live in
+Redis and the local vector index is memory mapped, so the workers share them. The Prometheus metrics of every worker
+are written to a shared directory and combined by the `/metrics` endpoint. Workers that exit are replaced.
+
+The number of workers is read from the `workers` setting of the configuration.
+
+```bash
+cd code
+APP_WORKERS=4 python -m chain_server.workers --host 0.0.0.0 --port 3030
+```
+"""
+
+import argparse
+import logging
+import os
+import signal
+import tempfile
+import time
+from contextlib import suppress
+from pathlib import Path
+from typing import Any
+
+import uvicorn
+
+from .configuration import WORKERS_ENV_VAR
+from .configuration import config as app_config
+
+_LOGGER = logging.getLogger(__name__)
+_METRICS_DIR_ENV_VAR = "PROMETHEUS_MULTIPROC_DIR"
+
+
+# pylint: disable-next=too-few-public-methods # the supervisor only runs
+class Supervisor:
+    """Fork the workers and replace the ones that exit, until the supervisor is told to stop."""
+
+    def __init__(self, config: uvicorn.Config, workers: int) -> None:
+        """Bind the listening socket that every worker accepts connections from."""
+        self._config = config
+        self._workers = workers
+        self._socket = config.bind_socket()
+        self._children: set[int] = set()
+        self._stopping = False
+
+    def _spawn(self) -> None:
+        """Fork a worker that serves the application until it is signaled to stop."""
+        pid = os.fork()
+        if pid:
+            self._children.add(pid)
+            return
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        exit_code = 1
+        try:
+            uvicorn.Server(self._config).run(sockets=[self._socket])
+            exit_code = 0
+        finally:
+            # never return into the supervisor's code
+            os._exit(exit_code)  # pylint: disable=protected-access # the documented way to leave a forked child
+
+    def _stop(self, signum: int, _: Any) -> None:
+        """Ask every worker to finish its requests and exit."""
+        _LOGGER.info("Received %s, stopping %d workers.", signal.Signals(signum).name, len(self._children))
+        self._stopping = True
+        for pid in self._children:
+            with suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+
+    def run(self) -> None:
+        """Serve until every worker has stopped."""
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for _ in range(self._workers):
+            self._spawn()
+        _LOGGER.info("Started %d workers on %s:%d.", self._workers, self._config.host, self._config.port)
+        while self._children:
+            pid, status = os.wait()
+            self._children.discard(pid)
+            if _METRICS_DIR_ENV_VAR in os.environ:
+                # pylint: disable-next=import-outside-toplevel # only imported once the metrics directory is set
+                from prometheus_client import multiprocess
+
+                multiprocess.mark_process_dead(pid)
+            if not self._stopping:
+                _LOGGER.warning(
+                    "Worker %d exited with code %d, starting a new one.", pid, os.waitstatus_to_exitcode(status)
+                )
+                time.sleep(1)
+                self._spawn()
+
+
+def _parse_arguments() -> argparse.Namespace:
+    """Parse the CLI arguments."""
+    parser = argparse.ArgumentParser("Chain Server workers")
+    parser.add_argument("--host", default="127.0.0.1", help="The address to listen on.")
+    parser.add_argument("--port", type=int, default=3030, help="The port to listen on.")
+    parser.add_argument("--log-level", default="info", help="The uvicorn log level.")
+    parser.add_argument(
+        "--timeout-graceful-shutdown", type=int, default=10, help="The seconds a stopping worker waits for requests."
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    """Import the application and serve it from the configured number of workers."""
+    args = _parse_arguments()
+    # the metrics must know they are shared before they are created by importing the application
+    if _METRICS_DIR_ENV_VAR in os.environ:
+        for stale in Path(os.environ[_METRICS_DIR_ENV_VAR]).glob("*.db"):
+            stale.unlink()
+    else:
+        os.environ[_METRICS_DIR_ENV_VAR] = tempfile.mkdtemp(prefix="nim-anywhere-metrics-")
+    # the workers split the admission limits between them as they import the application
+    os.environ[WORKERS_ENV_VAR] = str(app_config.workers)
+    # pylint: disable-next=import-outside-toplevel # the metrics directory must be set before the import
+    from .server import app
+
+    config = uvicorn.Config(
+        app,
+        host=args.host,
+        port=args.port,
+        log_level=args.log_level,
+        timeout_graceful_shutdown=args.timeout_graceful_shutdown,
+    )
+    Supervisor(config, app_config.workers).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -18,19 +18,25 @@
 from pathlib import Path
 import shutil
 import glob
+import logging
 from typing import List
 import time
+from datetime import datetime
 
-import os
 import gradio as gr
 import jinja2
+import redis
 import yaml
 
+from langchain_core.embeddings import Embeddings
 from langchain_nvidia_ai_endpoints import NVIDIAEmbeddings
-from langchain_milvus.vectorstores.milvus import Milvus
 from langchain_community.document_loaders import PyPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document
+from chain_server.cache import CachedEmbeddings, collection_version_key
+from chain_server.filters import parse_tags
+from chain_server.hybrid import SparseIndex
+from chain_server.vector_stores import connect_vector_store, create_scalar_indexes, delete_file
 from chain_server.configuration import Configuration as ChainConfiguration
 from chain_server.configuration import config as chain_config
 
@@ -38,6 +44,8 @@ from ... import mermaid
 from ...common import IMG_DIR, THEME, USE_KB_INITIAL, USE_RERANKER_INITIAL
 from ...configuration import config
 
+_LOGGER = logging.getLogger(__name__)
+
 # load custom style and scripts
 _CSS_FILE = Path(__file__).parent.joinpath("style.css")
 with open(_CSS_FILE, "r", encoding="UTF-8") as css_file:
@@ -85,19 +93,32 @@ with open(config.chain_config_file, "r", encoding="UTF-8") as config_file:
     _STARTING_CONFIG = config_file.read()
 
 # connect to our milvus DB
-embedding_model = NVIDIAEmbeddings(
+redis_client = redis.Redis.from_url(str(chain_config.redis_dsn))
+embedding_model: Embeddings = NVIDIAEmbeddings(
     model=chain_config.embedding_model.name,
     base_url=str(chain_config.embedding_model.url),
     api_key=chain_config.nvidia_api_key,
     truncate="END",
 )
+if chain_config.embedding_cache.enabled:
+    embedding_model = CachedEmbeddings(
+        embedding_model,
+        redis_client,
+        max_size=chain_config.embedding_cache.max_size,
+        ttl=chain_config.embedding_cache.ttl,
+    )
+
+vector_store = connect_vector_store(chain_config, embedding_model)
+sparse_index = SparseIndex(chain_config.milvus.collection_name, redis_client)
+
+
+def mark_collection_changed() -> None:
+    """Invalidate the chain server's cached answers after the knowledge base changes."""
+    try:
+        redis_client.incr(collection_version_key(chain_config.milvus.collection_name))
+    except redis.RedisError as err:
+        _LOGGER.warning("Unable to invalidate the answer cache: %s", err)
 
-vector_store = Milvus(
-    embedding_function=embedding_model,
-    connection_args={"uri": chain_config.milvus.url},
-    collection_name=chain_config.milvus.collection_name,
-    auto_id=True,
-)
 
 # web ui definition
 with gr.Blocks(theme=THEME, css=_CSS, head=mermaid.HEAD) as page:
@@ -140,6 +161,11 @@ with gr.Blocks(theme=THEME, css=_CSS, head=mermaid.HEAD) as page:
 
         # upload file button
         upload_btn = gr.UploadButton("Upload PDFs", icon=str(_UPLOAD_IMG), file_types=[".pdf"], file_count="multiple")
+        upload_tags = gr.Textbox(
+            label="Tags",
+            placeholder="Comma separated tags for the next upload, added to the keywords of each PDF",
+            max_lines=1,
+        )
 
         def refresh_button_callback():
             """Refesh docs button action"""
@@ -240,7 +266,14 @@ with gr.Blocks(theme=THEME, css=_CSS, head=mermaid.HEAD) as page:
         editor.input(None, js=_CONFIG_CHANGES_JS)
 
         # %% upload document actions
-        def upload_document(file_path, file_name) -> None:
+        def document_date(creation_date: str | None) -> int:
+            """Convert a PDF's creation date to Unix seconds, defaulting to now."""
+            try:
+                return int(datetime.fromisoformat(str(creation_date)).timestamp())
+            except ValueError:
+                return int(time.time())
+
+        def upload_document(file_path, file_name, tags: str = "") -> None:
             """Helper to upload a document to the milvus DB"""
             loader = PyPDFLoader(str(file_path))
             data = loader.load()
@@ -249,14 +282,18 @@ with gr.Blocks(theme=THEME, css=_CSS, head=mermaid.HEAD) as page:
             combined_content = "\n".join([page.page_content for page in data])
             new_metadata = data[0].metadata
             new_metadata["simple_file_name"] = file_name
+            # the fields retrieval filters read: the document's creation date, or the upload date, and its tags
+            new_metadata["date"] = document_date(new_metadata.get("creationdate"))
+            new_metadata["tags"] = parse_tags(new_metadata.get("keywords"), tags)
             combined_document = [Document(page_content=combined_content, metadata=new_metadata)]
 
-            vector_store.add_documents(documents=combined_document)
+            ids = vector_store.add_documents(documents=combined_document)
+            sparse_index.add_documents(combined_document, ids)
 
-        def upload_btn_callback(files) -> str:
+        def upload_btn_callback(files, tags) -> str:
             """Upload button action"""
 
-            # Specify chain server reload if inserting into an empty collection
+            # Specify chain server client rebuild if inserting into an empty collection
             need_reload = False
 
             # Search with a filler query to see if there are any docs in the vector store
@@ -269,17 +306,16 @@ with gr.Blocks(theme=THEME, css=_CSS, head=mermaid.HEAD) as page:
                 full_file_path = str(file.name)
                 file_name = file.name.split("/")[-1]  # Extract file name from path
                 try:
-                    upload_document(full_file_path, file_name)
+                    upload_document(full_file_path, file_name, tags)
                 except Exception as err:
                     raise IOError(f"Failed to upload {file_name}:\n{err}") from err
+            mark_collection_changed()
+            # the first upload creates the collection, index the fields that retrieval filters read
+            create_scalar_indexes(vector_store)
 
-            # Perform reload
+            # Touch the chain server's config, its clients are rebuilt without dropping in-flight requests
             if need_reload:
-                reload_filename = "reload"
-                with open(reload_filename, "w", encoding="utf-8") as file:
-                    pass  # 'pass' ensures the file is created but does nothing else
-                time.sleep(0.5)
-                os.remove(reload_filename)
+                Path(config.chain_config_file).touch()
 
             # Refresh uploaded files checkboxes
             time.sleep(1)
@@ -288,7 +324,7 @@ with gr.Blocks(theme=THEME, css=_CSS, head=mermaid.HEAD) as page:
             return refresh_results
 
         # Link upload button to callback
-        upload_btn.upload(upload_btn_callback, upload_btn, outputs=uploaded_files)
+        upload_btn.upload(upload_btn_callback, [upload_btn, upload_tags], outputs=uploaded_files)
 
         # %% Delete document actions
         def delete_button_callback(selected_docs):
@@ -305,11 +341,12 @@ with gr.Blocks(theme=THEME, css=_CSS, head=mermaid.HEAD) as page:
             """Confirm Delete Button Action (actually deletes docs)"""
 
             for filename in selected_docs:
-                expr = f"simple_file_name == '{filename}'"
                 try:
-                    vector_store.delete(expr=expr)
+                    delete_file(vector_store, filename)
+                    sparse_index.delete_file(filename)
                 except Exception as err:
                     raise IOError(f"Failed to remove {filename}:\n{err}") from err
+            mark_collection_changed()
 
             time.sleep(1)
             refresh_results = refresh_button_callback()
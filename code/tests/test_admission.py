@@ -0,0 +1,179 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the admission control of the upstream calls."""
+
+import asyncio
+import json
+from typing import Any, AsyncIterator
+
+import pytest
+from fastapi import FastAPI, Request, Response
+from fastapi.middleware import Middleware
+from fastapi.testclient import TestClient
+from langchain_core.runnables import RunnableGenerator
+from langserve import add_routes
+from sse_starlette.sse import AppStatus
+
+from chain_server import errors
+from chain_server.admission import AdmissionMiddleware, Overloaded, UpstreamLimiter, Upstreams, overloaded_response
+
+
+def _events(body: str) -> list[tuple[str, dict | str]]:
+    """Parse the events of a server sent event stream."""
+    events = []
+    for block in body.split("\r\n\r\n"):
+        if block:
+            event, data = block.split("\r\n")
+            events.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+    return events
+
+
+def _app(error: Exception, upstreams: Upstreams | None = None) -> FastAPI:
+    """Serve a chain that streams one chunk and then fails, with the server's middleware and error handler."""
+
+    async def _stream(inputs: AsyncIterator[str]) -> AsyncIterator[str]:
+        async for _ in inputs:
+            pass
+        yield "partial"
+        raise error
+
+    middleware = [Middleware(errors.ErrorHandlerMiddleware)]
+    if upstreams is not None:
+        middleware.append(Middleware(AdmissionMiddleware, upstreams=upstreams))
+    app = FastAPI(middleware=middleware)
+    add_routes(app, RunnableGenerator(_stream))
+
+    @app.exception_handler(Overloaded)
+    async def _overloaded(_: Request, err: Overloaded) -> Response:
+        return overloaded_response(err, 503)
+
+    return app
+
+
+@pytest.fixture(autouse=True)
+def _fresh_sse_status(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Keep the SSE shutdown event from binding to the event loop of an earlier test client."""
+    monkeypatch.setattr(AppStatus, "should_exit_event", None)
+
+
+def test_queued_calls_take_the_next_free_slot() -> None:
+    """Calls beyond the limit wait in the queue and run once a slot is released."""
+
+    async def _run() -> list[str]:
+        limiter = UpstreamLimiter("llm", max_concurrent=1, max_queued=1, max_wait=5)
+        order = []
+        release = asyncio.Event()
+
+        async def _first() -> None:
+            async with limiter.slot():
+                order.append("first")
+                await release.wait()
+
+        async def _second() -> None:
+            async with limiter.slot():
+                order.append("second")
+
+        first = asyncio.create_task(_first())
+        await asyncio.sleep(0)
+        second = asyncio.create_task(_second())
+        await asyncio.sleep(0)
+        assert limiter.stats == {"active": 1, "queued": 1, "limit": 1}
+        assert limiter.saturated
+        release.set()
+        await asyncio.gather(first, second)
+        assert limiter.stats == {"active": 0, "queued": 0, "limit": 1}
+        return order
+
+    assert asyncio.run(_run()) == ["first", "second"]
+
+
+def test_calls_are_rejected_when_the_queue_is_full() -> None:
+    """A call that finds the queue full is rejected right away, with a hint of when to retry."""
+
+    async def _run() -> None:
+        limiter = UpstreamLimiter("llm", max_concurrent=1, max_queued=0, max_wait=5)
+        async with limiter.slot():
+            with pytest.raises(Overloaded) as rejected:
+                async with limiter.slot():
+                    pass
+        assert rejected.value.upstream == "llm"
+        assert rejected.value.retry_after >= 1
+        assert limiter.stats["active"] == 0
+
+    asyncio.run(_run())
+
+
+def test_calls_are_rejected_after_waiting_too_long() -> None:
+    """Queued calls give up after the maximum wait and leave the queue."""
+
+    async def _run() -> None:
+        limiter = UpstreamLimiter("embedding", max_concurrent=1, max_queued=1, max_wait=0.01)
+        async with limiter.slot():
+            with pytest.raises(Overloaded):
+                async with limiter.slot():
+                    pass
+            assert limiter.stats == {"active": 1, "queued": 0, "limit": 1}
+            with pytest.raises(Overloaded):
+                with limiter.thread_slot():
+                    pass
+        assert limiter.stats == {"active": 0, "queued": 0, "limit": 1}
+
+    asyncio.run(_run())
+
+
+def test_chain_requests_are_turned_away_while_saturated() -> None:
+    """Requests to the chain are rejected with a 429 while an upstream's queue is full, other routes still answer."""
+    upstreams = Upstreams({"llm": 1}, max_queued=0, max_wait=1)
+    with TestClient(_app(RuntimeError("unused"), upstreams)) as client:
+        with upstreams["llm"].thread_slot():
+            rejected = client.post("/invoke", json={"input": "hi"})
+            assert client.get("/docs").status_code == 200
+    assert rejected.status_code == 429
+    assert int(rejected.headers["Retry-After"]) >= 1
+
+
+def test_streams_end_with_an_overloaded_event() -> None:
+    """A stream whose upstream call is rejected after it started ends with a 503 error event and a retry hint."""
+    with TestClient(_app(Overloaded("llm", 3))) as client:
+        response = client.post("/stream", json={"input": "hi"})
+    assert response.status_code == 200
+    events = _events(response.text)
+    assert events[1] == ("data", "partial")
+    assert events[-1][0] == "error"
+    assert events[-1][1] == {
+        "status_code": 503,
+        "message": "The llm service is overloaded, retry after 3 seconds.",
+        "retry_after": 3,
+    }
+
+
+def test_other_stream_errors_are_rewritten() -> None:
+    """Other errors still end the stream with the generic error event, and are raised for the server to log."""
+    sent = []
+
+    async def _app(_scope: dict, _receive: object, send: Any) -> None:
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send(
+            {"type": "http.response.body", "body": b'event: error\r\ndata: {"message": "secret"}', "more_body": True}
+        )
+        raise RuntimeError("secret")
+
+    async def _send(message: dict) -> None:
+        sent.append(message)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(errors.ErrorHandlerMiddleware(_app)({"type": "http"}, None, _send))
+    assert sent[-1] == errors._SSE_ERROR_MESSAGE  # pylint: disable=protected-access
@@ -0,0 +1,170 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the semantic answer cache."""
+
+import asyncio
+
+import fakeredis
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from chain_server.cache import CachedEmbeddings, SemanticAnswerCache
+from chain_server.filters import RetrievalFilter
+
+
+def _cache(
+    client: fakeredis.FakeAsyncRedis, llm_model: str = "llm-a", embedding_model: str = "embed-a"
+) -> SemanticAnswerCache:
+    """Create a cache on a fake Redis server."""
+    return SemanticAnswerCache(
+        client,
+        collection_name="docs",
+        similarity_threshold=0.9,
+        ttl=60,
+        max_entries=10,
+        llm_model=llm_model,
+        embedding_model=embedding_model,
+    )
+
+
+def test_scope_includes_the_retrieval_settings_and_models() -> None:
+    """Every setting that changes the answer or the question vectors selects a different scope."""
+
+    async def _scopes() -> list[str | None]:
+        client = fakeredis.FakeAsyncRedis()
+        cache = _cache(client)
+        return [
+            await cache.scope(False, False),
+            await cache.scope(True, False),
+            await cache.scope(True, True),
+            await cache.scope(True, False, RetrievalFilter.model_validate({"source": ["a.pdf"]})),
+            await _cache(client, llm_model="llm-b").scope(True, False),
+            await _cache(client, embedding_model="embed-b").scope(True, False),
+            await _cache(client, llm_model="llm-b").scope(False, False),
+        ]
+
+    scopes = asyncio.run(_scopes())
+    assert len(set(scopes)) == len(scopes)
+    assert "llm=llm-a" in str(scopes[1]) and "embedding=embed-a" in str(scopes[1])
+
+
+def test_lookup_finds_similar_questions_only() -> None:
+    """A stored answer is replayed for a similar question and not for a different one."""
+
+    async def _lookups() -> tuple[str | None, str | None]:
+        cache = _cache(fakeredis.FakeAsyncRedis())
+        scope = await cache.scope(True, False)
+        await cache.store("What is NIM?", [1.0, 0.0, 0.0], scope, "A microservice.")
+        return await cache.lookup([0.99, 0.05, 0.0], scope), await cache.lookup([0.0, 1.0, 0.0], scope)
+
+    similar, different = asyncio.run(_lookups())
+    assert similar == "A microservice."
+    assert different is None
+
+
+def test_mirrors_are_bounded() -> None:
+    """Only the most recently used scopes are mirrored, and scopes of older knowledge bases are dropped."""
+
+    async def _mirrored() -> tuple[list[str], list[str], list[str]]:
+        client = fakeredis.FakeAsyncRedis()
+        cache = SemanticAnswerCache(
+            client, "docs", 0.9, 60, 10, max_mirrors=2, llm_model="llm-a", embedding_model="embed-a"
+        )
+        scopes = [await cache.scope(True, False, RetrievalFilter.model_validate({"tags": [tag]})) for tag in "abc"]
+        for scope in scopes:
+            await cache.lookup([1.0, 0.0], scope)
+        bounded = list(cache._mirrors)  # pylint: disable=protected-access
+        await client.incr("nim-anywhere:collection-version:docs")
+        await cache.lookup([1.0, 0.0], await cache.scope(True, True))
+        return [str(scope) for scope in scopes[1:]], bounded, list(cache._mirrors)  # pylint: disable=protected-access
+
+    recent, bounded, after_update = asyncio.run(_mirrored())
+    assert bounded == recent
+    assert len(after_update) == 1
+    assert after_update[0].startswith("kb:docs:1:")
+
+
+def test_models_do_not_share_answers() -> None:
+    """An answer stored with one LLM is not replayed after switching to another."""
+
+    async def _lookup() -> str | None:
+        client = fakeredis.FakeAsyncRedis()
+        old = _cache(client)
+        await old.store("What is NIM?", [1.0, 0.0], await old.scope(True, False), "A microservice.")
+        new = _cache(client, llm_model="llm-b")
+        return await new.lookup([1.0, 0.0], await new.scope(True, False))
+
+    assert asyncio.run(_lookup()) is None
+
+
+def test_vectors_of_different_sizes_are_a_miss() -> None:
+    """A scope holding vectors of different sizes is skipped instead of failing the request."""
+
+    async def _lookup() -> str | None:
+        client = fakeredis.FakeAsyncRedis()
+        cache = _cache(client)
+        scope = await cache.scope(True, False)
+        await cache.store("What is NIM?", [1.0, 0.0], scope, "A microservice.")
+        await client.hset(
+            f"nim-anywhere:answer-cache:{scope}:vectors", mapping={"stale": np.ones(3, dtype=np.float32).tobytes()}
+        )
+        await client.incr(f"nim-anywhere:answer-cache:{scope}:generation")
+        return await cache.lookup([1.0, 0.0], scope)
+
+    assert asyncio.run(_lookup()) is None
+
+
+class _AsyncOnlyEmbeddings(Embeddings):
+    """An embedding model that counts its asyncio calls and fails its blocking ones."""
+
+    def __init__(self) -> None:
+        """Initialize the counter."""
+        self.calls = 0
+
+    def embed_query(self, text: str) -> list[float]:
+        """Fail, the cache must not block a thread on the model."""
+        raise AssertionError("The blocking interface was used.")
+
+    async def aembed_query(self, text: str) -> list[float]:
+        """Embed a query."""
+        self.calls += 1
+        return [float(len(text)), 1.0]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """Fail, documents are not embedded by these tests."""
+        raise AssertionError("Documents are not cached.")
+
+
+def test_embedding_misses_use_the_async_model() -> None:
+    """A miss is embedded through the wrapped model's asyncio interface and then served from both tiers."""
+    client = fakeredis.FakeRedis()
+    model = _AsyncOnlyEmbeddings()
+
+    async def _embed() -> tuple[list[float], list[float], list[float], dict]:
+        first = await CachedEmbeddings(model, client, max_size=4, ttl=60).aembed_query("What is NIM?")
+        cache = CachedEmbeddings(model, client, max_size=4, ttl=60)
+        # let the background write to the shared tier finish
+        for _ in range(100):
+            if client.dbsize():
+                break
+            await asyncio.sleep(0.01)
+        shared, memory = await cache.aembed_query("What  is NIM?"), await cache.aembed_query("What is NIM?")
+        return first, shared, memory, cache.stats
+
+    first, shared, memory, stats = asyncio.run(_embed())
+    assert first == shared == memory == [12.0, 1.0]
+    assert model.calls == 1
+    assert (stats["redis_hits"], stats["memory_hits"], stats["misses"]) == (1, 1, 0)
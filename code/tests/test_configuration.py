@@ -0,0 +1,34 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the configuration."""
+
+from chain_server.configuration import LogLevels, config, restart_required
+
+
+def test_restart_required_lists_the_marked_options() -> None:
+    """Changes to options read on start are listed by their path, changes applied by a reload are not."""
+    changed = config.model_copy(
+        update={
+            "workers": config.workers + 1,
+            "log_level": LogLevels.DEBUG,
+            "admission": config.admission.model_copy(update={"max_queued": config.admission.max_queued + 1}),
+            "history": config.history.model_copy(
+                update={"max_turns": config.history.max_turns + 1, "sweep_interval": config.history.sweep_interval + 1}
+            ),
+        }
+    )
+    assert restart_required(changed, config) == ["admission", "history.sweep_interval", "workers"]
+    assert not restart_required(config, config)
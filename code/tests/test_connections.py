@@ -0,0 +1,84 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the load balancing across model replicas."""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator
+
+import pytest
+
+from chain_server.connections import HTTPPool
+from chain_server.replicas import ReplicaSet
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Answer every request with a short body."""
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name # interface defined by http.server
+        """Send the body."""
+        body = b"line\n" * 1000
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:  # pylint: disable=arguments-differ
+        """Keep the test output quiet."""
+
+
+@pytest.fixture(name="replica_url")
+def _replica_url() -> Iterator[str]:
+    """Serve a replica on a free local port."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_replica_urls_are_normalized_before_deduplicating() -> None:
+    """URLs that only differ by a trailing slash are the same replica."""
+    replica_set = ReplicaSet(["http://a/v1", "http://a/v1/", "http://b/v1/"], eject_seconds=1)
+    assert [replica.url for replica in replica_set.replicas] == ["http://a/v1", "http://b/v1"]
+
+
+def test_replicas_are_released_when_the_response_is_read(replica_url: str) -> None:
+    """A request stops counting against its replica when the body is read, or when a stream ends or is closed."""
+    pool = HTTPPool(max_connections=4, connect_timeout=1, read_timeout=5)
+    replica_set = ReplicaSet([f"{replica_url}/v1", f"{replica_url.replace('127.0.0.1', 'localhost')}/v1"], 1)
+    pool._adapter.replica_sets = [replica_set]  # pylint: disable=protected-access
+
+    def outstanding() -> int:
+        return sum(replica.outstanding for replica in replica_set.replicas)
+
+    try:
+        assert pool.session.get(f"{replica_url}/v1/models").ok
+        assert outstanding() == 0
+
+        streamed = pool.session.get(f"{replica_url}/v1/models", stream=True)
+        assert outstanding() == 1
+        assert sum(1 for _ in streamed.iter_lines()) == 1000
+        assert outstanding() == 0
+
+        closed = pool.session.get(f"{replica_url}/v1/models", stream=True)
+        assert outstanding() == 1
+        closed.close()
+        assert outstanding() == 0
+        assert [replica.requests for replica in replica_set.replicas] == [2, 1]
+    finally:
+        pool.close()
@@ -0,0 +1,110 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the translation of retrieval filters for each index."""
+
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+import pytest
+from langchain_core.embeddings import FakeEmbeddings
+from langchain_core.vectorstores import InMemoryVectorStore
+
+from chain_server.filters import MAX_TAGS, RetrievalFilter, UnsupportedFilter, parse_tags
+from chain_server.vector_stores import LocalVectorStore, delete_file, search_kwargs
+
+_FIELDS = ["pk", "text", "vector", "source", "simple_file_name", "tags", "date"]
+_JAN_1 = int(datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp())
+_FEB_1 = int(datetime(2024, 2, 1, tzinfo=timezone.utc).timestamp())
+
+
+def _filter(**values: object) -> RetrievalFilter:
+    """Validate a filter the way the chain reads it from its input."""
+    return RetrievalFilter.model_validate(values)
+
+
+def test_milvus_expr_joins_every_condition() -> None:
+    """Every given field becomes a clause, strings are quoted and dates are read as UTC."""
+    retrieval_filter = _filter(
+        simple_file_name=['a "quoted".pdf', "b.pdf"], tags=["gpu"], after="2024-01-01", before="2024-02-01T00:00:00Z"
+    )
+    assert retrieval_filter.milvus_expr(_FIELDS) == (
+        'simple_file_name in ["a \\"quoted\\".pdf", "b.pdf"] and array_contains_any(tags, ["gpu"]) '
+        f"and date >= {_JAN_1} and date <= {_FEB_1}"
+    )
+    assert _filter().milvus_expr(_FIELDS) is None
+
+
+def test_milvus_expr_rejects_missing_fields() -> None:
+    """A filter on a field the collection does not have can not match any document."""
+    with pytest.raises(UnsupportedFilter, match="date, tags"):
+        _filter(source=["a.pdf"], tags=["gpu"], after="2024-01-01").milvus_expr(["source"])
+
+
+def test_metadata_filter_and_matches_agree() -> None:
+    """The local index filter and the check of keyword matches select the same documents."""
+    retrieval_filter = _filter(tags=["gpu", "nim"], after="2024-01-01")
+    assert retrieval_filter.metadata_filter() == {"tags": ["gpu", "nim"], "date": {"min": _JAN_1, "max": None}}
+    assert retrieval_filter.matches({"tags": ["nim"], "date": _FEB_1})
+    assert not retrieval_filter.matches({"tags": ["nim"], "date": _JAN_1 - 1})
+    assert not retrieval_filter.matches({"tags": ["cpu"], "date": _FEB_1})
+    assert not retrieval_filter.matches({"tags": ["nim"]})
+    assert _filter(source=["a.pdf"]).matches({"source": "a.pdf"})
+    assert not _filter(source=["a.pdf"]).matches({})
+
+
+def test_filter_key_is_stable() -> None:
+    """Equal filters share a key, different filters do not."""
+    assert _filter(tags=["gpu"], after="2024-01-01").key == _filter(after="2024-01-01T00:00:00", tags=["gpu"]).key
+    assert _filter(tags=["gpu"]).key != _filter(tags=["nim"]).key
+
+
+def test_local_index_applies_the_filter(tmp_path: Path) -> None:
+    """The local vector index only returns the documents that match the filter."""
+    store = LocalVectorStore(FakeEmbeddings(size=8), tmp_path, "test")
+    store.add_texts(
+        ["old gpu", "new gpu", "new cpu", "untagged"],
+        [
+            {"tags": ["gpu"], "date": _JAN_1 - 1},
+            {"tags": ["gpu", "nim"], "date": _FEB_1},
+            {"tags": ["cpu"], "date": _FEB_1},
+            {"date": _FEB_1},
+        ],
+    )
+    kwargs = search_kwargs(store, _filter(tags=["gpu"], after="2024-01-01"))
+    assert [doc.page_content for doc in store.similarity_search("gpu", k=4, **kwargs)] == ["new gpu"]
+
+
+def test_milvus_file_deletion_quotes_the_file_name() -> None:
+    """A quote in a file name can not end the string literal of the delete expression."""
+    deleted: list[dict[str, Any]] = []
+
+    # pylint: disable-next=abstract-method # only deletes are made
+    class _RecordingStore(InMemoryVectorStore):
+        """A vector store that records its delete arguments."""
+
+        def delete(self, ids: list[str] | None = None, **kwargs: Any) -> None:
+            """Record the arguments."""
+            deleted.append(kwargs)
+
+    delete_file(_RecordingStore(FakeEmbeddings(size=4)), 'it\'s "quoted".pdf')
+    assert deleted == [{"expr": 'simple_file_name == "it\'s \\"quoted\\".pdf"'}]
+
+
+def test_parse_tags() -> None:
+    """Tags are split on commas and semicolons, trimmed, deduplicated and capped."""
+    assert parse_tags("gpu; NIM,  inference", None, "gpu, rag,") == ["gpu", "NIM", "inference", "rag"]
+    assert len(parse_tags(",".join(str(idx) for idx in range(2 * MAX_TAGS)))) == MAX_TAGS
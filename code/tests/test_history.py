@@ -0,0 +1,133 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the compact chat history store and its sweeper."""
+
+import asyncio
+
+import fakeredis
+from langchain_core.messages import AIMessage, ChatMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import RunnableLambda
+
+from chain_server.history import (
+    BoundedChatMessageHistory,
+    RedisMessageStore,
+    _decode_message,
+    _encode_message,
+)
+from chain_server.sweeper import HistorySweeper
+from chain_server.tokens import estimate_tokens
+
+
+def _store(session_id: str = "session", **kwargs: int) -> RedisMessageStore:
+    """Create a store on a fake Redis server shared by its blocking and asyncio clients."""
+    server = fakeredis.FakeServer()
+    return RedisMessageStore(
+        session_id, fakeredis.FakeRedis(server=server), fakeredis.FakeAsyncRedis(server=server), **kwargs
+    )
+
+
+def _turns(count: int) -> list[HumanMessage | AIMessage]:
+    """Create the messages of a number of turns."""
+    messages: list[HumanMessage | AIMessage] = []
+    for turn in range(count):
+        messages += [HumanMessage(content=f"question {turn}"), AIMessage(content=f"answer {turn}")]
+    return messages
+
+
+def test_messages_are_packed_compactly() -> None:
+    """Chat messages keep their type and content, long content is compressed and other messages use JSON."""
+    short = HumanMessage(content="What is NIM?")
+    assert _encode_message(short) == b"\x00What is NIM?"
+    long = AIMessage(content="NIM serves models. " * 100)
+    encoded = _encode_message(long)
+    assert encoded[0] & 0x80 and len(encoded) < len(long.content)
+    other = ChatMessage(role="tool", content="result")
+    for message in (short, long, SystemMessage(content="Be brief."), other):
+        decoded = _decode_message(_encode_message(message))
+        assert type(decoded) is type(message) and decoded.content == message.content
+    assert _decode_message(_encode_message(other)).role == "tool"  # type: ignore[attr-defined]
+
+
+def test_store_keeps_the_latest_messages() -> None:
+    """The list is capped at the maximum, while the message numbers keep counting every message."""
+    store = _store(max_messages=4, ttl=60)
+    store.add_messages(_turns(2))
+    store.add_messages(_turns(3)[4:])
+    stored = store.load()
+    assert stored.total == 6 and stored.offset == 2
+    assert [message.content for message in stored.messages] == ["question 1", "answer 1", "question 2", "answer 2"]
+    assert [message.content for message in stored.since(5)] == ["answer 2"]
+    assert [message.content for message in store.load(2).messages] == ["question 2", "answer 2"]
+    assert 0 < int(store._client.ttl(store.key)) <= 60  # type: ignore[arg-type] # pylint: disable=protected-access
+
+
+def test_window_holds_the_summary_and_the_latest_turns() -> None:
+    """Turns are summarized in blocks, so the history only grows between folds and never starts mid turn."""
+    calls = []
+
+    def _summarize(inputs: dict[str, str]) -> str:
+        calls.append(inputs)
+        return f"{inputs['summary']} | {inputs['new_lines']}".strip(" |")
+
+    history = BoundedChatMessageHistory(_store(), RunnableLambda(_summarize), max_turns=1, token_budget=1000)
+    turns = _turns(4)
+    history.add_messages(turns[:2])
+    history.add_messages(turns[2:4])
+    assert not calls and history.messages == turns[:4]
+
+    history.add_messages(turns[4:6])
+    assert calls == [{"summary": "", "new_lines": "Human: question 0\nAI: answer 0\nHuman: question 1\nAI: answer 1"}]
+    summary, *window = history.messages
+    assert isinstance(summary, SystemMessage) and "question 1" in str(summary.content)
+    assert [message.content for message in window] == ["question 2", "answer 2"]
+
+    # the next turn is appended behind the same summary
+    history.add_messages(turns[6:])
+    assert len(calls) == 1 and history.messages == [summary, *turns[4:]]
+
+    # room for the answer of the last turn, but not its question
+    history.token_budget = estimate_tokens(history.store.load().summary) + estimate_tokens("answer 3") + 1
+    assert history.messages == [summary]
+
+
+def test_sweeper_compacts_and_evicts_sessions() -> None:
+    """Summarized messages are dropped, orphaned message lists are deleted and keys without an expiry get one."""
+
+    async def _sweep() -> tuple[dict, list[str]]:
+        summarized = _store("summarized")
+        client, async_client = summarized._client, summarized._async_client  # pylint: disable=protected-access
+        await summarized.aadd_messages(_turns(3))
+        await summarized.asave_summary("the first two turns", 4)
+        orphaned = RedisMessageStore("orphaned", client, async_client)
+        await orphaned.aadd_messages(_turns(1))
+        await async_client.delete(orphaned.meta_key)
+
+        report = await HistorySweeper(client, async_client, ttl=60, interval=1).sweep()
+        remaining = [str(message.content) for message in (await summarized.aload()).messages]
+        assert not await async_client.exists(orphaned.key)
+        assert 0 < await async_client.ttl(summarized.key) <= 60
+        return report, remaining
+
+    report, remaining = asyncio.run(_sweep())
+    assert remaining == ["question 2", "answer 2"]
+    assert {key: report[key] for key in ("sessions", "messages", "stored", "compacted", "evicted", "expired")} == {
+        "sessions": 1,
+        "messages": 6,
+        "stored": 2,
+        "compacted": 1,
+        "evicted": 1,
+        "expired": 1,
+    }
@@ -0,0 +1,124 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the keyword index and the hybrid retriever."""
+
+import asyncio
+from typing import cast
+
+import fakeredis
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from chain_server.filters import RetrievalFilter
+from chain_server.hybrid import HybridRetriever, SparseIndex, reciprocal_rank_fusion, tokenize
+
+_DOCUMENTS = [
+    Document(page_content="Deploy the nv-embedqa-e5-v5 model with NIM.", metadata={"simple_file_name": "embed.pdf"}),
+    Document(
+        page_content="Redis stores the chat history of every session.", metadata={"simple_file_name": "redis.pdf"}
+    ),
+    Document(page_content="Milvus stores the document vectors.", metadata={"simple_file_name": "milvus.pdf"}),
+]
+
+
+class _FixedRetriever(BaseRetriever):
+    """A dense retriever that always returns the same documents."""
+
+    documents: list[Document]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        """Return the fixed documents."""
+        return self.documents
+
+
+def _index(client: fakeredis.FakeRedis | None = None) -> SparseIndex:
+    """Index the test documents under the primary keys 1 to 3."""
+    index = SparseIndex("test", client or fakeredis.FakeRedis())
+    index.add_documents(_DOCUMENTS, [1, 2, 3])
+    return index
+
+
+def _doc(pk: int) -> Document:
+    """Create a document identified by its primary key."""
+    return Document(page_content=f"document {pk}", metadata={"pk": pk})
+
+
+def test_tokenize_keeps_model_names_together() -> None:
+    """Identifiers with dashes and dots are single terms."""
+    assert tokenize("Is nv-embedqa-e5-v5 in llama3.1?") == ["is", "nv-embedqa-e5-v5", "in", "llama3.1"]
+
+
+def test_search_ranks_the_matching_documents() -> None:
+    """Documents with more of the rare query terms rank first, and documents without any are not returned."""
+    index = _index()
+    results = index.search("which model does nv-embedqa-e5-v5 stand for", k=3)
+    assert [doc.metadata["pk"] for doc in results] == [1]
+    results = index.search("which stores keep chat history", k=3)
+    assert [doc.metadata["pk"] for doc in results] == [2, 3]
+    assert results[0].metadata["simple_file_name"] == "redis.pdf"
+    assert asyncio.run(index.asearch("which stores keep chat history", k=1))[0].metadata["pk"] == 2
+
+
+def test_search_reads_a_bounded_number_of_postings() -> None:
+    """Only the postings with the most occurrences of a term are read, and common terms are skipped."""
+    index = SparseIndex("test", fakeredis.FakeRedis(), max_postings=1)
+    index.add_documents(_DOCUMENTS, [1, 2, 3])
+    index.add_documents([Document(page_content="Milvus, Milvus and Milvus.")], [4])
+    assert [doc.metadata["pk"] for doc in index.search("milvus", k=3)] == [4]
+    # "the" is in three of the four documents, more than the postings that are read
+    assert not index.search("the", k=3)
+    assert [doc.metadata["pk"] for doc in index.search("the chat", k=3)] == [2]
+
+
+def test_delete_file_removes_its_documents() -> None:
+    """Deleted documents are no longer found."""
+    index = _index()
+    index.delete_file("redis.pdf")
+    assert [doc.metadata["pk"] for doc in index.search("stores history", k=3)] == [3]
+
+
+def test_backfill_only_adds_missing_documents() -> None:
+    """Documents that are already indexed are skipped, so their term statistics are not counted twice."""
+    client = fakeredis.FakeRedis()
+    index = SparseIndex("test", client)
+    index.add_documents(_DOCUMENTS[:1], [1])
+    stored = [
+        Document(page_content=doc.page_content, metadata={**doc.metadata, "pk": pk})
+        for pk, doc in enumerate(_DOCUMENTS, 1)
+    ]
+    assert index.backfill([stored[:2], stored[2:]]) == 2
+    assert index.backfill([stored]) == 0
+    total_length = sum(len(tokenize(doc.page_content)) for doc in _DOCUMENTS)
+    assert int(cast(bytes, client.get("nim-anywhere:sparse:test:total_length"))) == total_length
+    assert [doc.metadata["pk"] for doc in index.search("milvus vectors", k=3)] == [3]
+
+
+def test_reciprocal_rank_fusion_favors_documents_in_both_rankings() -> None:
+    """A document ranked by both searches beats documents ranked first by only one of them."""
+    fused = reciprocal_rank_fusion([[_doc(1), _doc(2), _doc(3)], [_doc(4), _doc(2)]])
+    assert [doc.metadata["pk"] for doc in fused] == [2, 1, 4, 3]
+
+
+def test_hybrid_retriever_filters_keyword_matches() -> None:
+    """Keyword matches that fail the filter are dropped, the dense results are kept as they are."""
+    dense = _FixedRetriever(documents=[_doc(9)])
+    retriever = HybridRetriever(dense=dense, sparse=_index(), k=2)
+    retrieval_filter = RetrievalFilter.model_validate({"simple_file_name": ["milvus.pdf"]})
+    results = retriever.invoke("which stores keep chat history", keyword_filter=retrieval_filter.matches)
+    assert sorted(doc.metadata["pk"] for doc in results) == [3, 9]
+    results = asyncio.run(retriever.ainvoke("which stores keep chat history"))
+    assert sorted(doc.metadata["pk"] for doc in results) == [2, 9]
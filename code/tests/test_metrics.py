@@ -0,0 +1,43 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the chain's request metrics."""
+
+from typing import Generator
+
+from langchain_core.messages import AIMessageChunk
+
+from chain_server import metrics
+
+
+def test_generation_timer_records_an_abandoned_stream() -> None:
+    """A stream that is not read to its end still records its generation time and tokens."""
+    timings = metrics.start_request(use_kb=False, use_reranker=False)
+    labels = {"use_kb": "false", "use_reranker": "false"}
+    before = metrics.COMPLETION_TOKENS.labels(**labels)._value.get()  # pylint: disable=protected-access
+
+    def _stream() -> Generator[AIMessageChunk, None, None]:
+        """Stream an answer through the timer."""
+        with metrics.GenerationTimer("What is NIM?") as timer:
+            for content in ("NIM serves ", "models."):
+                chunk = AIMessageChunk(content=content)
+                timer.observe(chunk)
+                yield chunk
+
+    stream = _stream()
+    next(stream)
+    stream.close()
+    assert "time_to_first_token" in timings and "generation" in timings
+    assert metrics.COMPLETION_TOKENS.labels(**labels)._value.get() > before  # pylint: disable=protected-access
@@ -0,0 +1,88 @@
+# SPDX-FileCopyrightText: Copyright (c) 2024 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the packing of retrieved documents into the prompt context."""
+
+import pytest
+from langchain_core.documents import Document
+
+from chain_server import packing
+from chain_server.packing import pack_documents
+
+
+def _doc(text: str, source: str, score: float | None = None) -> Document:
+    """Create a retrieved document, optionally scored by the reranker."""
+    metadata: dict = {"source": source}
+    if score is not None:
+        metadata["relevance_score"] = score
+    return Document(page_content=text, metadata=metadata)
+
+
+_NIM = "NVIDIA NIM microservices package optimized inference engines for foundation models."
+_REDIS = "The chain server keeps the chat history of every session in Redis."
+_MILVUS = "Milvus stores the embeddings of the uploaded documents for the vector search."
+
+
+def test_near_duplicates_are_dropped() -> None:
+    """A chunk that repeats one already packed is skipped, distinct chunks are kept."""
+    docs = [_doc(_NIM, "a.pdf"), _doc(_NIM.replace("models.", "models!"), "b.pdf"), _doc(_REDIS, "c.pdf")]
+    assert pack_documents(docs, token_budget=1000, duplicate_threshold=0.9, chunk_tokens=100) == [_NIM, _REDIS]
+
+
+def test_reranked_documents_are_packed_by_score() -> None:
+    """Scored documents are packed from the most to the least relevant."""
+    docs = [_doc(_NIM, "a.pdf", 0.1), _doc(_REDIS, "b.pdf", 0.9), _doc(_MILVUS, "c.pdf", 0.5)]
+    assert pack_documents(docs, token_budget=1000, duplicate_threshold=0.9, chunk_tokens=100) == [
+        _REDIS,
+        _MILVUS,
+        _NIM,
+    ]
+
+
+def test_packing_stops_at_the_budget() -> None:
+    """Packing stops at the first chunk that does not fit, and the documents after it are never chunked."""
+    chunked: list[str] = []
+    chunks = packing._chunks  # pylint: disable=protected-access
+
+    def _recording_chunks(text: str, chunk_tokens: int) -> list[str]:
+        chunked.append(text)
+        return chunks(text, chunk_tokens)
+
+    docs = [_doc(_NIM, "a.pdf"), _doc(_REDIS, "b.pdf"), _doc(_MILVUS, "c.pdf")]
+    budget = packing.estimate_tokens(_NIM) + packing.estimate_tokens(_REDIS)
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(packing, "_chunks", _recording_chunks)
+        assert pack_documents(docs, token_budget=budget, duplicate_threshold=0.9, chunk_tokens=100) == [_NIM, _REDIS]
+        assert chunked == [_NIM, _REDIS]
+        assert not pack_documents(docs, token_budget=1, duplicate_threshold=0.9, chunk_tokens=100)
+
+
+def test_long_documents_are_chunked_at_paragraphs() -> None:
+    """Paragraphs are merged into chunks up to the chunk size, and only the chunks that fit are packed."""
+    text = "\n\n".join([_NIM, _REDIS, _MILVUS])
+    budget = packing.estimate_tokens(_NIM) + packing.estimate_tokens(_REDIS) + 1
+    packed = pack_documents([_doc(text, "a.pdf")], token_budget=budget, duplicate_threshold=0.9, chunk_tokens=25)
+    assert packed == [_NIM, _REDIS]
+
+
+def test_stable_order_sorts_by_source_and_position() -> None:
+    """The same chunks serialize identically whatever their rank."""
+    first = [_doc(_NIM, "b.pdf", 0.9), _doc(_REDIS, "a.pdf", 0.5), _doc(_MILVUS, "c.pdf", 0.1)]
+    second = [_doc(_MILVUS, "c.pdf", 0.9), _doc(_NIM, "b.pdf", 0.5), _doc(_REDIS, "a.pdf", 0.1)]
+    packed = [
+        pack_documents(docs, token_budget=1000, duplicate_threshold=0.9, chunk_tokens=100, stable_order=True)
+        for docs in (first, second)
+    ]
+    assert packed[0] == packed[1] == [_REDIS, _NIM, _MILVUS]